@@ -3,7 +3,12 @@
 Analyzers are functions that inspect a pull request and return True or False
 depending on whether the analyzer's fact is true.
 
-Analyzer functions are registered with the @analyzer decorator.
+Analyzers don't read the PR dict directly. `extract_features` walks the PR once
+and builds a feature record of parsed timestamps, counts and lowercased text,
+and each analyzer reads the features it declares.
+
+Analyzer functions are registered with the @analyzer decorator, which takes the
+names of the features the analyzer reads.
 To run an analysis on a PR, call `run(pr)` with a dict representing the PR.
 This evaluates all of the analyzers and returns a set of facts that are true.
 
@@ -121,18 +126,56 @@ Facts are used by DiffBot to generate comments based on the context of the PR.
 #     }
 #   }
 # }
+import collections
 import datetime
+import typing
 
 
 analyzers = dict()
 
-
-def analyzer(func):
-    """Register a function as an analyzer.
-
-    Analyzer functions accept a PR dict and return True or False."""
-    analyzers[func.__name__] = func
-    return func
+# The features which `extract_features` can put in a feature record, and the
+# GraphQL fields of the pullRequest object each feature is computed from.
+# Fields of connection nodes are written as "<connection>.<field>", with nested
+# fields separated by dots.
+FEATURES = {
+    "title_lower": ("title",),
+    "body": ("body",),
+    "body_word_count": ("body",),
+    "created_at": ("createdAt",),
+    "additions": ("additions",),
+    "deletions": ("deletions",),
+    "changed_files": ("changedFiles",),
+    "participant_count": ("participants.login",),
+    "review_request_count": ("reviewRequests.requestedReviewer.__typename",),
+    "file_count": ("files.path",),
+    "change_type_counts": ("files.changeType",),
+    "vi_count": ("files.path",),
+    "python_file_count": ("files.path",),
+    "commit_count": ("commits.commit.committedDate",),
+    "commit_dates": ("commits.commit.committedDate",),
+    "last_commit_pst": ("commits.commit.committedDate",),
+    "last_commit_message": ("commits.commit.message",),
+    "last_commit_message_lower": ("commits.commit.message",),
+    "comment_count": ("comments.publishedAt",),
+    "comment_bodies_lower": ("comments.bodyText",),
+}
+
+
+def analyzer(*features: str):
+    """Register a function as an analyzer which reads the named features.
+
+    Analyzer functions accept a feature record (a dict of feature name to value)
+    containing only the features they declared, and return True or False.
+    The GraphQL fields an analyzer reads follow from its features, see `required_fields`."""
+    unknown = set(features) - FEATURES.keys()
+    if unknown:
+        raise ValueError(f"unknown features: {sorted(unknown)}")
+
+    def register(func):
+        func.features = features
+        analyzers[func.__name__] = func
+        return func
+    return register
 
 
 def _utc_timestamp_to_pst(timestamp: str) -> datetime.datetime:
@@ -142,274 +185,374 @@ def _utc_timestamp_to_pst(timestamp: str) -> datetime.datetime:
     This is OK since we are only interested in approximate the time of day
     and can ignore the time of day difference between PST and PDT.
     """
-    timestamp = timestamp.replace("Z", "+00:00")
-    utc = datetime.datetime.fromisoformat(timestamp)
-    pst = utc - datetime.timedelta(hours=7)
-    return pst
+    return _parse_timestamp(timestamp) - datetime.timedelta(hours=7)
+
+
+def _parse_timestamp(timestamp: str) -> datetime.datetime:
+    return datetime.datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+
+
+class FeatureBuilder:
+    """Accumulates a PR's feature record from its fields and connection nodes.
+
+    Nodes can be added a page at a time as they are fetched, so a PR with many
+    files, commits or comments never has to be held as one dict. Commits must
+    be added in chronological order. Each connection is only touched by its own
+    add method, so different connections may be added from different threads."""
+
+    def __init__(self):
+        self.pull_request = {}
+        self.change_type_counts = collections.Counter()
+        self.file_count = 0
+        self.vi_count = 0
+        self.python_file_count = 0
+        self.commit_count = 0
+        self.commit_dates = []
+        self.last_commit = None
+        self.comment_count = 0
+        self.comment_bodies_lower = []
+        self.participant_count = 0
+        self.review_request_count = 0
+
+    def set_fields(self, pull_request: dict):
+        """Set the scalar fields of the pullRequest object; connections are ignored."""
+        self.pull_request = pull_request
+
+    def add_files(self, files: typing.Iterable[dict]):
+        for file in files:
+            self.file_count += 1
+            if 'changeType' in file:
+                self.change_type_counts[file['changeType']] += 1
+            path = file.get('path', '')
+            if path.endswith('.vi'):
+                self.vi_count += 1
+            elif path.endswith('.py'):
+                self.python_file_count += 1
+
+    def add_commits(self, commits: typing.Iterable[dict]):
+        for commit in commits:
+            self.commit_count += 1
+            if 'committedDate' in commit:
+                self.commit_dates.append(_parse_timestamp(commit['committedDate']))
+            self.last_commit = commit
+
+    def add_comments(self, comments: typing.Iterable[dict]):
+        for comment in comments:
+            self.comment_count += 1
+            if 'bodyText' in comment:
+                self.comment_bodies_lower.append(comment['bodyText'].lower())
+
+    def add_participants(self, participants: typing.Iterable[dict]):
+        self.participant_count += sum(1 for _ in participants)
+
+    def add_review_requests(self, review_requests: typing.Iterable[dict]):
+        self.review_request_count += sum(1 for _ in review_requests)
+
+    def features(self, names: typing.Optional[typing.Iterable[str]] = None) -> dict:
+        """Build the feature record, or only the named features.
+
+        Only the fields the requested features are computed from need to have been fetched."""
+        pull_request = self.pull_request
+        last_commit = self.last_commit or {}
+        computed = {
+            "title_lower": lambda: pull_request['title'].lower(),
+            "body": lambda: pull_request['body'],
+            "body_word_count": lambda: len(pull_request['body'].split()),
+            "created_at": lambda: _parse_timestamp(pull_request['createdAt']),
+            "additions": lambda: pull_request['additions'],
+            "deletions": lambda: pull_request['deletions'],
+            "changed_files": lambda: pull_request['changedFiles'],
+            "participant_count": lambda: self.participant_count,
+            "review_request_count": lambda: self.review_request_count,
+            "file_count": lambda: self.file_count,
+            "change_type_counts": lambda: self.change_type_counts,
+            "vi_count": lambda: self.vi_count,
+            "python_file_count": lambda: self.python_file_count,
+            "commit_count": lambda: self.commit_count,
+            "commit_dates": lambda: self.commit_dates,
+            "last_commit_pst": lambda: (_utc_timestamp_to_pst(last_commit['committedDate'])
+                                        if last_commit else None),
+            "last_commit_message": lambda: last_commit.get('message', ''),
+            "last_commit_message_lower": lambda: last_commit.get('message', '').lower(),
+            "comment_count": lambda: self.comment_count,
+            "comment_bodies_lower": lambda: self.comment_bodies_lower,
+        }
+        if names is None:
+            names = FEATURES
+        return {name: computed[name]() for name in names}
+
+
+def extract_features(pr: dict) -> dict:
+    """Build the feature record for a PR in a single pass over the PR dict."""
+    pull_request = pr['data']['repository']['pullRequest']
+    builder = FeatureBuilder()
+    builder.set_fields(pull_request)
+    builder.add_files(pull_request['files']['nodes'])
+    builder.add_commits(edge['node']['commit'] for edge in pull_request['commits']['edges'])
+    builder.add_comments(pull_request['comments']['nodes'])
+    builder.add_participants(pull_request['participants']['nodes'])
+    builder.add_review_requests(pull_request['reviewRequests']['nodes'])
+    return builder.features()
 
 
 def run(pr: dict) -> set:
     """Run all analyzers on the PR, returning a set of facts that are true."""
+    return run_features(extract_features(pr))
+
+
+def run_features(features: dict, names: typing.Optional[typing.Iterable[str]] = None) -> set:
+    """Run all analyzers, or only the named ones, on a feature record, returning a set of facts that are true."""
     facts = set()
-    for name, analyzer in analyzers.items():
-        if analyzer(pr):
+    for name in analyzers if names is None else names:
+        analyzer = analyzers[name]
+        if analyzer({feature: features[feature] for feature in analyzer.features}):
             facts.add(name)
     return facts
 
 
-@analyzer
-def no_requested_reviewers(pr: dict):
+def required_features(names: typing.Optional[typing.Iterable[str]] = None) -> typing.Set[str]:
+    """The features read by all analyzers, or only the named ones."""
+    return {feature for name in (analyzers if names is None else names)
+            for feature in analyzers[name].features}
+
+
+def required_fields(names: typing.Optional[typing.Iterable[str]] = None) -> typing.Set[str]:
+    """The GraphQL fields read by all analyzers, or only the named ones, in the notation of FEATURES."""
+    return {field for feature in required_features(names) for field in FEATURES[feature]}
+
+
+@analyzer("review_request_count")
+def no_requested_reviewers(f: dict):
     """That's strange, you didn't ask anyone to inspect your work. You should ask someone to review it."""
-    return len(pr['data']['repository']['pullRequest']['reviewRequests']['nodes']) == 0
+    return f['review_request_count'] == 0
 
 
-@analyzer
-def more_than_three_reviewers(pr: dict):
+@analyzer("review_request_count")
+def more_than_three_reviewers(f: dict):
     """Oh wow, you asked so many people to review your work. Do you actually need this many people?"""
-    return len(pr['data']['repository']['pullRequest']['reviewRequests']['nodes']) > 3
+    return f['review_request_count'] > 3
 
 
-@analyzer
-def description_empty(pr: dict):
+@analyzer("body")
+def description_empty(f: dict):
     """I don't understand what this is all about. There is no description of the changes, and I cannot read your mind."""
-    return pr['data']['repository']['pullRequest']['body'] == ''
+    return f['body'] == ''
 
 
-@analyzer
-def description_tweetable(pr: dict):
+@analyzer("body")
+def description_tweetable(f: dict):
     """The summary is concise and short. Why use many words when fewer words do the trick?"""
-    return 1 < len(pr['data']['repository']['pullRequest']['body']) < 140
+    return 1 < len(f['body']) < 140
 
 
-@analyzer
-def description_over_150_words(pr: dict):
+@analyzer("body_word_count")
+def description_over_150_words(f: dict):
     """Oh wow, there are so many words in the description. Are you writing a book?"""
-    return len(pr['data']['repository']['pullRequest']['body'].split()) > 150
+    return f['body_word_count'] > 150
 
 
-@analyzer
-def last_commit_on_weekend_pst(pr: dict):
+@analyzer("last_commit_pst")
+def last_commit_on_weekend_pst(f: dict):
     """Why are you working on your day off? Shouldn't you be doing something more fun instead?"""
-    last_commit = pr['data']['repository']['pullRequest']['commits']['edges'][-1]['node']['commit']
-    commit_date = _utc_timestamp_to_pst(last_commit['committedDate'])
-    return commit_date.weekday() >= 5
+    commit_date = f['last_commit_pst']
+    return commit_date is not None and commit_date.weekday() >= 5
 
 
-@analyzer
-def last_commit_between_4am_and_7am_pst(pr: dict):
+@analyzer("last_commit_pst")
+def last_commit_between_4am_and_7am_pst(f: dict):
     """Wow do you always work so early in the morning? Some people are early birds but this is next level."""
-    last_commit = pr['data']['repository']['pullRequest']['commits']['edges'][-1]['node']['commit']
-    commit_date = _utc_timestamp_to_pst(last_commit['committedDate'])
-    return commit_date.hour >= 4 and commit_date.hour <= 7
+    commit_date = f['last_commit_pst']
+    return commit_date is not None and commit_date.hour >= 4 and commit_date.hour <= 7
 
 
-@analyzer
-def last_commit_between_8pm_and_3am_pst(pr: dict):
+@analyzer("last_commit_pst")
+def last_commit_between_8pm_and_3am_pst(f: dict):
     """Wow do you always work so late in the evening? Don't you have something better to do with your life?"""
-    last_commit = pr['data']['repository']['pullRequest']['commits']['edges'][-1]['node']['commit']
-    commit_date = _utc_timestamp_to_pst(last_commit['committedDate'])
-    return commit_date.hour >= 20 or commit_date.hour <= 3
+    commit_date = f['last_commit_pst']
+    return commit_date is not None and (commit_date.hour >= 20 or commit_date.hour <= 3)
 
 
-@analyzer
-def last_commit_on_halloween_pst(pr: dict):
+@analyzer("last_commit_pst")
+def last_commit_on_halloween_pst(f: dict):
     """Trick or treat! I think the changes you made are very spooky."""
-    last_commit = pr['data']['repository']['pullRequest']['commits']['edges'][-1]['node']['commit']
-    commit_date = _utc_timestamp_to_pst(last_commit['committedDate'])
-    return commit_date.month == 10 and commit_date.day == 31
+    commit_date = f['last_commit_pst']
+    return commit_date is not None and commit_date.month == 10 and commit_date.day == 31
 
 
-@analyzer
-def last_commit_on_new_years_day_pst(pr: dict):
+@analyzer("last_commit_pst")
+def last_commit_on_new_years_day_pst(f: dict):
     """Why are you working on New Year's day? Don't you know that today is a holiday? There must be something wrong with you."""
-    last_commit = pr['data']['repository']['pullRequest']['commits']['edges'][-1]['node']['commit']
-    commit_date = _utc_timestamp_to_pst(last_commit['committedDate'])
-    return commit_date.month == 1 and commit_date.day == 1
+    commit_date = f['last_commit_pst']
+    return commit_date is not None and commit_date.month == 1 and commit_date.day == 1
 
 
-@analyzer
-def last_commit_on_christmas_pst(pr: dict):
+@analyzer("last_commit_pst")
+def last_commit_on_christmas_pst(f: dict):
     """Why are you working on Christmas day? Don't you know that today is a holiday? There must be something wrong with you."""
-    last_commit = pr['data']['repository']['pullRequest']['commits']['edges'][-1]['node']['commit']
-    commit_date = _utc_timestamp_to_pst(last_commit['committedDate'])
-    return commit_date.month == 12 and commit_date.day == 25
+    commit_date = f['last_commit_pst']
+    return commit_date is not None and commit_date.month == 12 and commit_date.day == 25
 
 
-@analyzer
-def last_commit_on_april_fools_pst(pr: dict):
+@analyzer("last_commit_pst")
+def last_commit_on_april_fools_pst(f: dict):
     """I approve of these changes. Just kidding! April fools! Actually, this sucks."""
-    last_commit = pr['data']['repository']['pullRequest']['commits']['edges'][-1]['node']['commit']
-    commit_date = _utc_timestamp_to_pst(last_commit['committedDate'])
-    return commit_date.month == 4 and commit_date.day == 1
+    commit_date = f['last_commit_pst']
+    return commit_date is not None and commit_date.month == 4 and commit_date.day == 1
 
 
-@analyzer
-def last_commit_friday_afternoon_pst(pr: dict):
+@analyzer("last_commit_pst")
+def last_commit_friday_afternoon_pst(f: dict):
     """You're very productive even though it is friday afternoon. Enjoy your weekend!"""
-    last_commit = pr['data']['repository']['pullRequest']['commits']['edges'][-1]['node']['commit']
-    commit_date = _utc_timestamp_to_pst(last_commit['committedDate'])
-    return commit_date.weekday() == 4 and 15 <= commit_date.hour <= 18
+    commit_date = f['last_commit_pst']
+    return commit_date is not None and commit_date.weekday() == 4 and 15 <= commit_date.hour <= 18
 
 
-@analyzer
-def at_least_3_participants(pr: dict):
+@analyzer("participant_count")
+def at_least_3_participants(f: dict):
     """Oh wow! So many people are here! Hi everyone!"""
-    return len(pr['data']['repository']['pullRequest']['participants']['nodes']) >= 3
+    return f['participant_count'] >= 3
 
 
-@analyzer
-def less_than_2_participants(pr: dict):
+@analyzer("participant_count")
+def less_than_2_participants(f: dict):
     """Where is everyone? It's pretty lonely in here, don't you think?"""
-    return len(pr['data']['repository']['pullRequest']['participants']['nodes']) < 2
+    return f['participant_count'] < 2
 
 
-@analyzer
-def at_least_one_file_renamed(pr: dict):
+@analyzer("change_type_counts")
+def at_least_one_file_renamed(f: dict):
     """You renamed a file. Congratulations! You are a master of the art of renaming. You must be so smart."""
-    files = pr['data']['repository']['pullRequest']['files']['nodes']
-    return len([f for f in files if f['changeType'] == 'RENAMED']) >= 1
+    return f['change_type_counts']['RENAMED'] >= 1
 
 
-@analyzer
-def only_deletions(pr: dict):
+@analyzer("additions", "deletions")
+def only_deletions(f: dict):
     """Getting rid of things feels so satisfying, wouldn't you agree?"""
-    return pr['data']['repository']['pullRequest']['additions'] == 0 and pr['data']['repository']['pullRequest']['deletions'] > 0
+    return f['additions'] == 0 and f['deletions'] > 0
 
 
-@analyzer
-def more_than_1000_net_additions(pr: dict):
+@analyzer("additions", "deletions")
+def more_than_1000_net_additions(f: dict):
     """Holy fucking shit that's a lot of additions. I'm impressed and horrified at the same time. Ever heard of smaller pull requests?"""
-    return pr['data']['repository']['pullRequest']['additions'] - pr['data']['repository']['pullRequest']['deletions'] > 1000
+    return f['additions'] - f['deletions'] > 1000
 
 
-@analyzer
-def more_than_1000_net_deletions(pr: dict):
+@analyzer("additions", "deletions")
+def more_than_1000_net_deletions(f: dict):
     """Sometimes you add code, sometimes you delete code. Today is a delete day it seems. Nice job."""
-    return pr['data']['repository']['pullRequest']['deletions'] - pr['data']['repository']['pullRequest']['additions'] > 1000
+    return f['deletions'] - f['additions'] > 1000
 
 
-@analyzer
-def more_than_10_files_deleted(pr: dict):
+@analyzer("change_type_counts")
+def more_than_10_files_deleted(f: dict):
     """"Whoa, you deleted so many files! This is so great! Very impressive."""
-    files = pr['data']['repository']['pullRequest']['files']['nodes']
-    return len([f for f in files if f['changeType'] == 'DELETED']) > 10
+    return f['change_type_counts']['DELETED'] > 10
 
 
-@analyzer
-def more_than_10_files_added(pr: dict):
+@analyzer("change_type_counts")
+def more_than_10_files_added(f: dict):
     """Oh my goodness, you added so many new files! I can't wait to see what you do with them."""
-    files = pr['data']['repository']['pullRequest']['files']['nodes']
-    return len([f for f in files if f['changeType'] == 'ADDED']) > 10
+    return f['change_type_counts']['ADDED'] > 10
 
 
-@analyzer
-def more_than_10_comments(pr: dict):
+@analyzer("comment_count")
+def more_than_10_comments(f: dict):
     """Oh my goodness, so many people have added comments. May I join this discussion too?"""
-    return len(pr['data']['repository']['pullRequest']['comments']['nodes']) > 10
+    return f['comment_count'] > 10
 
 
-@analyzer
-def no_changes_to_files(pr: dict):
+@analyzer("changed_files")
+def no_changes_to_files(f: dict):
     """Umm... no changes to files? I don't think that's a good idea. I'm not sure why you made this pull request. Are you stupid?"""
-    return pr['data']['repository']['pullRequest']['changedFiles'] == 0
+    return f['changed_files'] == 0
 
 
-@analyzer
-def at_least_one_labview_vi(pr: dict):
+@analyzer("vi_count")
+def at_least_one_labview_vi(f: dict):
     """Another day, another VI changed."""
-    return any(file['path'].endswith('.vi') for file in pr['data']['repository']['pullRequest']['files']['nodes'])
+    return f['vi_count'] >= 1
 
 
-@analyzer
-def only_python_changes(pr: dict):
+@analyzer("python_file_count", "file_count")
+def only_python_changes(f: dict):
     """You only changed Python files? Thank you! You've saved me from a great deal of work."""
-    return all(file['path'].endswith('.py') for file in pr['data']['repository']['pullRequest']['files']['nodes'])
+    return f['python_file_count'] == f['file_count']
 
 
-@analyzer
-def created_more_than_two_weeks_ago(pr: dict):
+@analyzer("created_at")
+def created_more_than_two_weeks_ago(f: dict):
     """Wow, you created this pull request more than two weeks ago. It's practically an antique now."""
-    timestamp = pr['data']['repository']['pullRequest']['createdAt']
-    timestamp = timestamp.replace("Z", "+00:00")
-    created_at = datetime.datetime.fromisoformat(timestamp)
-    return (datetime.datetime.now(datetime.timezone.utc) - created_at).days > 14
+    return (datetime.datetime.now(datetime.timezone.utc) - f['created_at']).days > 14
 
 
-@analyzer
-def many_changed_labview_vi(pr: dict):
+@analyzer("vi_count")
+def many_changed_labview_vi(f: dict):
     """Holy shit there are a lot of VIs changed. What the heck are you doing?"""
-    return len(list(filter(lambda file: file['path'].endswith('.vi'), pr['data']['repository']['pullRequest']['files']['nodes']))) > 10
+    return f['vi_count'] > 10
 
 
-@analyzer
-def many_changed_files(pr: dict):
+@analyzer("changed_files")
+def many_changed_files(f: dict):
     """Wow that's a lot of files changed. You are either a genius or a very bad person."""
-    return pr['data']['repository']['pullRequest']['changedFiles'] > 10
+    return f['changed_files'] > 10
 
 
-@analyzer
-def last_commit_message_contains_fix(pr: dict):
+@analyzer("last_commit_message_lower")
+def last_commit_message_contains_fix(f: dict):
     """Thank you for fixing that! You are a master of the art of fixing."""
-    last_commit = pr['data']['repository']['pullRequest']['commits']['edges'][-1]['node']['commit']
-    return 'fix' in last_commit['message'].lower()
+    return 'fix' in f['last_commit_message_lower']
 
 
-@analyzer
-def last_commit_message_contains_bug(pr: dict):
+@analyzer("last_commit_message_lower")
+def last_commit_message_contains_bug(f: dict):
     """That bug was really starting to annoy me. I hope you fixed it."""
-    last_commit = pr['data']['repository']['pullRequest']['commits']['edges'][-1]['node']['commit']
-    return 'bug' in last_commit['message'].lower()
+    return 'bug' in f['last_commit_message_lower']
 
 
-@analyzer
-def last_commit_message_contains_rebase(pr: dict):
+@analyzer("last_commit_message_lower")
+def last_commit_message_contains_rebase(f: dict):
     """Wow you seem pretty good at using git, although, I'm still better than you."""
-    last_commit = pr['data']['repository']['pullRequest']['commits']['edges'][-1]['node']['commit']
-    return 'rebase' in last_commit['message'].lower()
+    return 'rebase' in f['last_commit_message_lower']
 
 
-@analyzer
-def last_commit_message_contains_add(pr: dict):
+@analyzer("last_commit_message")
+def last_commit_message_contains_add(f: dict):
     """Thanks for adding that. I hope it will be end up being useful."""
-    last_commit = pr['data']['repository']['pullRequest']['commits']['edges'][-1]['node']['commit']
-    return 'add' in last_commit['message']
+    return 'add' in f['last_commit_message']
 
 
-@analyzer
-def title_contains_wip(pr: dict):
+@analyzer("title_lower")
+def title_contains_wip(f: dict):
     """Not done yet, eh? Hope you whip this into shape soon. We're all counting on you."""
-    return 'wip' in pr['data']['repository']['pullRequest']['title'].lower()
+    return 'wip' in f['title_lower']
 
 
-@analyzer
-def title_contains_fix(pr: dict):
+@analyzer("title_lower")
+def title_contains_fix(f: dict):
     """It is great to finally have this issue fixed. This is great work."""
-    return 'fix' in pr['data']['repository']['pullRequest']['title'].lower()
+    return 'fix' in f['title_lower']
 
 
-@analyzer
-def title_contains_add(pr: dict):
+@analyzer("title_lower")
+def title_contains_add(f: dict):
     """I like this as much as a person can like something. Thank you."""
-    return 'add' in pr['data']['repository']['pullRequest']['title'].lower()
+    return 'add' in f['title_lower']
 
 
-@analyzer
-def more_than_10_commits(pr: dict):
+@analyzer("commit_count")
+def more_than_10_commits(f: dict):
     """Jeez, you've sure done a lot of work on this. I'm impressed."""
-    return len(pr['data']['repository']['pullRequest']['commits']['edges']) > 10
+    return f['commit_count'] > 10
 
 
-@analyzer
-def more_than_3_commits_in_last_hour(pr: dict):
+@analyzer("commit_dates")
+def more_than_3_commits_in_last_hour(f: dict):
     """Whoa, slow down! You're pushing commits faster than a cheetah can run."""
-    commits = pr['data']['repository']['pullRequest']['commits']['edges']
-    commit_date = [datetime.datetime.fromisoformat(
-        c['node']['commit']['committedDate'].replace("Z", "+00:00")) for c in commits]
-    now = datetime.datetime.now(datetime.timezone.utc)
-    return len([t for t in commit_date if t > now - datetime.timedelta(hours=1)]) > 3
+    an_hour_ago = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=1)
+    return len([t for t in f['commit_dates'] if t > an_hour_ago]) > 3
 
 
-@analyzer
-def comment_contains_lgtm(pr: dict):
+@analyzer("comment_bodies_lower")
+def comment_contains_lgtm(f: dict):
     """This looks good to me as well, not that anyone asked for my opinion."""
-    return any('lgtm' in comment['bodyText'].lower() for comment in pr['data']['repository']['pullRequest']['comments']['nodes'])
+    return any('lgtm' in body for body in f['comment_bodies_lower'])
@@ -0,0 +1,501 @@
+"""Module benchmark measures the DiffBot pipeline against local stand-ins for git, g-cli and GitHub.
+
+    python benchmark.py --vis 100 --gcli-latency 0.05 --output results.json
+    python benchmark.py --vis 100 --gcli-latency 0.05 --compare results.json
+
+Each run builds a synthetic git repository with a branch that adds and
+modifies VIs. It puts a stub `g-cli` on the PATH that sleeps for a
+configurable latency and writes a small PNG for every VI. It also serves a
+fake GitHub REST and GraphQL API on localhost. None of LabVIEW, g-cli or
+GitHub is needed, so the numbers only measure the Python side: `diff_repo`,
+the upload loop, the PR query and `analysis.run`, and all of them end to end.
+
+Every stage is run `--repeat` times. The results are written as JSON with the
+parameters and environment they were measured with. `--compare` prints the
+change from a previous results file and exits with status 1 if any stage got
+slower by more than `--threshold`, so regressions show up in review.
+
+The stub g-cli is a Python script, run through its shebang on Linux and macOS
+and through a g-cli.cmd wrapper on Windows.
+"""
+import argparse
+import contextlib
+import datetime
+import http.server
+import inspect
+import io
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import typing
+import zlib
+from os import path
+
+import analysis
+import diffbot
+import diffvi
+
+STUB_GCLI = '''#!{python}
+"""Stand-in for g-cli: sleeps for $GCLI_LATENCY seconds per VI and writes a PNG for each.
+
+VIs whose name contains $GCLI_HANG never finish, and those whose name contains
+$GCLI_FAIL fail. A batch stops at the first VI whose name contains $GCLI_CRASH,
+leaving a results file cut off partway, or none if no VI was diffed yet. Each
+call is appended to the $GCLI_LOG file, if it is set."""
+import json, os, random, struct, sys, time, zlib
+
+{write_png}
+
+
+def matches(setting, vi):
+    return bool(os.environ.get(setting)) and os.environ[setting] in os.path.basename(vi)
+
+
+def log(vis):
+    if os.environ.get("GCLI_LOG"):
+        lv_exe = args[args.index("--lv-exe") + 1] if "--lv-exe" in args else None
+        with open(os.environ["GCLI_LOG"], "a") as f:
+            f.write(json.dumps({{"pid": os.getpid(), "lv_exe": lv_exe, "vis": vis}}) + "\\n")
+
+
+args = sys.argv
+latency = float(os.environ.get("GCLI_LATENCY", "0"))
+if "-Manifest" in args:
+    with open(args[args.index("-Manifest") + 1]) as f:
+        diffs = json.load(f)["diffs"]
+    log([diff["new_vi"] for diff in diffs])
+    results = []
+    for diff in diffs:
+        if matches("GCLI_CRASH", diff["new_vi"]):
+            if results:
+                with open(args[args.index("-Results") + 1], "w") as f:
+                    f.write(json.dumps({{"results": results}})[:-10])
+            sys.exit(1)
+        if matches("GCLI_FAIL", diff["new_vi"]):
+            results.append({{"new_vi": diff["new_vi"], "ok": False, "error": "stub failure"}})
+            continue
+        time.sleep(latency)
+        write_png(os.path.join(diff["output_dir"], os.path.basename(diff["new_vi"]) + ".png"), diff["new_vi"])
+        results.append({{"new_vi": diff["new_vi"], "ok": True, "error": ""}})
+    with open(args[args.index("-Results") + 1], "w") as f:
+        json.dump({{"results": results}}, f)
+else:
+    new_vi = args[args.index("-NewVI") + 1]
+    log([new_vi])
+    if matches("GCLI_HANG", new_vi):
+        time.sleep(3600)
+    if matches("GCLI_FAIL", new_vi):
+        sys.exit(1)
+    time.sleep(latency)
+    write_png(os.path.join(args[args.index("-OutputDir") + 1], os.path.basename(new_vi) + ".png"), new_vi)
+'''
+
+
+def write_png(filename: str, seed: str, size: int = 256):
+    """Write a noisy grayscale PNG, different for every seed, like a small diff screenshot."""
+    rng = random.Random(seed)
+    rows = b"".join(b"\0" + rng.randbytes(size) for _ in range(size))
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    with open(filename, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", size, size, 8, 0, 0, 0, 0)))
+        f.write(chunk(b"IDAT", zlib.compress(rows)))
+        f.write(chunk(b"IEND", b""))
+
+
+def _git(repo: str, *args: str):
+    subprocess.check_call(["git", "-c", "user.name=benchmark", "-c", "user.email=benchmark@localhost", *args],
+                          cwd=repo, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def make_repo(repo: str, vis: int, vi_size: int = 16384, seed: int = 0):
+    """Create a git repository whose `feature` branch modifies 3/4 of `vis` VIs and adds the rest, compared to `main`."""
+    rng = random.Random(seed)
+    os.makedirs(repo)
+    _git(repo, "init", "-q")
+    _git(repo, "checkout", "-q", "-b", "main")
+    modified = vis * 3 // 4
+    for i in range(modified):
+        module = path.join(repo, f"Module{i % 10}")
+        os.makedirs(module, exist_ok=True)
+        with open(path.join(module, f"VI {i}.vi"), "wb") as f:
+            f.write(rng.randbytes(vi_size))
+    _git(repo, "add", ".")
+    _git(repo, "commit", "-q", "-m", "main")
+
+    _git(repo, "checkout", "-q", "-b", "feature")
+    for i in range(vis):
+        module = path.join(repo, f"Module{i % 10}")
+        os.makedirs(module, exist_ok=True)
+        with open(path.join(module, f"VI {i}.vi"), "ab" if i < modified else "wb") as f:
+            f.write(rng.randbytes(vi_size // 8 if i < modified else vi_size))
+    _git(repo, "add", ".")
+    _git(repo, "commit", "-q", "-m", "feature")
+
+
+def install_stub_gcli(bin_dir: str, latency: float):
+    """Put a stub g-cli with the given latency first on the PATH."""
+    os.makedirs(bin_dir, exist_ok=True)
+    if sys.platform == "win32":
+        # Windows can't run a script by its shebang; a .cmd wrapper runs it with this Python instead.
+        stub = path.join(bin_dir, "g-cli.py")
+        with open(path.join(bin_dir, "g-cli.cmd"), "w") as f:
+            f.write('@"{0}" "%~dp0g-cli.py" %*\n'.format(sys.executable))
+    else:
+        stub = path.join(bin_dir, "g-cli")
+    with open(stub, "w") as f:
+        f.write(STUB_GCLI.format(python=sys.executable, write_png=inspect.getsource(write_png)))
+    os.chmod(stub, 0o755)
+    os.environ["PATH"] = bin_dir + os.pathsep + os.environ["PATH"]
+    os.environ["GCLI_LATENCY"] = str(latency)
+    os.environ.setdefault("labviewPath_2020", "LabVIEW.exe")
+
+
+def synthetic_pr(files: int, commits: int, comments: int, seed: int = 0) -> dict:
+    """Build the GraphQL pullRequest response for a PR, in the shape analysis.run expects (commits as edges)."""
+    rng = random.Random(seed)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    words = ["fix", "bug", "add", "Add", "rebase", "wip", "lgtm", "LGTM", "refactor", "typo"]
+
+    def timestamp() -> str:
+        return (now - datetime.timedelta(minutes=rng.randint(0, 60 * 24 * 60))).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    def text(length: int) -> str:
+        return " ".join(rng.choice(words) for _ in range(length))
+
+    return {"data": {"repository": {"pullRequest": {
+        "title": text(4), "author": {"login": "author"}, "createdAt": timestamp(), "updatedAt": timestamp(),
+        "closedAt": None, "mergedAt": None, "url": "https://github.com/owner/repo/pull/1",
+        "additions": rng.randint(0, 3000), "body": text(rng.randint(0, 200)), "number": 1,
+        "changedFiles": files, "deletions": rng.randint(0, 3000),
+        "participants": {"nodes": [{"login": f"user{i}"} for i in range(rng.randint(1, 5))]},
+        "files": {"nodes": [{"changeType": rng.choice(["ADDED", "MODIFIED", "DELETED", "RENAMED"]),
+                             "additions": rng.randint(0, 100), "deletions": rng.randint(0, 100),
+                             "path": f"Module{i % 10}/File {i}{rng.choice(['.vi', '.ctl', '.lvclass'])}"}
+                            for i in range(files)]},
+        "commits": {"edges": [{"node": {"commit": {"message": text(5), "changedFiles": rng.randint(1, 20),
+                                                   "committedDate": timestamp()}}} for _ in range(commits)]},
+        "comments": {"nodes": [{"bodyText": text(20), "author": {"login": "reviewer"}, "publishedAt": timestamp()}
+                               for _ in range(comments)]},
+        "reviewRequests": {"nodes": [{"requestedReviewer": {"login": "reviewer"}}]},
+    }}}}
+
+
+class FakeGitHub(http.server.ThreadingHTTPServer):
+    """Local stand-in for the parts of the GitHub REST and GraphQL APIs diffbot uses.
+
+    Every request waits `latency` seconds before it is answered, like a round trip to GitHub.
+    The (method, path) of every request is kept in `calls`. While `reject_ref_updates`
+    is positive, each ref update is refused with 422 as if someone else had pushed
+    to the branch first, and the head moves to a new commit. Requests are answered
+    from `failures`, (status, headers, message) tuples such as rate limit replies,
+    until it is empty."""
+
+    def __init__(self, pr: dict, latency: float = 0.0):
+        super().__init__(("127.0.0.1", 0), FakeGitHubHandler)
+        self.pr = pr["data"]["repository"]["pullRequest"]
+        self.latency = latency
+        self.requests = 0
+        self.calls = []
+        self.reject_ref_updates = 0
+        self.failures = []
+        self.lock = threading.Lock()
+        self.contents = {}
+        self.objects = {"commit0": {"sha": "commit0", "tree": {"sha": "tree0"}}}
+        self.head = "commit0"
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self) -> str:
+        return "http://%s:%d" % self.server_address
+
+    def new_sha(self, value: dict) -> str:
+        with self.lock:
+            sha = "%040x" % len(self.objects)
+            self.objects[sha] = dict(value, sha=sha)
+        return sha
+
+    def connection_nodes(self, connection: str) -> list:
+        if connection == "commits":
+            return [edge["node"] for edge in self.pr["commits"]["edges"]]
+        return self.pr[connection]["nodes"]
+
+
+class FakeGitHubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: FakeGitHub
+
+    def log_message(self, *args):
+        pass
+
+    def _body(self) -> dict:
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _reply(self, status: int, value, headers: typing.Optional[dict] = None):
+        with self.server.lock:
+            self.server.requests += 1
+            self.server.calls.append((self.command, self.path))
+        time.sleep(self.server.latency)
+        body = json.dumps(value).encode()
+        self.send_response(status)
+        for name, header in (headers or {}).items():
+            self.send_header(name, header)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _fail(self) -> bool:
+        """Answer with the next of the server's failures, if there are any left."""
+        with self.server.lock:
+            if not self.server.failures:
+                return False
+            status, headers, message = self.server.failures.pop(0)
+        self._body()
+        self._reply(status, {"message": message}, headers)
+        return True
+
+    def do_GET(self):
+        if self._fail():
+            return
+        if "/git/ref/heads/" in self.path:
+            return self._reply(200, {"object": {"sha": self.server.head}})
+        if "/git/commits/" in self.path:
+            return self._reply(200, self.server.objects[self.path.rsplit("/", 1)[1]])
+        if "/contents/" in self.path and self.path in self.server.contents:
+            return self._reply(200, self.server.contents[self.path])
+        self._reply(404, {"message": "Not Found"})
+
+    def do_PUT(self):
+        if self._fail():
+            return
+        body = self._body()
+        content = {"content": body["content"], "sha": self.server.new_sha({}),
+                   "download_url": self.server.url + self.path}
+        self.server.contents[self.path] = content
+        self._reply(201, {"content": content})
+
+    def do_PATCH(self):
+        if self._fail():
+            return
+        body = self._body()
+        if self.server.reject_ref_updates > 0:
+            self.server.reject_ref_updates -= 1
+            self.server.head = self.server.new_sha({"tree": {"sha": "tree-pushed"}, "parents": [self.server.head]})
+            return self._reply(422, {"message": "Update is not a fast forward"})
+        self.server.head = body["sha"]
+        self._publish(self.path.split("/git/")[0])
+        self._reply(200, {"object": {"sha": self.server.head}})
+
+    def do_POST(self):
+        if self._fail():
+            return
+        body = self._body()
+        if self.path == "/graphql":
+            return self._reply(200, self._graphql(body["query"], body["variables"]))
+        if self.path.endswith("/comments"):
+            return self._reply(201, {"body": body["body"]})
+        kind = self.path.rsplit("/", 1)[1]
+        if kind == "commits":
+            body = {"tree": {"sha": body["tree"]}, "parents": body["parents"]}
+        self._reply(201, {"sha": self.server.new_sha(body)})
+
+    def _publish(self, repo_path: str):
+        """Serve the files added by the new head commit from the contents API, as GitHub would."""
+        commit = self.server.objects[self.server.head]
+        for entry in self.server.objects.get(commit["tree"]["sha"], {}).get("tree", []):
+            self.server.contents[f"{repo_path}/contents/{entry['path']}"] = {
+                "content": self.server.objects[entry["sha"]]["content"], "sha": entry["sha"],
+                "download_url": f"{self.server.url}{repo_path}/contents/{entry['path']}"}
+
+    def _graphql(self, query: str, variables: dict) -> dict:
+        pull_request = {}
+        for connection, first in re.findall(r"(\w+)\(first: (\d+)", query):
+            nodes = self.server.connection_nodes(connection)
+            start = int(variables.get("cursor") or 0)
+            end = start + int(first)
+            pull_request[connection] = {"pageInfo": {"hasNextPage": end < len(nodes), "endCursor": str(end)},
+                                        "nodes": nodes[start:end]}
+        for field, value in self.server.pr.items():
+            if field not in pull_request and field not in diffbot.PR_CONNECTIONS and \
+                    re.search(r"^\s*%s\b" % field, query, re.MULTILINE):
+                pull_request[field] = value
+        return {"data": {"repository": {"pullRequest": pull_request}}}
+
+
+def measure(function: typing.Callable[[], int], repeat: int, quiet: bool = True) -> dict:
+    """Run a stage repeat times; the stage returns the number of items it processed."""
+    runs = []
+    items = 0
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()) if quiet else contextlib.nullcontext():
+            start = time.perf_counter()
+            items = function()
+            runs.append(time.perf_counter() - start)
+    median = statistics.median(runs)
+    return {
+        "runs": runs,
+        "median_seconds": median,
+        "min_seconds": min(runs),
+        "items": items,
+        "items_per_second": items / median if median else None,
+    }
+
+
+def bench_diff_repo(repo: str, output_dir: str, jobs: int, batch: bool) -> int:
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.makedirs(output_dir)
+    # The stub g-cli doesn't load the operations, but --batch checks that they exist.
+    os.makedirs(path.join(repo, "ops"), exist_ok=True)
+    open(path.join(repo, "ops", "DiffVIBatch.vi"), "a").close()
+    cwd = os.getcwd()
+    os.chdir(repo)
+    try:
+        diffvi.diff_repo("2020", "ops", output_dir, "main", None, jobs, batch=batch)
+    finally:
+        os.chdir(cwd)
+    return len([name for name in os.listdir(output_dir) if name.endswith(".png")])
+
+
+def bench_upload(pngfiles: typing.Dict[str, str], mode: str, jobs: int, run: typing.List[int]) -> int:
+    # A new PR number each run, so nothing is reused from the previous run's manifest.
+    run[0] += 1
+    diffbot.upload_pngs("token", pngfiles, "owner", "repo", run[0], mode, jobs)
+    return len(pngfiles)
+
+
+def bench_query_pr() -> int:
+    features = diffbot.fetch_pr_features("token", "owner/repo", 1)
+    return len(features)
+
+
+def bench_analysis(pr: dict, iterations: int) -> int:
+    for _ in range(iterations):
+        analysis.run(pr)
+    return iterations
+
+
+def bench_end_to_end(repo: str, output_dir: str, jobs: int, mode: str, run: typing.List[int]) -> int:
+    images = bench_diff_repo(repo, output_dir, jobs, False)
+    pngfiles = {name: path.join(output_dir, name) for name in sorted(os.listdir(output_dir))}
+    run[0] += 1
+    pngurls = diffbot.upload_pngs("token", pngfiles, "owner", "repo", run[0], mode, jobs)
+    facts = analysis.run_features(diffbot.fetch_pr_features("token", "owner/repo", 1))
+    with open(path.join(path.dirname(path.abspath(__file__)), "quips.json"), "r") as f:
+        quips = json.load(f)
+    comment = diffbot.generate_comment("Shakespeare", facts, quips,
+                                       [("M", path.splitext(name)[0], url) for name, url in pngurls.items()], "")
+    diffbot.post_comment("token", "owner/repo", 1, comment)
+    return images
+
+
+def run_benchmarks(args) -> dict:
+    pr = synthetic_pr(args.pr_files, args.pr_commits, args.pr_comments, args.seed)
+    server = FakeGitHub(pr, args.api_latency)
+    diffbot.API_URL = server.url
+    stages = {}
+    upload_run = [0]
+    with tempfile.TemporaryDirectory() as work_dir:
+        repo = path.join(work_dir, "repo")
+        output_dir = path.join(work_dir, "diff")
+        make_repo(repo, args.vis, args.vi_size, args.seed)
+
+        install_stub_gcli(path.join(work_dir, "bin"), args.gcli_latency)
+        stages["diff_repo"] = measure(lambda: bench_diff_repo(repo, output_dir, args.jobs, False), args.repeat)
+        stages["diff_repo_batch"] = measure(lambda: bench_diff_repo(repo, output_dir, 1, True), args.repeat)
+        with contextlib.redirect_stdout(io.StringIO()):
+            bench_diff_repo(repo, output_dir, args.jobs, False)
+
+        pngfiles = {name: path.join(output_dir, name) for name in sorted(os.listdir(output_dir))
+                    if name.endswith(".png")}
+        for mode in ("commit", "contents"):
+            stages["upload_" + mode] = measure(
+                lambda: bench_upload(pngfiles, mode, args.upload_jobs, upload_run), args.repeat)
+        stages["query_pr"] = measure(bench_query_pr, args.repeat)
+        stages["analysis"] = measure(lambda: bench_analysis(pr, args.analysis_iterations), args.repeat)
+        stages["end_to_end"] = measure(
+            lambda: bench_end_to_end(repo, output_dir, args.jobs, "commit", upload_run), args.repeat)
+    server.shutdown()
+
+    return {
+        "parameters": {name: value for name, value in vars(args).items() if name not in ("output", "compare")},
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpus": os.cpu_count(),
+            "commit": subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                     cwd=path.dirname(path.abspath(__file__))).stdout.strip(),
+            "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        },
+        "stages": stages,
+    }
+
+
+def compare(baseline: dict, results: dict, threshold: float) -> typing.List[str]:
+    """Print the change in median time of each stage, returning the stages which got slower than the threshold."""
+    if baseline["parameters"] != results["parameters"]:
+        print("Warning: the baseline was measured with different parameters")
+    regressions = []
+    print(f"{'stage':<20}{'baseline':>12}{'now':>12}{'change':>10}")
+    for stage, result in results["stages"].items():
+        if stage not in baseline["stages"]:
+            print(f"{stage:<20}{'-':>12}{result['median_seconds']:>11.3f}s{'new':>10}")
+            continue
+        before = baseline["stages"][stage]["median_seconds"]
+        after = result["median_seconds"]
+        change = (after - before) / before if before else 0.0
+        print(f"{stage:<20}{before:>11.3f}s{after:>11.3f}s{change:>+10.1%}")
+        if change > threshold:
+            regressions.append(stage)
+    return regressions
+
+
+parser = argparse.ArgumentParser(description="Benchmark the DiffBot pipeline against local stand-ins")
+parser.add_argument("--vis", type=int, default=50, help="Number of changed VIs in the synthetic repository (default: 50)")
+parser.add_argument("--vi-size", type=int, default=16384, help="Size of each synthetic VI in bytes (default: 16384)")
+parser.add_argument("--gcli-latency", type=float, default=0.02, help="Seconds the stub g-cli takes per VI (default: 0.02)")
+parser.add_argument("--api-latency", type=float, default=0.005,
+                    help="Seconds the fake GitHub API takes per request (default: 0.005)")
+parser.add_argument("--jobs", type=int, default=4, help="diff_repo jobs (default: 4)")
+parser.add_argument("--upload-jobs", type=int, default=4, help="Concurrent uploads (default: 4)")
+parser.add_argument("--pr-files", type=int, default=300, help="Files in the synthetic PR (default: 300)")
+parser.add_argument("--pr-commits", type=int, default=150, help="Commits in the synthetic PR (default: 150)")
+parser.add_argument("--pr-comments", type=int, default=50, help="Comments on the synthetic PR (default: 50)")
+parser.add_argument("--analysis-iterations", type=int, default=100,
+                    help="Times analysis.run is called per analysis run (default: 100)")
+parser.add_argument("--repeat", type=int, default=3, help="Runs of each stage; the median is reported (default: 3)")
+parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic repository and PR (default: 0)")
+parser.add_argument("--output", help="Write the results to this JSON file")
+parser.add_argument("--compare", help="Compare against a previous results file")
+parser.add_argument("--threshold", type=float, default=0.1,
+                    help="With --compare, fail if a stage's median is this much slower (default: 0.1)")
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    results = run_benchmarks(args)
+    for stage, result in results["stages"].items():
+        print(f"{stage}: median {result['median_seconds']:.3f}s, {result['items']} items, "
+              f"{result['items_per_second'] or 0:.1f} items/s")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare, "r") as f:
+            regressions = compare(json.load(f), results, args.threshold)
+        if regressions:
+            print("Slower than the baseline: " + ", ".join(regressions))
+            sys.exit(1)
@@ -0,0 +1,211 @@
+"""Module changeset classifies the files changed on a branch, for diffvi and diffbot.
+
+`get_changed_files` lists the added and modified files compared to a target ref.
+Renamed and copied files are detected too, with `git diff -M -C`, and are
+reported with status "R" or "C". `get_changes` also gives the path each was
+renamed or copied from, so that they can be diffed against their source
+rather than rendered as new files, and whether their content is unchanged.
+Paths are read NUL-separated (`-z`), so names with spaces, quotes or non-ASCII
+characters aren't mangled. `IgnoreRules` filters them against a .VIignore file, and `ChangeIndex` looks up
+the change status of a diff image by name.
+
+Ignore files contain one pattern per line. Blank lines and lines starting with
+`#` are skipped. A pattern without glob characters excludes every path that
+contains it, which is how .VIignore files have always worked. Patterns with
+glob characters follow .gitignore rules:
+
+* `*` and `?` match within one path component, and `**` matches across them.
+* A pattern containing `/` is matched against the whole path; if it ends with
+  `/` it excludes everything in that directory.
+* Any other pattern is matched against the file name alone.
+
+All patterns are compiled once, rather than per file. Literal patterns are
+escaped and combined into one regular expression. `*suffix` and `prefix*` file
+name patterns are checked against tuples of suffixes and prefixes, so only the
+remaining globs need to be translated into regular expressions.
+"""
+import re
+import subprocess
+import typing
+from os import path
+
+LABVIEW_EXTENSIONS = (".vi", ".vit", ".vim")
+
+_GLOB_CHARS = re.compile(r"[*?\[]")
+
+
+def get_changes(target_ref: str) -> typing.List[typing.Tuple[str, str, typing.Optional[str], bool]]:
+    """
+    Get files which have changed compared to the target ref, with the files they were renamed or copied from.
+
+    Copies are only detected from files which were also changed on the branch.
+
+    :param target_ref: The git ref to check for changed files against
+    :return: Tuples of the form (status, filename, source, identical). status is "A", "M", "R" or "C", depending
+             on whether the file was added, modified, renamed or copied. For renames and copies, source is the path
+             of the original file in the target ref, and identical is whether the content is unchanged.
+    """
+    diff_args = ["git", "diff", "--raw", "-z", "--no-abbrev", "-M", "-C",
+                 "--diff-filter=AMRC", target_ref + "..."]
+    # Each change is ":<old mode> <new mode> <old blob> <new blob> <status>", then its path,
+    # then for renames and copies the new path, all separated by NULs.
+    fields = subprocess.check_output(diff_args).decode("utf-8").split("\0")
+    changes = []
+    i = 0
+    while i + 1 < len(fields):
+        _, _, old_blob, new_blob, status = fields[i].split(" ")
+        status = status[0]
+        if status in ("R", "C"):
+            changes.append((status, fields[i + 2], fields[i + 1], old_blob == new_blob))
+            i += 3
+        else:
+            changes.append((status, fields[i + 1], None, False))
+            i += 2
+    return changes
+
+
+def get_changed_files(target_ref: str) -> typing.List[typing.Tuple[str, str]]:
+    """
+    Get files which have changed compared to the target ref.
+
+    :param target_ref: The git ref to check for changed files against
+    :return: Tuples of the form (status, filename) where status is "A", "M", "R" or "C", depending on whether the file was added, modified, renamed or copied.
+    """
+    return [(status, filename) for status, filename, _, _ in get_changes(target_ref)]
+
+
+def is_labview_file(filename: str) -> bool:
+    return filename.endswith(LABVIEW_EXTENSIONS)
+
+
+def _glob_to_regex(pattern: str) -> str:
+    """Translate a .gitignore-style glob into a regular expression."""
+    regex = ""
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            regex += "(?:.*/)?"
+            i += 3
+        elif pattern.startswith("**", i):
+            regex += ".*"
+            i += 2
+        elif pattern[i] == "*":
+            regex += "[^/]*"
+            i += 1
+        elif pattern[i] == "?":
+            regex += "[^/]"
+            i += 1
+        elif pattern[i] == "[" and "]" in pattern[i + 1:]:
+            end = pattern.index("]", i + 1)
+            members = pattern[i + 1:end].replace("\\", "\\\\")
+            if members.startswith(("!", "^")):
+                # A negated class, which like every glob never matches "/".
+                members = "^/" + members[1:]
+            regex += "[" + members + "]"
+            i = end + 1
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    return regex
+
+
+class IgnoreRules:
+    """A compiled set of ignore patterns."""
+
+    def __init__(self, patterns: typing.Iterable[str]):
+        self.patterns = []
+        substrings = []
+        name_prefixes = []
+        name_suffixes = []
+        name_globs = []
+        path_globs = []
+        for line in patterns:
+            pattern = line.strip()
+            if not pattern or pattern.startswith("#"):
+                continue
+            self.patterns.append(pattern)
+            if not _GLOB_CHARS.search(pattern):
+                substrings.append(pattern)
+            elif "/" in pattern:
+                anchored = pattern.lstrip("/")
+                if anchored.endswith("/"):
+                    anchored += "**"
+                path_globs.append(_glob_to_regex(anchored))
+            elif pattern.startswith("*") and not _GLOB_CHARS.search(pattern[1:]):
+                name_suffixes.append(pattern[1:])
+            elif pattern.endswith("*") and not _GLOB_CHARS.search(pattern[:-1]):
+                name_prefixes.append(pattern[:-1])
+            else:
+                name_globs.append(_glob_to_regex(pattern))
+
+        self._substring_regex = re.compile("|".join(map(re.escape, substrings))) if substrings else None
+        self._name_prefixes = tuple(name_prefixes)
+        self._name_suffixes = tuple(name_suffixes)
+        self._name_regex = re.compile("|".join(name_globs)) if name_globs else None
+        self._path_regex = re.compile("|".join(path_globs)) if path_globs else None
+
+    @classmethod
+    def from_file(cls, ignorefile: typing.Optional[str]) -> "IgnoreRules":
+        """Load rules from an ignore file; no file means nothing is ignored."""
+        if not ignorefile:
+            return cls([])
+        with open(ignorefile, "r") as f:
+            return cls(f.readlines())
+
+    def ignores(self, filename: str) -> bool:
+        filename = filename.replace("\\", "/")
+        name = path.basename(filename)
+        if self._substring_regex is not None and self._substring_regex.search(filename):
+            return True
+        if name.startswith(self._name_prefixes) or name.endswith(self._name_suffixes):
+            return True
+        if self._name_regex is not None and self._name_regex.fullmatch(name):
+            return True
+        return self._path_regex is not None and bool(self._path_regex.fullmatch(filename))
+
+
+def get_labview_changes(target_ref: str, rules: typing.Optional[IgnoreRules] = None
+                        ) -> typing.List[typing.Tuple[str, str, typing.Optional[str], bool]]:
+    """Get the (status, filename, source, identical) of LabVIEW files changed compared to the target ref, less ignored ones."""
+    return [change for change in get_changes(target_ref)
+            if is_labview_file(change[1]) and not (rules and rules.ignores(change[1]))]
+
+
+def get_changed_labview_files(target_ref: str, rules: typing.Optional[IgnoreRules] = None
+                              ) -> typing.List[typing.Tuple[str, str]]:
+    """Get the (status, filename) of LabVIEW files changed compared to the target ref, less ignored ones."""
+    return [(status, filename) for status, filename, _, _ in get_labview_changes(target_ref, rules)]
+
+
+class ChangeIndex:
+    """Change status of changed files, looked up by the name of their diff image.
+
+    Diff images are named after the VI they show, possibly with a prefix, so an
+    image matches the changed file whose name is the longest suffix of the image
+    name. The lookup only depends on the length of the image name, not the number
+    of changed files.
+    """
+
+    def __init__(self, changes: typing.Iterable[typing.Tuple[str, str]]):
+        self.by_name = {}
+        self.filenames = {}
+        for status, filename in changes:
+            self.by_name[path.basename(filename)] = status
+            self.filenames[path.basename(filename)] = filename
+
+    def _match(self, image_name: str) -> typing.Optional[str]:
+        stem = path.splitext(image_name)[0] if image_name.endswith((".png", ".webp")) else image_name
+        for start in range(len(stem)):
+            if stem[start:] in self.by_name:
+                return stem[start:]
+        return None
+
+    def status(self, image_name: str, default: str = "?") -> str:
+        """Get the status of the file an image shows, from the image file name or stem."""
+        name = self._match(image_name)
+        return default if name is None else self.by_name[name]
+
+    def filename(self, image_name: str) -> typing.Optional[str]:
+        """Get the path of the file an image shows, from the image file name or stem."""
+        name = self._match(image_name)
+        return None if name is None else self.filenames[name]
@@ -1,28 +1,49 @@
 import os
-import re
 import glob
 import typing
+import hashlib
 import base64
 import random
 import json
 import argparse
 import datetime
 import pathlib
-import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 
 import analysis
+import changeset
+import imagedups
+import imageopt
+import pixeldiff
+import responsecache
+import timing
 
 # Type definition for the quip database.
 QuipDB = typing.Dict[str, typing.Dict[str, typing.List[str]]]
 
+# Base URL of the GitHub REST API. GitHub Actions sets GITHUB_API_URL; it can
+# also be pointed at a local stand-in server for testing.
+API_URL = os.environ.get("GITHUB_API_URL", "https://api.github.com")
+
+# Status codes worth retrying: 409 is returned when concurrent contents API
+# commits race each other on the same branch.
+RETRY_STATUS = {409, 429, 500, 502, 503, 504}
+
+# Repository the diff images are uploaded to.
+DIFF_OWNER = "AbCellera"
+DIFF_REPO = "OrionDiff"
+
 
 def post_comment(github_token: str, repo: str, pr: int, comment: str):
     """Post a comment to an issue on GitHub."""
-    url = f"https://api.github.com/repos/{repo}/issues/{pr}/comments"
+    url = f"{API_URL}/repos/{repo}/issues/{pr}/comments"
     headers = {"Authorization": f"token {github_token}"}
     data = {"body": comment}
+    timing.count("http_requests")
     response = requests.post(url, headers=headers, data=json.dumps(data))
     if response.ok:
         print(f"Comment posted to {repo}/{pr}")
@@ -31,12 +52,8 @@ def post_comment(github_token: str, repo: str, pr: int, comment: str):
     return response.json()
 
 
-def query_pr(github_token: str, repo: str, pr: int):
-    owner, name = repo.split("/")
-    query = """
-    {
-      repository(owner: "%s", name: "%s") {
-        pullRequest(number: %s) {
+# Scalar fields of the pull request which are fetched.
+PR_FIELDS = """
           title
           author {
             login
@@ -46,70 +63,187 @@ def query_pr(github_token: str, repo: str, pr: int):
           closedAt
           mergedAt
           url
-          participants(first: 100) {
-            nodes {
-              login
-            }
-          }
           additions
           body
           number
           changedFiles
           deletions
-          files(first: 100) {
-            nodes {
-              changeType
-              additions
-              path
-              deletions
-            }
-          }
-          commits(last: 100) {
-            edges {
-              node {
-                commit {
-                  message
-                  changedFiles
-                  committedDate
-                }
-              }
-            }
-            totalCount
-          }
-          comments(last: 100) {
-            nodes {
-              bodyText
-              author {
-                login
-              }
-              publishedAt
-            }
-          }
-          reviewRequests(first: 100) {
-            nodes {
-            requestedReviewer {
-                ... on User {
-                login
-                }
-              }
-            }
-          }
+"""
+
+# Fields of the nodes of each paginated connection of the pull request.
+PR_CONNECTIONS = {
+    "participants": "login",
+    "files": "changeType additions path deletions",
+    "commits": "commit { message changedFiles committedDate }",
+    "comments": "bodyText author { login } publishedAt",
+    "reviewRequests": "requestedReviewer { ... on User { login } }",
+}
+
+PAGE_SIZE = 100
+
+
+def _selection(fields: typing.Iterable[str], indent: str = "\n          ") -> str:
+    """Build a GraphQL selection from dotted field paths, e.g. commit.message -> commit { message }."""
+    children = {}
+    for field in sorted(fields):
+        name, _, rest = field.partition(".")
+        children.setdefault(name, [])
+        if rest:
+            children[name].append(rest)
+    return "".join(
+        f"{indent}{name} {{ {_selection(rest, ' ').strip()} }}" if rest else f"{indent}{name}"
+        for name, rest in children.items())
+
+
+def _split_fields(fields: typing.Iterable[str]) -> typing.Tuple[str, typing.Dict[str, str]]:
+    """Split dotted field paths into the PR's scalar field selection and its connections' node selections."""
+    scalars = []
+    connections = {}
+    for field in fields:
+        name, _, rest = field.partition(".")
+        if name in PR_CONNECTIONS and rest:
+            connections.setdefault(name, []).append(rest)
+        else:
+            scalars.append(field)
+    return _selection(scalars), {name: _selection(nodes, " ").strip() for name, nodes in connections.items()}
+
+
+def _pr_query(connections: typing.Dict[str, str], fields: str = "", cursor: bool = False) -> str:
+    """Build a pull request query with the given scalar fields and a page of each connection."""
+    after = ", after: $cursor" if cursor else ""
+    selections = fields + "".join(
+        f"\n          {name}(first: {PAGE_SIZE}{after}) {{ pageInfo {{ hasNextPage endCursor }} nodes {{ {nodes} }} }}"
+        for name, nodes in connections.items())
+    return """
+    query($owner: String!, $name: String!, $pr: Int!%s) {
+      repository(owner: $owner, name: $name) {
+        pullRequest(number: $pr) {%s
         }
       }
     }
-    """ % (owner, name, pr)
-    request = requests.post(
-        'https://api.github.com/graphql',
-        json={'query': query},
-        headers={"Authorization": f"Bearer {github_token}"})
-    if request.ok:
-        return request.json()
-    else:
-        raise IOError(f"query failed with status code {request.status_code}")
+    """ % (", $cursor: String" if cursor else "", selections)
+
+
+def _graphql(session: requests.Session, query: str, variables: dict) -> typing.Tuple[dict, int]:
+    """Run a GraphQL query, returning the result and the size of the response in bytes."""
+    with timing.span("graphql"):
+        reply = request_with_retry(session, "POST", f"{API_URL}/graphql",
+                                   json={'query': query, 'variables': variables})
+    timing.count("graphql_bytes", len(reply.content))
+    if not reply.ok:
+        raise IOError(f"query failed with status code {reply.status_code}")
+    result = reply.json()
+    if result.get("errors"):
+        raise IOError(f"query failed with {result['errors']}")
+    return result, len(reply.content)
+
+
+def fetch_pr_features(github_token: str, repo: str, pr: int,
+                      analyzer_names: typing.Optional[typing.Iterable[str]] = None) -> dict:
+    """Fetch every page of a PR's connections and return its analysis feature record.
+
+    Only the fields read by the given analyzers (all of them by default) are
+    queried, and connections no analyzer needs aren't fetched at all.
+
+    The first request fetches the PR's fields and the first page of every
+    connection. Connections with more pages are then paginated by cursor,
+    each in its own thread. Nodes are added to an analysis.FeatureBuilder as
+    each page arrives and are not kept afterwards."""
+    start = time.perf_counter()
+    owner, name = repo.split("/")
+    variables = {"owner": owner, "name": name, "pr": int(pr)}
+    fields, connections = _split_fields(analysis.required_fields(analyzer_names))
+    session = make_session(github_token, pool_size=len(PR_CONNECTIONS))
+    builder = analysis.FeatureBuilder()
+    adders = {
+        "participants": builder.add_participants,
+        "files": builder.add_files,
+        "commits": lambda nodes: builder.add_commits(node['commit'] for node in nodes),
+        "comments": builder.add_comments,
+        "reviewRequests": builder.add_review_requests,
+    }
+
+    def paginate(connection: str, cursor: str) -> typing.Tuple[int, int]:
+        query = _pr_query({connection: connections[connection]}, cursor=True)
+        pages = 0
+        size = 0
+        has_next_page = True
+        while has_next_page:
+            page, page_size = _graphql(session, query, dict(variables, cursor=cursor))
+            page = page['data']['repository']['pullRequest'][connection]
+            adders[connection](page['nodes'])
+            pages += 1
+            size += page_size
+            has_next_page = page['pageInfo']['hasNextPage']
+            cursor = page['pageInfo']['endCursor']
+        return pages, size
+
+    first, size = _graphql(session, _pr_query(connections, fields), variables)
+    pull_request = first['data']['repository']['pullRequest']
+    builder.set_fields(pull_request)
+    pages = 1
+    with ThreadPoolExecutor(max_workers=len(PR_CONNECTIONS)) as pool:
+        futures = []
+        for connection in connections:
+            page = pull_request.pop(connection)
+            adders[connection](page['nodes'])
+            if page['pageInfo']['hasNextPage']:
+                futures.append(pool.submit(paginate, connection, page['pageInfo']['endCursor']))
+        for future in futures:
+            connection_pages, connection_size = future.result()
+            pages += connection_pages
+            size += connection_size
+
+    print(f"Fetched {repo}#{pr} in {pages} pages ({size} bytes) in {time.perf_counter() - start:.2f}s")
+    return builder.features(analysis.required_features(analyzer_names))
+
 
+def query_pr_updated_at(github_token: str, repo: str, pr: int) -> str:
+    """Query when a PR was last updated; any new commit, comment or edit changes it."""
+    owner, name = repo.split("/")
+    result, _ = _graphql(make_session(github_token), _pr_query({}, "\n          updatedAt"),
+                         {"owner": owner, "name": name, "pr": int(pr)})
+    return result['data']['repository']['pullRequest']['updatedAt']
+
+
+def fetch_pr_features_cached(github_token: str, repo: str, pr: int,
+                             analyzer_names: typing.Optional[typing.Iterable[str]],
+                             cache: responsecache.ResponseCache) -> dict:
+    """Like fetch_pr_features, but reusing the feature record from a previous run if the PR hasn't changed.
+
+    Fresh entries are used without any request. Older entries are reused if the
+    PR's updatedAt hasn't changed, at the cost of one small query."""
+    features = sorted(analysis.required_features(analyzer_names))
+    key = f"pr:{repo}#{pr}:" + ",".join(features)
+    entry = cache.get(key)
+    if cache.fresh(entry):
+        print(f"Using cached PR data for {repo}#{pr} from {entry['updated_at']}")
+        return entry["value"]
+    if cache.offline:
+        raise IOError(f"{repo}#{pr} is not cached and the cache is offline")
 
-def generate_comment(character: str, pr_info: dict, quips: QuipDB, imgs: typing.List[str], build_url: str) -> str:
-    facts = analysis.run(pr_info)
+    updated_at = query_pr_updated_at(github_token, repo, pr)
+    if entry is not None and entry["updated_at"] == updated_at:
+        print(f"PR {repo}#{pr} is unchanged since {updated_at}, using cached PR data")
+        cache.touch(key, entry)
+        return entry["value"]
+    value = fetch_pr_features(github_token, repo, pr, analyzer_names)
+    cache.put(key, value, updated_at=updated_at)
+    return value
+
+
+def generate_comment(character: str, facts: typing.Set[str], quips: QuipDB, imgs: typing.List[str], build_url: str,
+                     unchanged: typing.Iterable[str] = (),
+                     similar: typing.Optional[typing.Dict[str, str]] = None,
+                     renamed: typing.Iterable[typing.Tuple[str, str]] = ()) -> str:
+    """Write the PR comment.
+
+    Images with the same URL are listed once, with all of their VI names.
+    VIs in similar, which maps a VI name to the name of a VI whose diff looks
+    alike, are flagged as similar to it. Images of renamed and copied VIs are
+    listed with the modified VIs, since they are diffed against their source.
+    renamed lists the (source, filename) of VIs renamed or copied without changes."""
+    similar = similar or {}
     avatar_url = random.choice(quips["avatar"][character])
     comment = f'<img align="right" width="128" height="128" src="{avatar_url}">'
     if len(facts) > 0:
@@ -118,38 +252,144 @@ def generate_comment(character: str, pr_info: dict, quips: QuipDB, imgs: typing.
         comment += reaction
     comment += "\n\n"
 
-    vi_add = []
-    vi_mod = []
+    vi_add = {}
+    vi_mod = {}
     for status, name, url in imgs:
         if status == "A":
-            vi_add.append(("✨ " + name, url))
-        elif status == "M":
-            vi_mod.append(("🔨 " + name, url))
+            vi_add.setdefault(url, []).append(name)
+        elif status in ("M", "R", "C"):
+            vi_mod.setdefault(url, []).append(name)
+
+    def entry(icon: str, names: typing.List[str], url: str) -> str:
+        note = f" (similar to {similar[names[0]]})" if names[0] in similar else ""
+        return f"- [ ] [{icon} {', '.join(names)}]({url}){note}\n"
 
     comment += random.choice(quips["diff_modified"][character]) + "\n"
-    for name, url in vi_mod:
-        comment += f"- [ ] [{name}]({url})\n"
+    for url, names in vi_mod.items():
+        comment += entry("🔨", names, url)
         # comment += f"<details>\n  <summary>{name}</summary>\n\n  ![img]({url})\n</details>\n"
     comment += "\n\n" + random.choice(quips["diff_added"][character]) + "\n"
-    for name, url in vi_add:
-        comment += f"- [ ] [{name}]({url})\n"
+    for url, names in vi_add.items():
+        comment += entry("✨", names, url)
         # comment += f"<details>\n  <summary>{name}</summary>\n\n  ![img]({url})\n</details>\n"
+    unchanged = list(unchanged)
+    if unchanged:
+        comment += "\n\nRecompiled or re-saved with no visual change:\n"
+        for filename in unchanged:
+            comment += f"- {os.path.basename(filename)}\n"
+    renamed = list(renamed)
+    if renamed:
+        comment += "\n\nRenamed or copied with no changes:\n"
+        for source, filename in renamed:
+            comment += f"- {source} → {filename}\n"
     comment += f"\n\n[*{random.choice(quips['footer'][character])}*]({build_url})"
     return comment
 
 
-def post_file(token: str, data: str, owner: str, repo: str, path: str):
-    header = {
+def encode_file(filename: str) -> str:
+    """Read a file and return its contents base64 encoded, as the GitHub API expects."""
+    with open(filename, "rb") as f:
+        return base64.b64encode(f.read()).decode()
+
+
+def make_session(token: str, pool_size: int = 10) -> requests.Session:
+    """Create a keep-alive session authenticated with a GitHub token."""
+    session = requests.Session()
+    session.headers.update({
         "Accept": "application/vnd.github+json",
         "Authorization": "token " + token,
-    }
-    url = f"https://api.github.com/repos/{owner}/{repo}/contents/{path}"
+    })
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def _header_seconds(reply: requests.Response, name: str) -> typing.Optional[float]:
+    """A header's value as a number of seconds, or None if it is missing or not a number."""
+    try:
+        return float(reply.headers[name])
+    except (KeyError, ValueError):
+        return None
+
+
+def _retry_delay(reply: requests.Response, attempt: int, backoff: float) -> typing.Optional[float]:
+    """Seconds to wait before retrying a reply, or None if it shouldn't be retried.
+
+    Honors Retry-After, and x-ratelimit-reset when the primary rate limit is exhausted.
+    Secondary rate limits are reported as 403 with a message rather than a header.
+    Headers which aren't a number of seconds, such as a Retry-After date, fall back to backoff."""
+    rate_limited = reply.status_code == 403 and (
+        reply.headers.get("x-ratelimit-remaining") == "0" or "rate limit" in reply.text.lower())
+    if reply.status_code not in RETRY_STATUS and not rate_limited:
+        return None
+    retry_after = _header_seconds(reply, "Retry-After")
+    if retry_after is not None:
+        return retry_after
+    reset = _header_seconds(reply, "x-ratelimit-reset")
+    if reply.headers.get("x-ratelimit-remaining") == "0" and reset is not None:
+        return max(0.0, reset - time.time())
+    return backoff * 2 ** attempt + random.uniform(0, backoff)
+
+
+def request_with_retry(session: requests.Session, method: str, url: str,
+                       retries: int = 5, backoff: float = 1.0, **kwargs) -> requests.Response:
+    """Send a request, retrying with exponential backoff on rate limits and transient errors."""
+    for attempt in range(retries + 1):
+        timing.count("http_requests")
+        if attempt:
+            timing.count("http_retries")
+        try:
+            reply = session.request(method, url, **kwargs)
+        except requests.ConnectionError:
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2 ** attempt)
+            continue
+        delay = _retry_delay(reply, attempt, backoff)
+        if delay is None or attempt == retries:
+            return reply
+        print(f"{method} {url} returned {reply.status_code}, retrying in {delay:.1f}s")
+        time.sleep(delay)
+    return reply
+
+
+def rest_get(session: requests.Session, url: str, cache: typing.Optional[responsecache.ResponseCache] = None,
+             revalidate: bool = False) -> typing.Tuple[int, typing.Any]:
+    """GET a REST resource, returning its status code and JSON body.
+
+    With a cache, fresh entries are returned without a request, unless revalidate
+    is set for resources which must be current. Older entries are revalidated
+    with If-None-Match, and a 304 reply returns the cached body."""
+    entry = cache.get(url) if cache is not None else None
+    if cache is not None and cache.fresh(entry) and (cache.offline or not revalidate):
+        return entry["status"], entry["value"]
+    if cache is not None and cache.offline:
+        raise IOError(f"{url} is not cached and the cache is offline")
+    headers = {"If-None-Match": entry["etag"]} if entry and entry.get("etag") else {}
+    reply = request_with_retry(session, "GET", url, headers=headers)
+    if reply.status_code == 304:
+        cache.touch(url, entry)
+        return entry["status"], entry["value"]
+    value = reply.json() if reply.content else None
+    if cache is not None and (reply.ok or reply.status_code == 404) and "ETag" in reply.headers:
+        cache.put(url, value, status=reply.status_code, etag=reply.headers["ETag"])
+    return reply.status_code, value
+
+
+def post_file(token: str, data: str, owner: str, repo: str, path: str,
+              session: typing.Optional[requests.Session] = None):
+    if session is None:
+        session = make_session(token)
+    url = f"{API_URL}/repos/{owner}/{repo}/contents/{path}"
     body = json.dumps({
         "message": "add diff output",
         "content": data,
     })
-    reply = requests.put(url, body, headers=header)
+    with timing.span("post_file", path=path):
+        reply = request_with_retry(session, "PUT", url, data=body)
     if reply.ok:
+        timing.count("upload_bytes", len(data))
         print("uploaded", path)
     else:
         raise IOError(
@@ -157,22 +397,222 @@ def post_file(token: str, data: str, owner: str, repo: str, path: str):
     return reply.json()["content"]["download_url"]
 
 
+def upload_files(token: str, files: typing.List[typing.Tuple[str, str]], owner: str, repo: str,
+                 jobs: int = 4) -> typing.List[str]:
+    """Upload (repository path, local file) pairs concurrently over one keep-alive session.
+
+    Each file is only read and encoded when it is uploaded, so at most `jobs`
+    files are held in memory at once. Returns the download URLs in the same order as files."""
+    session = make_session(token, pool_size=jobs)
+
+    def upload(path: str, filename: str) -> str:
+        return post_file(token, encode_file(filename), owner, repo, path, session)
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(upload, path, filename) for path, filename in files]
+        return [future.result() for future in futures]
+
+
+def _check(reply: requests.Response, what: str) -> dict:
+    if not reply.ok:
+        raise IOError(f"{what} failed with status code {reply.status_code} with {reply.text}")
+    return reply.json()
+
+
+def create_blob(session: requests.Session, owner: str, repo: str, filename: str) -> str:
+    """Upload a local file as a blob with the Git Data API, reading and encoding it only now. Returns its SHA."""
+    content = encode_file(filename)
+    body = json.dumps({"content": content, "encoding": "base64"})
+    with timing.span("create_blob", filename=filename):
+        reply = request_with_retry(session, "POST", f"{API_URL}/repos/{owner}/{repo}/git/blobs", data=body)
+    timing.count("upload_bytes", len(content))
+    return _check(reply, "blob upload")["sha"]
+
+
+def commit_blobs(session: requests.Session, blobs: typing.List[typing.Tuple[str, str]], owner: str, repo: str,
+                 branch: str = "main", message: str = "add diff output",
+                 cache: typing.Optional[responsecache.ResponseCache] = None) -> str:
+    """Add (repository path, blob SHA) pairs to a branch with one tree, one commit and one ref update.
+
+    If the branch moves while committing, the tree and commit are rebuilt on the
+    new head; the blobs don't need to be uploaded again.
+
+    Returns the SHA of the new commit."""
+    git_url = f"{API_URL}/repos/{owner}/{repo}/git"
+    tree = [{"path": path, "mode": "100644", "type": "blob", "sha": sha} for path, sha in blobs]
+
+    with timing.span("commit"):
+        for attempt in range(5):
+            status, ref = rest_get(session, f"{git_url}/ref/heads/{branch}", cache, revalidate=True)
+            if status >= 400:
+                raise IOError(f"ref lookup failed with status code {status} with {ref}")
+            head = ref["object"]["sha"]
+            # Commits never change, so a cached one doesn't need revalidating.
+            status, head_commit = rest_get(session, f"{git_url}/commits/{head}", cache)
+            if status >= 400:
+                raise IOError(f"commit lookup failed with status code {status} with {head_commit}")
+            new_tree = _check(request_with_retry(session, "POST", f"{git_url}/trees", data=json.dumps(
+                {"base_tree": head_commit["tree"]["sha"], "tree": tree})), "tree creation")
+            commit = _check(request_with_retry(session, "POST", f"{git_url}/commits", data=json.dumps(
+                {"message": message, "tree": new_tree["sha"], "parents": [head]})), "commit creation")
+            reply = request_with_retry(session, "PATCH", f"{git_url}/refs/heads/{branch}",
+                                       data=json.dumps({"sha": commit["sha"]}))
+            if reply.status_code == 422:
+                # Not a fast-forward: someone else pushed to the branch in the meantime.
+                print(f"{branch} moved while committing, retrying")
+                continue
+            _check(reply, "ref update")
+            print(f"uploaded {len(blobs)} files in commit {commit['sha']}")
+            return commit["sha"]
+        raise IOError(f"could not update {branch} after {attempt + 1} attempts")
+
+
+def upload_files_single_commit(token: str, files: typing.List[typing.Tuple[str, str]], owner: str, repo: str,
+                               branch: str = "main", message: str = "add diff output",
+                               jobs: int = 4, cache: typing.Optional[responsecache.ResponseCache] = None) -> str:
+    """Upload (repository path, local file) pairs as a single commit using the Git Data API.
+
+    Blobs are created concurrently, reading and encoding each file only when it
+    is uploaded, then they are committed together with commit_blobs.
+
+    Returns the SHA of the new commit."""
+    session = make_session(token, pool_size=jobs)
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        blob_shas = list(pool.map(lambda filename: create_blob(session, owner, repo, filename),
+                                  [filename for _, filename in files]))
+    return commit_blobs(session, [(path, sha) for (path, _), sha in zip(files, blob_shas)], owner, repo,
+                        branch, message, cache)
+
+
+def file_sha256(filename: str) -> str:
+    sha = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def fetch_manifest(token: str, owner: str, repo: str, path: str,
+                   cache: typing.Optional[responsecache.ResponseCache] = None
+                   ) -> typing.Tuple[dict, typing.Optional[str]]:
+    """Fetch a JSON manifest of image name -> {"sha256", "url"} from the diff repository.
+
+    Returns the manifest and the blob SHA of the file, which the contents API
+    needs to update it. A missing manifest is returned as ({}, None)."""
+    session = make_session(token)
+    status, content = rest_get(session, f"{API_URL}/repos/{owner}/{repo}/contents/{path}", cache, revalidate=True)
+    if status == 404:
+        return {}, None
+    if status >= 400:
+        raise IOError(f"manifest download failed with status code {status} with {content}")
+    return json.loads(base64.b64decode(content["content"])), content["sha"]
+
+
+def put_manifest(token: str, manifest: dict, owner: str, repo: str, path: str, sha: typing.Optional[str]):
+    """Create or update a JSON manifest in the diff repository with the contents API."""
+    body = {
+        "message": "update diff manifest",
+        "content": base64.b64encode(json.dumps(manifest, indent=2).encode()).decode(),
+    }
+    if sha:
+        body["sha"] = sha
+    reply = request_with_retry(make_session(token), "PUT", f"{API_URL}/repos/{owner}/{repo}/contents/{path}",
+                               data=json.dumps(body))
+    _check(reply, "manifest upload")
+
+
+def write_manifest(manifest: dict, filename: str):
+    with open(filename, "w") as f:
+        json.dump(manifest, f, indent=2)
+
+
+def reuse_or_place(manifest: dict, name: str, pngpath: str, diff_dir: str, owner: str, repo: str
+                   ) -> typing.Tuple[str, typing.Optional[str]]:
+    """Find an image's URL in the manifest, or choose where to upload it.
+
+    Returns the image's URL and, unless the manifest has an identical image,
+    the repository path to upload it to. The manifest is updated to match."""
+    digest = file_sha256(pngpath)
+    if manifest.get(name, {}).get("sha256") == digest:
+        return manifest[name]["url"], None
+    path = f"{diff_dir}/{name}"
+    url = image_url(owner, repo, path)
+    manifest[name] = {"sha256": digest, "url": url}
+    return url, path
+
+
+def manifest_path(pr: int) -> str:
+    """Path in the diff repository of the manifest of the images uploaded for a PR."""
+    return f"pull/{pr}/manifest.json"
+
+
+def image_url(owner: str, repo: str, path: str) -> str:
+    """URL of an image uploaded to the main branch of the diff repository, for embedding in a comment."""
+    return f"https://github.com/{owner}/{repo}/blob/main/{path}?raw=true".replace(" ", "%20")
+
+
+def upload_dir(pr: int) -> str:
+    """Directory of the diff repository this run's images for a PR are uploaded to."""
+    return f"pull/{pr}/{datetime.datetime.now().strftime('%Y-%m-%d/%H:%M:%S')}"
+
+
+def upload_pngs(token: str, pngfiles: typing.Dict[str, str], owner: str, repo: str, pr: int,
+                upload_mode: str = "commit", jobs: int = 4,
+                cache: typing.Optional[responsecache.ResponseCache] = None) -> typing.Dict[str, str]:
+    """Upload PNG files (name -> local path) to pull/<pr>/<timestamp> in the diff repository.
+
+    Images which are identical to the ones uploaded by a previous run for this
+    PR reuse the existing URL instead of being uploaded again. The digests and
+    URLs are kept in pull/<pr>/manifest.json in the diff repository.
+
+    Returns a dict of image name to URL, in the same order as pngfiles."""
+    diff_dir = upload_dir(pr)
+    manifest, manifest_sha = fetch_manifest(token, owner, repo, manifest_path(pr), cache)
+    uploads = []
+    pngurls = {}
+    for name, pngpath in pngfiles.items():
+        pngurls[name], path = reuse_or_place(manifest, name, pngpath, diff_dir, owner, repo)
+        if path is not None:
+            uploads.append((path, pngpath))
+    print(f"Reusing {len(pngfiles) - len(uploads)} unchanged images, uploading {len(uploads)}")
+
+    if uploads and upload_mode == "commit":
+        # The manifest goes in the same commit as the images.
+        with tempfile.TemporaryDirectory() as manifest_dir:
+            manifest_file = os.path.join(manifest_dir, "manifest.json")
+            write_manifest(manifest, manifest_file)
+            upload_files_single_commit(token, uploads + [(manifest_path(pr), manifest_file)],
+                                       owner, repo, jobs=jobs, cache=cache)
+    elif uploads:
+        upload_files(token, uploads, owner, repo, jobs)
+        put_manifest(token, manifest, owner, repo, manifest_path(pr), manifest_sha)
+    upload_bytes = sum(os.path.getsize(pngpath) for _, pngpath in uploads)
+    print(f"Uploaded {len(uploads)} images ({upload_bytes} bytes), "
+          f"peak RSS {timing.peak_rss_bytes() / (1024 * 1024):.1f} MiB")
+    return pngurls
+
+
+def read_no_visual_change(diff_dir: str) -> typing.List[str]:
+    """Read the VIs diffvi.py skipped because they have no visual change."""
+    try:
+        with open(os.path.join(diff_dir, "no_visual_change.txt"), "r") as f:
+            return [line.strip() for line in f if line.strip()]
+    except FileNotFoundError:
+        return []
+
+
+def read_renamed(diff_dir: str) -> typing.List[typing.Tuple[str, str]]:
+    """Read the (source, filename) of VIs diffvi.py skipped because they were renamed or copied without changes."""
+    try:
+        with open(os.path.join(diff_dir, "renamed.txt"), "r") as f:
+            return [tuple(line.rstrip("\n").split("\t", 1)) for line in f if line.strip()]
+    except FileNotFoundError:
+        return []
+
+
 def get_changed_files(target_ref: str) -> typing.Dict[str, str]:
-    """Get added, modified, and deleted files from a git diff."""
-    diff_args = ["git", "diff", "--name-status",
-                 "--diff-filter=AM", target_ref + "..."]
-    diff_output = subprocess.check_output(diff_args).decode("utf-8")
-    # https://regex101.com/r/EFVDVV/2
-    diff_regex = re.compile(r"^([AM])\s+(.*)$", re.MULTILINE)
-    changes = {}
-    for match in re.finditer(diff_regex, diff_output):
-        changes[match.group(2)] = match.group(1)
-    diff_regex = re.compile(r"^(.*\.vi[tm]?)$", re.MULTILINE)
-    lv_changes = {}
-    for filename, status in changes.items():
-        if re.match(diff_regex, filename):
-            lv_changes[filename] = status
-    return lv_changes
+    """Get added, modified, renamed and copied LabVIEW files from a git diff."""
+    return {filename: status for status, filename in changeset.get_changed_labview_files(target_ref)}
 
 
 parser = argparse.ArgumentParser()
@@ -194,41 +634,135 @@ parser.add_argument(
 parser.add_argument(
     "--build-url", required=True,
     help="URL to build artifacts")
+parser.add_argument(
+    "--upload-jobs", type=int, default=4,
+    help="Number of images to upload concurrently (default: 4)")
+parser.add_argument(
+    "--upload-mode", choices=["commit", "contents"], default="commit",
+    help="Upload all images in a single commit with the Git Data API, "
+         "or with one contents API commit per image (default: commit)")
+parser.add_argument(
+    "--optimize-images", action="store_true",
+    help="Losslessly recompress images before uploading them (requires Pillow)")
+parser.add_argument(
+    "--max-dimension", type=int, default=0,
+    help="With --optimize-images, downscale images larger than this many pixels on a side")
+parser.add_argument(
+    "--webp", action="store_true",
+    help="With --optimize-images, upload lossless WebP images instead of PNGs")
+parser.add_argument(
+    "--pixel-diff", action="store_true",
+    help="Crop images of modified VIs to the highlighted regions which changed, and leave out images "
+         "where no pixels changed (requires NumPy and Pillow)")
+parser.add_argument(
+    "--pixel-diff-padding", type=int, default=16,
+    help="With --pixel-diff, pixels of context to keep around each change (default: 16)")
+parser.add_argument(
+    "--pixel-diff-threshold", type=int, default=0,
+    help="With --pixel-diff, largest per-channel difference to ignore as noise (default: 0)")
+parser.add_argument(
+    "--dedupe-images", action="store_true",
+    help="Upload identical images once and list their VIs under one link, and flag similar images "
+         "(similar images are found with Pillow, if it is installed)")
+parser.add_argument(
+    "--similar-distance", type=int, default=4,
+    help="With --dedupe-images, how many of the 64 perceptual hash bits may differ for images to be similar "
+         "(default: 4)")
+parser.add_argument(
+    "--disable-analyzer", action="append", default=[], choices=sorted(analysis.analyzers),
+    metavar="ANALYZER",
+    help="Don't run this analyzer, and don't query the PR fields only it reads (can be repeated)")
+parser.add_argument(
+    "--cache-dir",
+    help="Directory to cache PR data and GitHub API responses in between runs")
+parser.add_argument(
+    "--cache-ttl", type=float, default=600,
+    help="Seconds cached responses are used without checking GitHub (default: 600)")
+parser.add_argument(
+    "--offline", action="store_true",
+    help="Only use cached responses; print the comment with local image links instead of uploading and posting")
+parser.add_argument(
+    "--report-json",
+    help="Write a JSON report of phase durations, bytes uploaded, HTTP calls and retries and peak memory to this file")
 
 if __name__ == "__main__":
     character = "Shakespeare"  # Only supported character at the moment.
     args = parser.parse_args()
-    changes = get_changed_files(args.target)
+    if args.offline and not args.cache_dir:
+        parser.error("--offline requires --cache-dir")
+    cache = None
+    if args.cache_dir:
+        cache = responsecache.ResponseCache(args.cache_dir, args.cache_ttl, args.offline)
+    with timing.span("changed_files"):
+        changes = changeset.ChangeIndex(changeset.get_changed_labview_files(args.target))
 
     # Upload files to OrionDiff repository.
-    pngfiles = {}  # Base64 encoded PNG files.
-    pngurls = {}  # URLs to the uploaded PNG files.
-    for pngpath in glob.glob(os.path.join(args.diffdir, "*.png")):
-        with open(pngpath, "rb") as f:
-            name = os.path.basename(pngpath)
-            pngfiles[name] = base64.b64encode(f.read()).decode()
-    diff_dir = f"pull/{args.pr}/{datetime.datetime.now().strftime('%Y-%m-%d/%H:%M:%S')}"
+    # Files are only read when they are uploaded, so just keep their paths here.
+    pngfiles = {os.path.basename(pngpath): pngpath
+                for pngpath in glob.glob(os.path.join(args.diffdir, "*.png"))}
+    cropped_dir = tempfile.TemporaryDirectory()
+    if args.pixel_diff and pngfiles:
+        # Images of added VIs have nothing to compare against.
+        modified = {name: pngpath for name, pngpath in pngfiles.items()
+                    if changes.status(name) in ("M", "R", "C")}
+        with timing.span("pixel_diff", images=len(modified)):
+            cropped = pixeldiff.pixel_diff_images(modified, cropped_dir.name, args.pixel_diff_padding,
+                                                  args.pixel_diff_threshold)
+        pngfiles = {name: cropped.get(name, pngpath) for name, pngpath in pngfiles.items()
+                    if name in cropped or name not in modified}
+    optimized_dir = tempfile.TemporaryDirectory()
+    if args.optimize_images and pngfiles:
+        with timing.span("optimize_images", images=len(pngfiles)):
+            pngfiles = imageopt.optimize_images(pngfiles, optimized_dir.name, args.max_dimension, args.webp)
+    duplicates = None
+    uploads = pngfiles
+    if args.dedupe_images and pngfiles:
+        with timing.span("dedupe_images", images=len(pngfiles)):
+            duplicates = imagedups.ImageIndex(pngfiles, args.similar_distance)
+        print(duplicates.summary())
+        uploads = duplicates.unique(pngfiles)
+    if args.offline:
+        pngurls = {name: pathlib.Path(pngpath).resolve().as_uri() for name, pngpath in uploads.items()}
+    else:
+        with timing.span("upload", images=len(uploads), mode=args.upload_mode):
+            pngurls = upload_pngs(args.token, uploads, DIFF_OWNER, DIFF_REPO, args.pr,
+                                  args.upload_mode, args.upload_jobs, cache)
+    similar = {}
+    if duplicates is not None:
+        pngurls = duplicates.urls(pngurls)
+        similar = {os.path.splitext(name)[0]: os.path.splitext(other)[0]
+                   for name, other in duplicates.similar.items()}
+
     img_url = []
-    for name, data in pngfiles.items():
-        path = f"{diff_dir}/{name}"
-        post_file(args.token, data, "AbCellera", "OrionDiff", path)
-        url = f"https://github.com/AbCellera/OrionDiff/blob/main/{path}?raw=true"
-        url = url.replace(" ", "%20")
-        diff_status = "?"
-        for filename, status in changes.items():
-            if name.replace(".png", "").endswith(os.path.basename(filename)):
-                diff_status = status
-        img_url.append((diff_status, name.replace(".png", ""), url))
-
-    pr_info = query_pr(args.token, args.repo, args.pr)
+    for name, url in pngurls.items():
+        vi_name = os.path.splitext(name)[0]
+        img_url.append((changes.status(vi_name), vi_name, url))
+
+    analyzer_names = [name for name in analysis.analyzers if name not in args.disable_analyzer]
+    with timing.span("query_pr"):
+        if cache is not None:
+            features = fetch_pr_features_cached(args.token, args.repo, args.pr, analyzer_names, cache)
+        else:
+            features = fetch_pr_features(args.token, args.repo, args.pr, analyzer_names)
+    with timing.span("analysis"):
+        facts = analysis.run_features(features, analyzer_names)
     parent_dir = pathlib.Path(__file__).parent.resolve()
     with open(parent_dir.joinpath("quips.json"), "r") as f:
         quips = json.load(f)
 
-    if len(img_url) == 0:
+    unchanged = read_no_visual_change(args.diffdir)
+    renamed = read_renamed(args.diffdir)
+    if len(img_url) == 0 and not unchanged and not renamed:
         print("No diff images found. Skipping PR comment")
     else:
         print("Found", len(img_url), "diff images. Posting comment.")
         comment = generate_comment(
-            character, pr_info, quips, img_url, args.build_url)
-        post_comment(args.token, args.repo, args.pr, comment)
+            character, facts, quips, img_url, args.build_url, unchanged, similar, renamed)
+        if args.offline:
+            print(comment)
+        else:
+            with timing.span("post_comment"):
+                post_comment(args.token, args.repo, args.pr, comment)
+
+    if args.report_json:
+        timing.write_report(args.report_json, tool="diffbot", repo=args.repo, pr=args.pr, images=len(img_url))
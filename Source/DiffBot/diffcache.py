@@ -0,0 +1,122 @@
+"""Module diffcache stores diff images on disk, keyed by the content they were made from.
+
+A diff image depends on the old VI, the new VI, the LabVIEW version and the
+DiffVI.vi operation that rendered it. It also depends on any changed controls
+and typedefs the VI shows, which aren't part of the VI file, and is named after
+the VI. The cache key is built from the git blob SHA of both VIs, the VI's path
+in the repository, the blob SHAs of those controls and the two versions. Re-pushes to a PR that touch neither a VI nor the controls it
+shows reuse the image from the previous run instead of launching g-cli.
+
+Entries are directories named after the key. The least recently used entries
+are evicted once the cache grows beyond its size limit.
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from os import path
+
+
+def git_blob_sha(filename: str) -> str:
+    """Return the SHA git would assign to the file as a blob, without calling git."""
+    sha = hashlib.sha1()
+    sha.update(b"blob %d\0" % path.getsize(filename))
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def cache_key(old_vi, new_vi, name, lv_version, diffvi_version, controls=()) -> str:
+    """Build the cache key for a diff.
+
+    :param old_vi: The older version of the VI, or None if the VI was added
+    :param new_vi: The newer version of the VI
+    :param name: The VI's path in the repository; identical VIs elsewhere get their own images
+    :param lv_version: The year version of LabVIEW used for diffing
+    :param diffvi_version: The version of the DiffVI operation, e.g. from `diffvi_version`
+    :param controls: Changed controls and typedefs the VI shows, whose current content is part of the key
+    """
+    old_sha = git_blob_sha(old_vi) if old_vi else "0" * 40
+    new_sha = git_blob_sha(new_vi)
+    parts = [old_sha, new_sha, name, str(lv_version), diffvi_version]
+    for control in sorted(controls):
+        parts.append("{0}:{1}".format(control, git_blob_sha(control) if path.isfile(control) else "deleted"))
+    return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+
+def diffvi_version(opsdir: str) -> str:
+    """Identify the DiffVI operation by the blob SHA of DiffVI.vi, if it can be found."""
+    diffvi = path.join(opsdir, "DiffVI.vi")
+    if path.isfile(diffvi):
+        return git_blob_sha(diffvi)
+    return "unknown"
+
+
+class DiffCache:
+    """Size-bounded, least-recently-used cache of diff output directories."""
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _entry(self, key: str) -> str:
+        return path.join(self.directory, key)
+
+    def fetch(self, key: str, output_dir: str) -> bool:
+        """Copy a cached entry into output_dir, returning False on a miss."""
+        entry = self._entry(key)
+        try:
+            names = os.listdir(entry)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return False
+        for name in names:
+            shutil.copy(path.join(entry, name), path.join(output_dir, name))
+        # The entry's mtime records when it was last used, for eviction.
+        os.utime(entry)
+        with self._lock:
+            self.hits += 1
+        return True
+
+    def store(self, key: str, source_dir: str):
+        """Store the files in source_dir under key, then evict old entries if needed."""
+        entry = self._entry(key)
+        staging = tempfile.mkdtemp(dir=self.directory, prefix=".tmp-")
+        for name in os.listdir(source_dir):
+            src = path.join(source_dir, name)
+            if path.isfile(src):
+                shutil.copy(src, path.join(staging, name))
+        try:
+            os.rename(staging, entry)
+        except OSError:
+            # Another worker stored the same key first.
+            shutil.rmtree(staging, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits in max_bytes."""
+        with self._lock:
+            entries = []
+            total = 0
+            for key in os.listdir(self.directory):
+                entry = self._entry(key)
+                if key.startswith(".") or not path.isdir(entry):
+                    continue
+                size = sum(path.getsize(path.join(entry, name)) for name in os.listdir(entry))
+                entries.append((path.getmtime(entry), size, entry))
+                total += size
+            for _, size, entry in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                shutil.rmtree(entry, ignore_errors=True)
+                total -= size
+
+    def summary(self) -> str:
+        return f"Diff cache: {self.hits} hits, {self.misses} misses"
@@ -1,33 +1,36 @@
 import os
-import re
+import json
 import argparse
+import queue
 import shutil
+import signal
 import subprocess
 import tempfile
+import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from os import path
 
+import changeset
+import diffcache
+import rsrc
+import sharding
+import timing
+import vihierarchy
+
 
 def get_changed_files(target_ref):
     """
     Get files which have changed compared to the target ref.
 
     :param target_ref: The git ref to check for changed files against
-    :return: Tuples of the form (status, filename) where status is either "A" or "M", depending on whether the file was added or modified.
+    :return: Tuples of the form (status, filename) where status is "A", "M", "R" or "C", depending on whether the file was added, modified, renamed or copied.
     """
-    diff_args = ["git", "diff", "--name-status",
-                 "--diff-filter=AM", target_ref + "..."]
-    diff_output = subprocess.check_output(diff_args).decode("utf-8")
-
-    # https://regex101.com/r/EFVDVV/2
-    diff_regex = re.compile(r"^([AM])\s+(.*)$", re.MULTILINE)
+    yield from changeset.get_changed_files(target_ref)
 
-    for match in re.finditer(diff_regex, diff_output):
-        yield match.group(1), match.group(2)
 
-
-def diff_vi(old_vi, new_vi, output_dir, opsdir, lv_version):
+def diff_vi(old_vi, new_vi, output_dir, opsdir, lv_version, timeout=None, lv_exe=None):
     """Generates a diff of LabVIEW VIs.
 
     VIs which fail to be diffed are logged to {output_dir}/diff_failures.txt.
@@ -37,13 +40,18 @@ def diff_vi(old_vi, new_vi, output_dir, opsdir, lv_version):
     :param output_dir: The directory in which to store output
     :param opsdir: The directory containing DiffVI operation
     :param lv_version: The year version of LabVIEW to use for diffing
+    :param timeout: (optional) Seconds to wait for the diff. If it times out LabVIEW is
+                    assumed to be wedged and is killed, see kill_labview; a timed out or failed
+                    diff is retried once.
+    :param lv_exe: (optional) The LabVIEW executable to diff in, for running several LabVIEW instances at once
     """
     version_path = labview_path_from_year(lv_version)
 
     command_args = [
-        "g-cli",
+        gcli_executable(),
         "--lv-ver", lv_version,
         "--x64",
+        *labview_exe_args(lv_exe),
         f"{opsdir}\\DiffVI.vi",
         "--",
         "-NewVI", new_vi,
@@ -58,14 +66,176 @@ def diff_vi(old_vi, new_vi, output_dir, opsdir, lv_version):
     # This is copied from the original NI LabVIEW diff script.
     # If there are weird problems then this should be uncommented.
     # subprocess.call(["taskkill", "/IM", "labview.exe", "/F"])
+    # With a timeout, LabVIEW is only killed when a diff hangs.
+    attempts = 2 if timeout else 1
+    for attempt in range(attempts):
+        try:
+            with timing.span("g-cli", vi=new_vi, attempt=attempt):
+                run_gcli(command_args, timeout, lv_exe)
+            return
+        except subprocess.CalledProcessError as e:
+            reason = "g-cli exited with status {0}".format(e.returncode)
+            traceback.print_exc()
+        except subprocess.TimeoutExpired:
+            reason = "timed out after {0}s".format(timeout)
+            timing.count("diff_timeouts")
+        print('Failed to diff "{0}" and "{1}": {2}.'.format(old_vi, new_vi, reason))
+        if attempt + 1 < attempts:
+            timing.count("diff_retries")
+            print("Retrying.")
+    record_failure(output_dir, new_vi, reason)
+
+
+def gcli_executable():
+    """
+    Find g-cli on the PATH.
+
+    Given a bare name, subprocess only looks for g-cli.exe on Windows, while
+    shutil.which also finds wrappers with other PATHEXT extensions, such as g-cli.cmd.
+    """
+    return shutil.which("g-cli") or "g-cli"
+
+
+def labview_exe_args(lv_exe):
+    """g-cli arguments selecting a LabVIEW executable, if one is given."""
+    return ["--lv-exe", lv_exe] if lv_exe else []
+
+
+def run_gcli(command_args, timeout=None, lv_exe=None):
+    """
+    Run g-cli, killing it and its LabVIEW if it doesn't finish within timeout seconds.
+
+    :raises subprocess.CalledProcessError: If g-cli fails
+    :raises subprocess.TimeoutExpired: If g-cli times out, after it has been killed
+    """
+    # In its own process group, so that everything it started can be killed with it.
+    process = subprocess.Popen(command_args, start_new_session=os.name != "nt")
     try:
-        subprocess.check_call(command_args)
-    except subprocess.CalledProcessError:
-        print('Failed to diff "{0}" and "{1}".'.format(old_vi, new_vi))
-        traceback.print_exc()
+        returncode = process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        kill_labview(process, lv_exe)
+        process.wait()
+        raise
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, command_args)
+
+
+def kill_labview(process, lv_exe=None):
+    """
+    Kill a timed out g-cli and its wedged LabVIEW, so that the next g-cli call launches a fresh one.
+
+    g-cli and everything it started are killed by process ID. LabVIEW keeps running
+    after g-cli exits, so the LabVIEW it attached to may not be one of them. With
+    lv_exe, every process running that executable is killed too, which leaves the
+    LabVIEW instances of other jobs alone. Without it, every LabVIEW is killed, which
+    is only safe when no other diffs are running; the command line checks this.
+
+    :param process: The g-cli subprocess.Popen
+    :param lv_exe: (optional) The LabVIEW executable g-cli was given
+    """
+    print("Killing g-cli (pid {0}) and {1}.".format(process.pid, lv_exe or "LabVIEW"))
+    if os.name != "nt":
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        return
+    subprocess.call(["taskkill", "/PID", str(process.pid), "/T", "/F"])
+    if lv_exe:
+        subprocess.call([
+            "powershell", "-NoProfile", "-Command",
+            "Get-Process | Where-Object {{ $_.Path -eq '{0}' }} | Stop-Process -Force".format(
+                path.abspath(lv_exe).replace("'", "''")),
+        ])
+    else:
+        subprocess.call(["taskkill", "/IM", "labview.exe", "/F"])
+
+
+def record_failure(output_dir, new_vi, reason=None):
+    """Log a VI which failed to be diffed to {output_dir}/diff_failures.txt, with the reason after a tab."""
+    timing.count("diff_failures")
+    with open(path.join(output_dir, "diff_failures.txt"), "a+") as file:
+        file.write(new_vi + ("\t" + reason if reason else "") + "\n")
+
+
+def check_batch_operation(opsdir):
+    """
+    Check that the DiffVIBatch operation exists, before any VIs are handed to it.
+
+    DiffVIBatch.vi isn't part of this repository; it has to be installed in the
+    operations directory alongside DiffVI.vi.
+
+    :param opsdir: The directory containing DiffVIBatch operation
+    :raises FileNotFoundError: If the operation is missing
+    """
+    operation = path.join(opsdir, "DiffVIBatch.vi")
+    if not path.isfile(operation):
+        raise FileNotFoundError(
+            "--batch requires the DiffVIBatch operation, but {0} doesn't exist. "
+            "Install it next to DiffVI.vi, or diff without --batch.".format(operation))
 
-        with open(output_dir + "\\diff_failures.txt", "a+") as file:
-            file.write(new_vi + "\n")
+
+def diff_vis_batch(diffs, opsdir, lv_version, lv_exe=None):
+    """Generates diffs of many LabVIEW VIs with a single g-cli invocation.
+
+    The (old, new, output) triples are written to a JSON manifest which the
+    DiffVIBatch operation works through in one LabVIEW session, so LabVIEW and
+    the diff operation are only loaded once. The operation writes a JSON results
+    file of the form `{"results": [{"new_vi": ..., "ok": ..., "error": ...}]}`.
+
+    VIs which fail to be diffed, or which are missing from the results, are logged
+    to diff_failures.txt in their own output directory. A results file which
+    can't be read, e.g. because LabVIEW crashed while writing it, reports none.
+
+    :param diffs: Tuples of the form (old_vi, new_vi, output_dir); old_vi is None for added VIs
+    :param opsdir: The directory containing DiffVIBatch operation
+    :param lv_version: The year version of LabVIEW to use for diffing
+    :param lv_exe: (optional) The LabVIEW executable to diff in
+    :return: The parsed results, as a dict of new_vi to result
+    """
+    check_batch_operation(opsdir)
+    with tempfile.TemporaryDirectory() as batch_dir:
+        manifest_path = path.join(batch_dir, "manifest.json")
+        results_path = path.join(batch_dir, "results.json")
+        with open(manifest_path, "w") as f:
+            json.dump({"diffs": [
+                {"old_vi": old_vi or "", "new_vi": new_vi, "output_dir": output_dir}
+                for old_vi, new_vi, output_dir in diffs
+            ]}, f, indent=2)
+
+        command_args = [
+            gcli_executable(),
+            "--lv-ver", lv_version,
+            "--x64",
+            *labview_exe_args(lv_exe),
+            f"{opsdir}\\DiffVIBatch.vi",
+            "--",
+            "-Manifest", manifest_path,
+            "-Results", results_path,
+        ]
+        try:
+            with timing.span("g-cli batch", vis=len(diffs)):
+                subprocess.check_call(command_args)
+        except subprocess.CalledProcessError:
+            print("Batch diff exited with an error; checking results for individual VIs.")
+            traceback.print_exc()
+
+        results = {}
+        if path.exists(results_path):
+            try:
+                with open(results_path, "r") as f:
+                    results = {result["new_vi"]: result for result in json.load(f)["results"]}
+            except ValueError:
+                # LabVIEW died while writing it; every VI is reported as having no result.
+                print("Batch results file is incomplete; ignoring it.")
+
+    for old_vi, new_vi, output_dir in diffs:
+        result = results.get(new_vi)
+        if result is None or not result["ok"]:
+            error = result.get("error", "") if result else "no result reported"
+            print('Failed to diff "{0}" and "{1}": {2}'.format(old_vi, new_vi, error))
+            record_failure(output_dir, new_vi, error)
+    return results
 
 
 def labview_path_from_year(year):
@@ -93,67 +263,683 @@ def export_repo(target_ref):
     return directory
 
 
+def export_blobs(target_ref, filenames):
+    """
+    Export only the given files, as they are at a given ref, to a temporary directory.
+
+    The blobs are streamed out of a single `git cat-file --batch` process, so the
+    cost is proportional to the size of the files rather than the size of the repository.
+    Files which don't exist at the ref are skipped.
+
+    :param target_ref: The ref you want to export, e.g. `origin/main`
+    :param filenames: Repository-relative paths of the files to export
+    :return: A temporaryfile.TemporaryDirectory containing the files at the given ref
+    """
+    directory = tempfile.TemporaryDirectory()
+    with subprocess.Popen(["git", "cat-file", "--batch"],
+                          stdin=subprocess.PIPE, stdout=subprocess.PIPE) as git:
+        for filename in filenames:
+            git.stdin.write("{0}:{1}\n".format(target_ref, filename).encode("utf-8"))
+            git.stdin.flush()
+            header = git.stdout.readline().decode("utf-8").split()
+            if len(header) != 3 or header[1] != "blob":
+                print("Not found in {0}: {1}".format(target_ref, filename))
+                continue
+            data = git.stdout.read(int(header[2]))
+            git.stdout.read(1)  # Trailing newline after the object contents.
+
+            exported = path.join(directory.name, filename)
+            os.makedirs(path.dirname(exported), exist_ok=True)
+            with open(exported, "wb") as f:
+                f.write(data)
+        git.stdin.close()
+
+    return directory
+
+
+def directory_size(directory):
+    """Total size in bytes of the files under a directory."""
+    total = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            total += path.getsize(path.join(root, name))
+    return total
+
+
+def export_target(target_ref, filenames, strategy):
+    """
+    Export the old versions of changed files using the given strategy, reporting what it cost.
+
+    :param target_ref: The ref you want to export, e.g. `origin/main`
+    :param filenames: Repository-relative paths of the files which will be diffed against the ref
+    :param strategy: "full" to copy the repository and check out the ref, or "blobs" to export only `filenames`
+    :return: A temporaryfile.TemporaryDirectory containing the files at the given ref
+    """
+    start = time.perf_counter()
+    with timing.span("export", strategy=strategy):
+        if strategy == "blobs":
+            directory = export_blobs(target_ref, filenames)
+        else:
+            directory = export_repo(target_ref)
+    elapsed = time.perf_counter() - start
+    size = directory_size(directory.name)
+    timing.count("export_bytes", size)
+    print("Exported {0} with '{1}' strategy in {2:.1f}s ({3} bytes)".format(
+        target_ref, strategy, elapsed, size))
+    return directory
+
+
+def get_labview_changes(target_ref, ignorefile):
+    """
+    Get LabVIEW files which have changed compared to the target ref, with the files they were renamed or copied from.
+
+    :param target_ref: The git ref to check for changed files against
+    :param ignorefile: (optional) File of patterns to ignore, see changeset.IgnoreRules
+    :return: Tuples of the form (status, filename, source, identical), see changeset.get_changes
+    """
+    rules = changeset.IgnoreRules.from_file(ignorefile)
+    if rules.patterns:
+        print("Ignore file: " + ignorefile)
+        print("Patterns to ignore:")
+        print(rules.patterns)
+
+    return changeset.get_labview_changes(target_ref, rules)
+
+
 def get_changed_labview_files(target_ref, ignorefile):
     """
     Get LabVIEW files which have changed compared to the target ref.
 
     :param target_ref: The git ref to check for changed files against
-    :param patterns_to_ignore: (optional) List of file patterns to ignore
-    :return: Tuples of the form (status, filename) where status is either "A" or "M", depending on whether the file was added or modified.
+    :param ignorefile: (optional) File of patterns to ignore, see changeset.IgnoreRules
+    :return: Tuples of the form (status, filename) where status is "A", "M", "R" or "C", depending on whether the file was added, modified, renamed or copied.
+    """
+    for status, filename, _, _ in get_labview_changes(target_ref, ignorefile):
+        yield status, filename
+
+
+def split_identical_renames(diffs, sources, identical, dependents=()):
+    """
+    Separate files which were renamed or copied without changing from the changes to diff.
+
+    Their diff would show the same VI twice, so they don't need LabVIEW. VIs which
+    show a changed control are always diffed, as in split_compile_only.
+
+    :param diffs: Tuples of the form (status, filename) from get_changed_labview_files
+    :param sources: Maps renamed and copied files to the file they came from
+    :param identical: The renamed and copied files whose content is unchanged
+    :param dependents: (optional) The VIs which show a changed control, see expand_dependents
+    :return: The (status, filename) tuples to diff, and (source, filename) tuples of the unchanged renames and copies
+    """
+    to_diff = []
+    renamed = []
+    for status, filename in diffs:
+        if status in ("R", "C") and filename in identical and filename not in dependents:
+            print("Renamed or copied without changes: {0} -> {1}".format(sources[filename], filename))
+            renamed.append((sources[filename], filename))
+        else:
+            to_diff.append((status, filename))
+    return to_diff, renamed
+
+
+def record_renamed(output_dir, renamed):
+    """Log files which weren't diffed because they were renamed or copied without changes to {output_dir}/renamed.txt."""
+    if not renamed:
+        return
+    timing.count("identical_renames", len(renamed))
+    with open(path.join(output_dir, "renamed.txt"), "a+") as file:
+        for source, filename in renamed:
+            file.write("{0}\t{1}\n".format(source, filename))
+
+
+def old_filenames(diffs, sources):
+    """The paths in the target ref of the old versions of the (status, filename) diffs, for export_target."""
+    filenames = []
+    for status, filename in diffs:
+        if status == "M":
+            filenames.append(filename)
+        elif status in ("R", "C"):
+            filenames.append(sources[filename])
+    return filenames
+
+
+def stage_old_vi(export_dir, filename):
+    """
+    Copy the old version of a VI next to itself under a `_COPY_` name.
+
+    LabVIEW won't let us load two files with the same name into memory,
+    so we copy the old file to have a new name. This isn't perfect - the VIs
+    it references will still pull in the new versions of dependencies - but it
+    is better than nothing.
+
+    :param export_dir: The directory containing the exported target ref
+    :param filename: The repository-relative path of the VI
+    :return: The path of the staged copy
+    """
+    old_file = path.join(export_dir, filename)
+    copied_file = path.join(
+        path.dirname(old_file), "_COPY_" + path.basename(filename)
+    )
+    shutil.copy(old_file, copied_file)
+    return copied_file
+
+
+def stage_source(export_dir, source, filename):
     """
-    print("Ignore file:" + ignorefile)
-    changed_files = get_changed_files(target_ref)
+    Copy the file a VI was renamed or copied from to the VI's own path in the exported target ref.
 
-    # https://regex101.com/r/W3riqw/1
-    diff_regex = re.compile(r"^(.*\.vi[tm]?)$", re.MULTILINE)
-    if ignorefile:
-        with open(ignorefile,'r') as f:
-            patterns_to_ignore = [line.strip() for line in f.readlines()]
-        if patterns_to_ignore:
-            # https://regex101.com/r/2LhuWP/1
-            print("Patterns to ignore:")
-            print(patterns_to_ignore)
-            diff_regex = re.compile(r'^(?!.*({}))(.*\.vi[tm]?)$'.format('|'.join(patterns_to_ignore)), re.MULTILINE)
+    The VI can then be diffed against its source like a modified VI.
+
+    :param export_dir: The directory containing the exported target ref
+    :param source: The repository-relative path of the source, or None
+    :param filename: The repository-relative path of the renamed or copied VI
+    :return: Whether the source was found
+    """
+    old_file = path.join(export_dir, source) if source else None
+    if old_file is None or not path.isfile(old_file):
+        return False
+    staged_file = path.join(export_dir, filename)
+    os.makedirs(path.dirname(staged_file), exist_ok=True)
+    shutil.copy(old_file, staged_file)
+    return True
 
-    for status, filename in changed_files:
-        if re.match(diff_regex, filename):
-            yield status, filename
 
+def plan_diffs(diffs, export_dir, sources=None):
+    """
+    Turn changed files into diff tasks.
 
-def diff_repo(lv_version, workspace, output_dir, target_branch, ignorefile):
-    diffs = get_changed_labview_files(target_branch, ignorefile)
+    Renamed and copied files are staged from their source with stage_source. If
+    their source isn't in the export, they are diffed as added files.
 
-    directory = export_repo(target_branch)
+    :param diffs: Tuples of the form (status, filename) from get_changed_labview_files
+    :param export_dir: The directory containing the exported target ref
+    :param sources: (optional) Maps renamed and copied files to the file they came from
+    :return: A list of (status, filename) tuples in the order they should be diffed
+    """
+    sources = sources or {}
+    tasks = []
     for status, filename in diffs:
-        if status == "A":
-            print("Diffing added file: " + filename)
-            diff_vi(
-                None,
-                path.abspath(filename),
-                path.abspath(output_dir),
-                workspace,
-                lv_version,
-            )
-        elif status == "M":
-            print("Diffing modified file: " + filename)
-            # LabVIEW won't let us load two files with the same name into memory,
-            # so we copy the old file to have a new name. This isn't perfect - the VIs
-            # it references will still pull in the new versions of dependencies - but it
-            # is better than nothing.
-            old_file = path.join(directory.name, filename)
-            copied_file = path.join(
-                path.dirname(old_file), "_COPY_" + path.basename(filename)
-            )
-            shutil.copy(old_file, copied_file)
-            diff_vi(
-                copied_file,
-                path.abspath(filename),
-                path.abspath(output_dir),
-                workspace,
-                lv_version,
-            )
+        if status in ("R", "C") and not stage_source(export_dir, sources.get(filename), filename):
+            print("Source of {0} not found, diffing it as an added file".format(filename))
+            status = "A"
+        if status in ("A", "M", "R", "C"):
+            tasks.append((status, filename))
         else:
             print("Unknown file status: " + filename)
+    return tasks
+
+
+def split_compile_only(tasks, export_dir, dependents=()):
+    """
+    Separate modified VIs whose front panel, block diagram and connector pane are unchanged.
+
+    Such VIs were only recompiled or re-saved, and would diff as identical, so
+    they don't need LabVIEW. See rsrc.visual_digest. VIs which show a changed
+    control are always diffed: their own resources don't change with the control.
+
+    :param tasks: The (status, filename) tuples to diff
+    :param export_dir: The directory containing the exported target ref
+    :param dependents: (optional) The VIs which show a changed control, see expand_dependents
+    :return: The tasks which still need diffing, and the filenames with no visual change
+    """
+    to_diff = []
+    unchanged = []
+    for status, filename in tasks:
+        if status in ("M", "R", "C") and filename not in dependents and \
+                rsrc.same_visual(path.join(export_dir, filename), filename):
+            print("No visual change: " + filename)
+            unchanged.append(filename)
+        else:
+            to_diff.append((status, filename))
+    return to_diff, unchanged
+
+
+def record_no_visual_change(output_dir, filenames):
+    """Log VIs which weren't diffed because they have no visual change to {output_dir}/no_visual_change.txt."""
+    if not filenames:
+        return
+    timing.count("no_visual_change", len(filenames))
+    with open(path.join(output_dir, "no_visual_change.txt"), "a+") as file:
+        for filename in filenames:
+            file.write(filename + "\n")
+
+
+def diff_cache_key(old_vi, new_vi, opsdir, lv_version, controls=()):
+    # new_vi is always the VI in the working tree, which is the root of the repository.
+    name = path.relpath(new_vi).replace(os.sep, "/")
+    return diffcache.cache_key(old_vi, new_vi, name, lv_version, diffcache.diffvi_version(opsdir), controls)
+
+
+def cached_diff_vi(cache, old_vi, new_vi, output_dir, opsdir, lv_version, timeout=None, lv_exe=None, controls=()):
+    """Generates a diff of LabVIEW VIs, reusing a cached result when there is one.
+
+    Successful diffs are stored in the cache; failures are not, so they are retried next run.
+
+    :param cache: A diffcache.DiffCache
+    :param old_vi: The older version of the VI; if bool(vi1) is false, the VI is assumed to be newly added
+    :param new_vi: The newer version of the VI
+    :param output_dir: The directory in which to store output
+    :param opsdir: The directory containing DiffVI operation
+    :param lv_version: The year version of LabVIEW to use for diffing
+    :param timeout: (optional) Seconds to wait for the diff, see diff_vi
+    :param lv_exe: (optional) The LabVIEW executable to diff in, see diff_vi
+    :param controls: (optional) Changed controls and typedefs the VI shows, which are part of the cache key
+    """
+    key = diff_cache_key(old_vi, new_vi, opsdir, lv_version, controls)
+    if cache.fetch(key, output_dir):
+        print("Using cached diff for: " + new_vi)
+        return
+
+    staging_dir = tempfile.mkdtemp(dir=output_dir, prefix="_cache_")
+    diff_vi(old_vi, new_vi, staging_dir, opsdir, lv_version, timeout, lv_exe)
+    if not path.exists(path.join(staging_dir, "diff_failures.txt")):
+        cache.store(key, staging_dir)
+    merge_worker_output(staging_dir, output_dir)
+
+
+def resolve_task(task, export_dir):
+    """
+    Get the (old_vi, new_vi) paths to diff for a (status, filename) task.
+
+    Modified files, and renamed and copied files staged by plan_diffs, are staged
+    from export_dir into a `_COPY_` file first.
+    """
+    status, filename = task
+    if status == "A":
+        print("Diffing added file: " + filename)
+        return None, path.abspath(filename)
+    elif status in ("M", "R", "C"):
+        print("Diffing {0} file: {1}".format({"M": "modified", "R": "renamed", "C": "copied"}[status], filename))
+        return stage_old_vi(export_dir, filename), path.abspath(filename)
+    return None
+
+
+def run_diff_task(task, export_dir, output_dir, workspace, lv_version, cache=None, timeout=None, lv_exe=None,
+                  controls=None):
+    """
+    Diff a single (status, filename) task into output_dir, in the LabVIEW lv_exe if one is given.
+
+    controls maps VIs to the changed controls they show, from expand_dependents, for the cache key.
+    """
+    status, filename = task
+    with timing.span("diff_vi", vi=filename, status=status):
+        resolved = resolve_task(task, export_dir)
+        if resolved is None:
+            return
+        old_vi, new_vi = resolved
+        timing.count("vi_bytes_read", file_size(new_vi) + (file_size(old_vi) if old_vi else 0))
+
+        if cache is None:
+            diff_vi(old_vi, new_vi, path.abspath(output_dir), workspace, lv_version, timeout, lv_exe)
+        else:
+            cached_diff_vi(cache, old_vi, new_vi, path.abspath(output_dir), workspace, lv_version, timeout, lv_exe,
+                           (controls or {}).get(filename, ()))
+
+
+def run_diff_batch(tasks, export_dir, output_dir, workspace, lv_version, cache=None, lv_exe=None, controls=None):
+    """
+    Diff tasks in a single LabVIEW session with diff_vis_batch.
+
+    Cached diffs are taken from the cache and left out of the batch. Every other
+    task gets its own output directory in the manifest, which is merged back into
+    output_dir in task order once the batch has finished.
+
+    :param tasks: The (status, filename) tuples to diff
+    :param export_dir: The directory containing the exported target ref
+    :param output_dir: The directory in which to store output
+    :param workspace: The directory containing DiffVIBatch operation
+    :param lv_version: The year version of LabVIEW to use for diffing
+    :param cache: (optional) A diffcache.DiffCache to reuse diffs from
+    :param lv_exe: (optional) The LabVIEW executable to diff in
+    :param controls: (optional) Maps VIs to the changed controls they show, for the cache key
+    """
+    controls = controls or {}
+    output_dir = path.abspath(output_dir)
+    pending = []
+    for task in tasks:
+        resolved = resolve_task(task, export_dir)
+        if resolved is None:
+            continue
+        old_vi, new_vi = resolved
+        key = None
+        if cache is not None:
+            key = diff_cache_key(old_vi, new_vi, workspace, lv_version, controls.get(task[1], ()))
+            if cache.fetch(key, output_dir):
+                print("Using cached diff for: " + new_vi)
+                continue
+        task_dir = tempfile.mkdtemp(dir=output_dir, prefix="_batch_")
+        pending.append((old_vi, new_vi, task_dir, key))
+
+    if pending:
+        diff_vis_batch([(old_vi, new_vi, task_dir) for old_vi, new_vi, task_dir, _ in pending],
+                       workspace, lv_version, lv_exe)
+
+    for _, _, task_dir, key in pending:
+        if key is not None and not path.exists(path.join(task_dir, "diff_failures.txt")):
+            cache.store(key, task_dir)
+        merge_worker_output(task_dir, output_dir)
+
+
+def gcli_durations(tasks, first_span=0):
+    """
+    Measure how long g-cli took to diff each task, for the shard history.
+
+    Cache hits are left out, since LabVIEW didn't diff them. The attempts of a
+    retried diff are added together.
+
+    :param tasks: The (status, filename) tuples that were diffed
+    :param first_span: (optional) The number of spans recorded before this run, which are left out
+    :return: Tuples of the form (filename, seconds, bytes)
+    """
+    filenames = {path.abspath(filename): filename for _, filename in tasks}
+    seconds = {}
+    for span in timing.recorder().spans[first_span:]:
+        if span["name"] == "g-cli" and span.get("vi") in filenames:
+            filename = filenames[span["vi"]]
+            seconds[filename] = seconds.get(filename, 0.0) + span["seconds"]
+    return [(filename, total, file_size(filename)) for filename, total in seconds.items()]
+
+
+def file_size(filename):
+    try:
+        return path.getsize(filename)
+    except OSError:
+        return 0
+
+
+def merge_worker_output(worker_dir, output_dir):
+    """
+    Move everything a worker produced into output_dir.
+
+    Failures are appended to {output_dir}/diff_failures.txt rather than overwriting it.
+    """
+    for name in sorted(os.listdir(worker_dir)):
+        src = path.join(worker_dir, name)
+        if name == "diff_failures.txt":
+            with open(src, "r") as f_in, open(path.join(output_dir, name), "a+") as f_out:
+                f_out.write(f_in.read())
+            os.remove(src)
+        else:
+            os.replace(src, path.join(output_dir, name))
+    os.rmdir(worker_dir)
+
+
+def run_diff_pool(tasks, export_dir, output_dir, workspace, lv_version, jobs, cache=None, timeout=None,
+                  labview_exes=None, controls=None, ordered=False):
+    """
+    Diff tasks with up to `jobs` concurrent g-cli invocations.
+
+    With labview_exes, each job has a LabVIEW executable of its own, which is
+    handed to whichever task that job is running, so no two diffs ever share a
+    LabVIEW instance. Without them, every job uses g-cli's default LabVIEW.
+
+    Each task gets its own output directory under output_dir so that concurrent
+    DiffVI runs cannot clobber each other's images or failure logs. Once every
+    task has finished, the per-task output is merged back into output_dir in task
+    order, so images and diff_failures.txt come out in the same order as a serial run.
+
+    Tasks are started largest VI first, so that the slowest diffs don't end up
+    running alone at the end while the other workers sit idle. If ordered, they
+    are started in the given order instead, e.g. grouped by dependencies.
+
+    :param tasks: The (status, filename) tuples to diff
+    :param export_dir: The directory containing the exported target ref
+    :param output_dir: The directory in which to store output
+    :param workspace: The directory containing DiffVI operation
+    :param lv_version: The year version of LabVIEW to use for diffing
+    :param jobs: The maximum number of concurrent diffs
+    :param cache: (optional) A diffcache.DiffCache to reuse diffs from
+    :param timeout: (optional) Seconds to wait for each diff, see diff_vi
+    :param labview_exes: (optional) One LabVIEW executable per job
+    :param controls: (optional) Maps VIs to the changed controls they show, for the cache key
+    :param ordered: Whether to start the tasks in order rather than largest first
+    """
+    instances = queue.Queue()
+    for lv_exe in labview_exes or [None] * jobs:
+        instances.put(lv_exe)
+
+    def run_in_instance(task, worker_dir):
+        lv_exe = instances.get()
+        try:
+            run_diff_task(task, export_dir, worker_dir, workspace, lv_version, cache, timeout, lv_exe, controls)
+        finally:
+            instances.put(lv_exe)
+
+    worker_dirs = [
+        path.join(output_dir, "_worker_{0}".format(i)) for i in range(len(tasks))
+    ]
+    for worker_dir in worker_dirs:
+        os.makedirs(worker_dir, exist_ok=True)
+
+    if ordered:
+        start_order = range(len(tasks))
+    else:
+        start_order = sorted(range(len(tasks)), key=lambda i: -file_size(tasks[i][1]))
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [
+            pool.submit(run_in_instance, tasks[i], worker_dirs[i])
+            for i in start_order
+        ]
+        for future in futures:
+            future.result()
+
+    for worker_dir in worker_dirs:
+        merge_worker_output(worker_dir, output_dir)
+
+
+def expand_dependents(diffs, target_ref, ignorefile, callers):
+    """
+    Add the VIs which show changed controls and typedefs to the changed files, grouped by their dependencies.
+
+    A typedef change doesn't change the VIs that use it, so they wouldn't be diffed
+    otherwise. The result is ordered so that VIs with the same dependencies are
+    diffed one after the other.
+
+    :param diffs: Tuples of the form (status, filename) from get_changed_labview_files
+    :param target_ref: The git ref to check for changed files against
+    :param ignorefile: (optional) File of patterns to ignore, see changeset.IgnoreRules
+    :param callers: A vihierarchy index of the working tree
+    :return: Tuples of the form (status, filename), and a dict mapping every VI which shows a changed
+             control, whether it changed itself or was added here, to the changed controls it shows
+    """
+    rules = changeset.IgnoreRules.from_file(ignorefile)
+    changed = [filename for _, filename in changeset.get_changed_files(target_ref)]
+    controls = vihierarchy.shown_controls(changed, callers)
+    already = {filename for _, filename in diffs}
+    dependents = sorted(
+        filename for filename in controls
+        if filename not in already and changeset.is_labview_file(filename) and not rules.ignores(filename))
+    if dependents:
+        print("Diffing {0} VIs which use changed controls:".format(len(dependents)))
+        print(dependents)
+
+    expanded = diffs + [("M", filename) for filename in dependents]
+    groups = vihierarchy.dependency_groups([filename for _, filename in expanded], callers)
+    return sorted(expanded, key=lambda diff: groups[diff[1]]), controls
+
+
+def git_rev_parse(ref):
+    return subprocess.check_output(["git", "rev-parse", ref]).decode("utf-8").strip()
+
+
+def git_merge_base(ref, other="HEAD"):
+    return subprocess.check_output(["git", "merge-base", ref, other]).decode("utf-8").strip()
+
+
+def git_changed_between(old_ref, new_ref):
+    """
+    Get the names of files which differ between two commits, or None if old_ref is no longer available.
+    """
+    if subprocess.call(["git", "cat-file", "-e", old_ref + "^{commit}"], stderr=subprocess.DEVNULL) != 0:
+        return None
+    diff_output = subprocess.check_output(["git", "diff", "--name-only", old_ref, new_ref]).decode("utf-8")
+    return set(diff_output.splitlines())
+
+
+def load_incremental_state(state_dir):
+    """
+    Load the state recorded by the last incremental run, or None if there wasn't one.
+
+    The state is {"head", "merge_base", "images"} where images maps each diffed
+    file to the names of its images, which are kept in {state_dir}/images.
+    """
+    try:
+        with open(path.join(state_dir, "state.json"), "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def select_incremental(diffs, state, head, merge_base, callers=None):
+    """
+    Split the changed files into those to diff again and those whose last diff can be carried forward.
+
+    Everything is diffed again if there is no state, or if the merge base with the
+    target changed, since then the old versions of the VIs may have changed too.
+    Otherwise only files changed since the last diffed head, and files which have
+    no images from the last run, are diffed again.
+
+    :param diffs: Tuples of the form (status, filename) from get_changed_labview_files
+    :param state: The state from load_incremental_state, or None
+    :param head: The commit being diffed
+    :param merge_base: The merge base of head and the target
+    :param callers: (optional) A vihierarchy index; VIs showing controls changed since the last run are diffed again
+    :return: A tuple of the (status, filename) tuples to diff, and the filenames to carry forward
+    """
+    if state is None or state["merge_base"] != merge_base:
+        return diffs, []
+    changed = git_changed_between(state["head"], head)
+    if changed is None:
+        return diffs, []
+    if callers is not None:
+        changed |= vihierarchy.affected_vis(changed, callers)
+
+    to_diff = []
+    carried = []
+    for status, filename in diffs:
+        if filename in changed or not state["images"].get(filename):
+            to_diff.append((status, filename))
+        else:
+            carried.append(filename)
+    return to_diff, carried
+
+
+def carry_forward(state_dir, state, filenames, output_dir):
+    """Copy the images of files which weren't diffed again from the last run into output_dir."""
+    for filename in filenames:
+        for name in state["images"][filename]:
+            shutil.copy(path.join(state_dir, "images", name), path.join(output_dir, name))
+
+
+def save_incremental_state(state_dir, head, merge_base, diffs, output_dir):
+    """Record the images in output_dir as the diffs of head, for the next incremental run."""
+    index = changeset.ChangeIndex(diffs)
+    images_dir = path.join(state_dir, "images")
+    shutil.rmtree(images_dir, ignore_errors=True)
+    os.makedirs(images_dir)
+
+    images = {}
+    for name in sorted(os.listdir(output_dir)):
+        filename = index.filename(name)
+        if filename is None or not path.isfile(path.join(output_dir, name)):
+            continue
+        shutil.copy(path.join(output_dir, name), path.join(images_dir, name))
+        images.setdefault(filename, []).append(name)
+
+    with open(path.join(state_dir, "state.json"), "w") as f:
+        json.dump({"head": head, "merge_base": merge_base, "images": images}, f, indent=2)
+
+
+def diff_repo(lv_version, workspace, output_dir, target_branch, ignorefile, jobs=1, cache=None,
+              export_strategy="full", batch=False, state_dir=None, dependency_index=None, timeout=None,
+              skip_compile_only=False, shard_index=0, shard_count=1, history=None, labview_exes=None):
+    if batch:
+        check_batch_operation(workspace)
+    # The recorder is shared by every run in this process, e.g. in the benchmark.
+    first_span = len(timing.recorder().spans)
+    with timing.span("changed_files"):
+        changes = get_labview_changes(target_branch, ignorefile)
+    all_diffs = [(status, filename) for status, filename, _, _ in changes]
+    sources = {filename: source for _, filename, source, _ in changes if source}
+    callers = None
+    controls = {}
+    if dependency_index is not None:
+        with timing.span("dependency_index"):
+            callers = vihierarchy.load_index(dependency_index)
+            all_diffs, controls = expand_dependents(all_diffs, target_branch, ignorefile, callers)
+    all_diffs, renamed = split_identical_renames(
+        all_diffs, sources, {filename for _, filename, _, identical in changes if identical}, controls)
+    if shard_index == 0:
+        # Every shard sees the same renames; only record them once.
+        record_renamed(output_dir, renamed)
+    diffs = all_diffs
+
+    if state_dir is not None:
+        os.makedirs(state_dir, exist_ok=True)
+        state = load_incremental_state(state_dir)
+        head = git_rev_parse("HEAD")
+        merge_base = git_merge_base(target_branch)
+        diffs, carried = select_incremental(all_diffs, state, head, merge_base, callers)
+        print("Incremental diff: {0} VIs changed since last run, {1} carried forward".format(
+            len(diffs), len(carried)))
+        carry_forward(state_dir, state, carried, output_dir)
+
+    if shard_count > 1:
+        diffs, plan = sharding.select_shard(diffs, shard_index, shard_count, history)
+        sharding.write_plan(output_dir, plan)
+
+    directory = export_target(target_branch, old_filenames(diffs, sources), export_strategy)
+    tasks = plan_diffs(diffs, directory.name, sources)
+    if skip_compile_only:
+        with timing.span("skip_compile_only"):
+            tasks, unchanged = split_compile_only(tasks, directory.name, controls)
+        record_no_visual_change(output_dir, unchanged)
+    lv_exe = labview_exes[0] if labview_exes else None
+    with timing.span("diff", vis=len(tasks)):
+        if batch:
+            run_diff_batch(tasks, directory.name, output_dir, workspace, lv_version, cache, lv_exe, controls)
+        elif jobs > 1 and len(tasks) > 1:
+            # Keep VIs grouped by their dependencies, if they were.
+            run_diff_pool(tasks, directory.name, output_dir, workspace, lv_version, jobs, cache, timeout,
+                          labview_exes, controls, ordered=callers is not None)
+        else:
+            for task in tasks:
+                run_diff_task(task, directory.name, output_dir, workspace, lv_version, cache, timeout, lv_exe,
+                              controls)
+
+    if not batch:
+        durations = gcli_durations(tasks, first_span)
+        if shard_count > 1:
+            # Shards only read the history, so that they all compute the same partition;
+            # the merge step records what they measured.
+            plan["durations"] = durations
+            sharding.write_plan(output_dir, plan)
+        elif history is not None:
+            history.record(durations)
+    if cache is not None:
+        print(cache.summary())
+        timing.count("diff_cache_hits", cache.hits)
+        timing.count("diff_cache_misses", cache.misses)
+    if state_dir is not None:
+        with timing.span("save_incremental_state"):
+            save_incremental_state(state_dir, head, merge_base, all_diffs, output_dir)
+
+
+def check_labview_exes(parser, labview_exes, jobs, timeout=None):
+    """
+    Check there is one --labview-exe per job, if any are given.
+
+    A timed out diff kills its LabVIEW; without an executable per job that would be
+    every job's LabVIEW, so --timeout with --jobs requires them.
+    """
+    if labview_exes and len(labview_exes) != jobs:
+        parser.error("--labview-exe must be given once per job ({0} given for --jobs {1})".format(
+            len(labview_exes), jobs))
+    if timeout and jobs > 1 and not labview_exes:
+        parser.error("--timeout with --jobs requires --labview-exe for each job, "
+                     "so that a hung diff only kills its own LabVIEW")
+    if jobs > 1 and not labview_exes:
+        print("Warning: --jobs {0} without --labview-exe; concurrent diffs will share one LabVIEW".format(jobs))
 
 
 parser = argparse.ArgumentParser(description="Generate LabVIEW diff images")
@@ -172,7 +958,85 @@ parser.add_argument(
 parser.add_argument(
     "--ignorefile", required=False,
     help="File containing a list of vi names to ignore, e.g. files created by the DQMH scripter")
+parser.add_argument(
+    "--jobs", type=int, default=1,
+    help="Number of VIs to diff concurrently; each job needs its own LabVIEW instance, see --labview-exe "
+         "(default: 1)")
+parser.add_argument(
+    "--labview-exe", action="append", default=[], metavar="PATH",
+    help="LabVIEW executable for one job, passed to g-cli as --lv-exe; give it once per --jobs. "
+         "Separate instances are usually copies of LabVIEW.exe with their own name and "
+         "AllowMultipleInstances=True in their .ini")
+parser.add_argument(
+    "--cache-dir", required=False,
+    help="Directory of a persistent diff cache, keyed on the content of the old and new VIs")
+parser.add_argument(
+    "--cache-max-mb", type=int, default=1024,
+    help="Size limit of the diff cache; least recently used diffs are evicted first (default: 1024)")
+parser.add_argument(
+    "--export-strategy", choices=["full", "blobs"], default="full",
+    help="How to export the target ref: copy the whole repository, or stream only the changed VIs "
+         "out of git (faster, but the old VIs can't load their old dependencies) (default: full)")
+parser.add_argument(
+    "--batch", action="store_true",
+    help="Diff all VIs in one g-cli invocation of DiffVIBatch.vi instead of launching g-cli per VI. "
+         "Requires the DiffVIBatch operation in --opdir, which isn't part of this repository")
+parser.add_argument(
+    "--state-dir", required=False,
+    help="Directory to keep incremental diff state in, one subdirectory per PR; requires --pr")
+parser.add_argument(
+    "--pr", required=False,
+    help="Pull request number; with --state-dir, only VIs changed since the PR's last diffed head are re-diffed")
+parser.add_argument(
+    "--dependency-index", required=False,
+    help="Directory to cache the VI dependency index in; VIs using changed controls and typedefs are diffed too, "
+         "and VIs sharing dependencies are diffed together")
+parser.add_argument(
+    "--timeout", type=float, required=False,
+    help="Seconds to wait for each VI diff; a hung LabVIEW is killed and the diff retried once "
+         "(not used with --batch; with --jobs, requires --labview-exe)")
+parser.add_argument(
+    "--skip-compile-only", action="store_true",
+    help="Don't diff modified VIs whose front panel, block diagram and connector pane are unchanged; "
+         "list them in no_visual_change.txt instead")
+parser.add_argument(
+    "--shard-index", type=int, default=0,
+    help="Which shard of the changed VIs this node diffs, from 0 (default: 0)")
+parser.add_argument(
+    "--shard-count", type=int, default=1,
+    help="Number of nodes the changed VIs are split across, balanced by estimated diff time; "
+         "merge their --diffdir with sharding.py (default: 1)")
+parser.add_argument(
+    "--history-db", required=False,
+    help="SQLite database of past diff durations per VI, used to balance shards; all shards must use the same "
+         "one. Unsharded runs record their durations in it, shards leave that to sharding.py")
+parser.add_argument(
+    "--report-json", required=False,
+    help="Write a JSON report of phase and per-VI durations, bytes read, retries and peak memory to this file")
 
 if __name__ == "__main__":
     args = parser.parse_args()
-    diff_repo(args.labview_version, args.opdir, args.diffdir, args.target, args.ignorefile)
+    if bool(args.state_dir) != bool(args.pr):
+        parser.error("--state-dir and --pr must be given together")
+    if not 0 <= args.shard_index < args.shard_count:
+        parser.error("--shard-index must be at least 0 and less than --shard-count")
+    if args.shard_count > 1 and args.state_dir:
+        parser.error("--state-dir can't be used with --shard-count")
+    check_labview_exes(parser, args.labview_exe, args.jobs, args.timeout)
+    if args.batch:
+        try:
+            check_batch_operation(args.opdir)
+        except FileNotFoundError as e:
+            parser.error(str(e))
+    state_dir = path.join(args.state_dir, "pr-" + args.pr) if args.state_dir else None
+    history = sharding.DurationHistory(args.history_db) if args.history_db else None
+    cache = None
+    if args.cache_dir:
+        cache = diffcache.DiffCache(args.cache_dir, args.cache_max_mb * 1024 * 1024)
+    diff_repo(args.labview_version, args.opdir, args.diffdir, args.target, args.ignorefile, args.jobs, cache,
+              args.export_strategy, args.batch, state_dir, args.dependency_index, args.timeout,
+              args.skip_compile_only, args.shard_index, args.shard_count, history, args.labview_exe)
+    if history is not None:
+        history.close()
+    if args.report_json:
+        timing.write_report(args.report_json, tool="diffvi", target=args.target, jobs=args.jobs)
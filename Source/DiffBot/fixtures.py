@@ -0,0 +1,62 @@
+"""Fixtures shared by the DiffBot tests, test_*.py in this directory.
+
+Run them all from here with `python -m unittest` or `python -m pytest`.
+"""
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from os import path
+from unittest import mock
+
+import benchmark
+
+# A real VI, for tests which read the resource fork.
+TEST_VI = path.join(path.dirname(path.abspath(__file__)), "..", "..", "Tests", "UT_CICD", "Test Paths.vi")
+
+
+class TestCase(unittest.TestCase):
+    """Gives each test an empty directory, self.directory, and hides what the code under test prints.
+
+    Tracebacks printed for handled errors are hidden too; subprocesses still print."""
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        stack = contextlib.ExitStack()
+        self.addCleanup(stack.close)
+        self.stdout = stack.enter_context(contextlib.redirect_stdout(io.StringIO()))
+        stack.enter_context(contextlib.redirect_stderr(io.StringIO()))
+
+    def chdir(self, directory: str):
+        """Change to directory for the rest of the test."""
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(directory)
+
+    def write(self, name: str, data: bytes = b"") -> str:
+        """Write a file under self.directory, creating its directories, and return its path."""
+        filename = path.join(self.directory, name)
+        os.makedirs(path.dirname(filename), exist_ok=True)
+        with open(filename, "wb") as f:
+            f.write(data)
+        return filename
+
+    def stub_gcli(self, latency: float = 0.0):
+        """Put benchmark's stub g-cli first on the PATH for the rest of the test.
+
+        Changes to the environment, such as the stub's GCLI_* settings, are undone after the test."""
+        environ = mock.patch.dict(os.environ)
+        environ.start()
+        self.addCleanup(environ.stop)
+        benchmark.install_stub_gcli(path.join(self.directory, "bin"), latency)
+
+    def copy_vi(self, name: str) -> str:
+        """Copy TEST_VI to name under self.directory and return its path."""
+        filename = path.join(self.directory, name)
+        os.makedirs(path.dirname(filename), exist_ok=True)
+        shutil.copy(TEST_VI, filename)
+        return filename
@@ -0,0 +1,100 @@
+"""Module imagedups finds identical and nearly identical diff images, so each is only uploaded once.
+
+Modules made by the DQMH scripter, and cloned VIs, often diff to the same
+image. Every image gets two hashes:
+
+* an exact digest, the SHA-256 of the file. Images with the same digest are
+  grouped, and only the first of each group is uploaded. The comment lists
+  every VI of the group under the one link.
+* a perceptual hash, the 64 bit difference hash of the image shrunk to 9x8
+  grays. Images whose hashes differ in only a few bits look alike but aren't
+  identical, so they are still uploaded; the comment flags them as similar.
+
+Images are hashed in parallel in a process pool. Perceptual hashes require
+Pillow, which is only imported when they are computed; without it only exact
+duplicates are found.
+"""
+import hashlib
+import typing
+from concurrent.futures import ProcessPoolExecutor
+
+
+def difference_hash(filename: str) -> int:
+    """64 bit difference hash: whether each pixel is brighter than its right neighbour, in a 9x8 thumbnail."""
+    from PIL import Image
+
+    with Image.open(filename) as image:
+        pixels = list(image.convert("L").resize((9, 8), Image.LANCZOS).getdata())
+    bits = 0
+    for row in range(8):
+        for column in range(8):
+            bits = bits << 1 | (pixels[row * 9 + column] > pixels[row * 9 + column + 1])
+    return bits
+
+
+def hash_image(filename: str, perceptual: bool = True) -> typing.Tuple[str, typing.Optional[int]]:
+    """(SHA-256 of the file, difference hash or None)."""
+    sha = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    phash = None
+    if perceptual:
+        try:
+            phash = difference_hash(filename)
+        except OSError:
+            # Not an image Pillow can read; it can still be an exact duplicate.
+            pass
+    return sha.hexdigest(), phash
+
+
+class ImageIndex:
+    """Identical and similar images among a set of images (name -> path)."""
+
+    def __init__(self, pngfiles: typing.Dict[str, str], max_distance: int = 4, jobs: typing.Optional[int] = None):
+        """
+        :param pngfiles: The images to index, name -> path
+        :param max_distance: Largest number of differing perceptual hash bits for images to count as similar
+        :param jobs: Number of processes to hash with
+        """
+        try:
+            import PIL  # noqa: F401
+            perceptual = True
+        except ImportError:
+            print("Pillow is not installed; only finding identical images")
+            perceptual = False
+
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            hashes = list(pool.map(hash_image, pngfiles.values(), [perceptual] * len(pngfiles)))
+
+        # Each group is the names of identical images; the first name is the one uploaded.
+        self.groups = {}
+        self.representative = {}
+        phashes = {}
+        for name, (digest, phash) in zip(pngfiles, hashes):
+            group = self.groups.setdefault(digest, [])
+            group.append(name)
+            self.representative[name] = group[0]
+            if len(group) == 1 and phash is not None:
+                phashes[name] = phash
+
+        # Similar images: the earlier image each unique image is closest to, within max_distance.
+        self.similar = {}
+        names = list(phashes)
+        for i, name in enumerate(names):
+            distances = [(bin(phashes[name] ^ phashes[other]).count("1"), other) for other in names[:i]]
+            close = [(distance, other) for distance, other in distances if distance <= max_distance]
+            if close:
+                self.similar[name] = min(close)[1]
+
+    def unique(self, pngfiles: typing.Dict[str, str]) -> typing.Dict[str, str]:
+        """The images to upload: the first of each group of identical images."""
+        return {name: pngpath for name, pngpath in pngfiles.items() if self.representative[name] == name}
+
+    def urls(self, uploaded: typing.Dict[str, str]) -> typing.Dict[str, str]:
+        """Give every image the URL its group's uploaded image got, in the order images were indexed."""
+        return {name: uploaded[representative] for name, representative in self.representative.items()}
+
+    def summary(self) -> str:
+        return (f"Images: {len(self.representative)}, unique: {len(self.groups)}, "
+                f"similar to another: {len(self.similar)}")
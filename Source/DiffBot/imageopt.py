@@ -0,0 +1,74 @@
+"""Module imageopt shrinks diff images before they are uploaded.
+
+DiffVI renders full resolution screenshots of the front panel and block
+diagram, which are slow to upload and slow to load in the PR. Each image can be
+losslessly recompressed, downscaled to a maximum dimension, and converted to
+WebP. Images are processed in parallel in a process pool.
+
+Requires Pillow (`pip install Pillow`), which is only imported when the stage is used.
+"""
+import os
+import time
+import typing
+from concurrent.futures import ProcessPoolExecutor
+
+
+def optimize_image(src: str, out_dir: str, max_dimension: int = 0,
+                   webp: bool = False) -> typing.Tuple[str, int, int, float]:
+    """Recompress a PNG into out_dir.
+
+    :param src: The PNG to optimize
+    :param out_dir: The directory to write the optimized image to
+    :param max_dimension: If non-zero, downscale so neither side is larger than this
+    :param webp: Write a lossless WebP instead of a PNG
+    :return: (path of the optimized image, bytes before, bytes after, seconds taken)
+    """
+    from PIL import Image
+
+    start = time.perf_counter()
+    stem = os.path.splitext(os.path.basename(src))[0]
+    dst = os.path.join(out_dir, stem + (".webp" if webp else ".png"))
+    with Image.open(src) as image:
+        if max_dimension and max(image.size) > max_dimension:
+            image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+        if webp:
+            image.save(dst, "WEBP", lossless=True, method=6)
+        else:
+            image.save(dst, "PNG", optimize=True)
+
+    before = os.path.getsize(src)
+    after = os.path.getsize(dst)
+    if not webp and not max_dimension and after >= before:
+        # Recompression didn't help; keep the original bytes.
+        with open(src, "rb") as f_in, open(dst, "wb") as f_out:
+            f_out.write(f_in.read())
+        after = before
+    return dst, before, after, time.perf_counter() - start
+
+
+def optimize_images(pngfiles: typing.Dict[str, str], out_dir: str, max_dimension: int = 0,
+                    webp: bool = False, jobs: typing.Optional[int] = None) -> typing.Dict[str, str]:
+    """Optimize images (name -> path) in parallel, writing the results to out_dir.
+
+    Logs the size before and after and the time taken for each image, and the total saved.
+    Returns a dict of optimized image name to path, in the same order as pngfiles."""
+    try:
+        import PIL  # noqa: F401
+    except ImportError:
+        raise ImportError("Image optimization requires Pillow: pip install Pillow")
+
+    optimized = {}
+    total_before = 0
+    total_after = 0
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(optimize_image, src, out_dir, max_dimension, webp)
+                   for src in pngfiles.values()]
+        for name, future in zip(pngfiles, futures):
+            dst, before, after, seconds = future.result()
+            print(f"Optimized {name}: {before} -> {after} bytes in {seconds:.2f}s")
+            optimized[os.path.basename(dst)] = dst
+            total_before += before
+            total_after += after
+    print(f"Image optimization saved {total_before - total_after} bytes "
+          f"({total_before} -> {total_after})")
+    return optimized
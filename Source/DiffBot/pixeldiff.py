@@ -0,0 +1,169 @@
+"""Module pixeldiff crops diff images down to what changed, and drops images where nothing did.
+
+DiffVI renders a modified VI as one image with two columns: the old VI's
+screenshots on the left and the new VI's on the right. Reviewers have to scan
+the whole image to find a moved wire. This stage:
+
+1. Splits the image at the widest run of background columns between the
+   halves, and trims the margins of each half.
+2. Compares the halves as NumPy arrays to find the changed-pixel mask.
+3. Finds bounding boxes around the changes: changed rows are grouped into
+   bands, with gaps narrower than the padding merged, and each band is
+   bounded by its changed columns.
+4. Writes the padded boxes of both halves side by side, with the changed
+   pixels of the new half highlighted.
+
+If the halves are identical, nothing visible changed, and the image is dropped.
+Images of added VIs have no old column and are left alone. Images are processed
+in parallel in a process pool.
+
+Requires NumPy and Pillow (`pip install numpy Pillow`), which are only imported
+when the stage is used.
+"""
+import os
+import time
+import typing
+from concurrent.futures import ProcessPoolExecutor
+
+# Color and opacity of the highlight drawn over changed pixels.
+HIGHLIGHT = (255, 0, 0)
+HIGHLIGHT_ALPHA = 0.5
+# Width of the gap between the old and new crops.
+GUTTER = 8
+
+
+def split_columns(image):
+    """Split a two-column image at the widest run of background columns in its middle third.
+
+    The margins of each column are trimmed, so that screenshots which are in the
+    same place in both columns line up.
+
+    :param image: An (height, width, 3) array; the top-left pixel is taken as the background
+    :return: The (left, right) arrays, padded with background to the same size, or None if there's no separator
+    """
+    import numpy as np
+
+    background = image[0, 0]
+    blank = (image == background).all(axis=(0, 2))
+    width = image.shape[1]
+    middle = blank[width // 3:2 * width // 3]
+    # Edges of the runs of blank columns in the middle third.
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], middle.view(np.int8), [0]))))
+    if len(edges) == 0:
+        return None
+    starts, ends = edges[::2], edges[1::2]
+    widest = np.argmax(ends - starts)
+    start = width // 3 + starts[widest]
+    end = width // 3 + ends[widest]
+
+    def trim(first, last):
+        # Drop the margins, so both columns start at their first screenshot.
+        content = np.flatnonzero(~blank[first:last])
+        return image[:, first + content[0]:first + content[-1] + 1] if len(content) else image[:, first:first]
+
+    left = trim(0, start)
+    right = trim(end, width)
+    padded_width = max(left.shape[1], right.shape[1])
+
+    def pad(half):
+        filler = np.empty((half.shape[0], padded_width - half.shape[1], 3), dtype=image.dtype)
+        filler[:] = background
+        return np.concatenate((half, filler), axis=1)
+
+    return pad(left), pad(right)
+
+
+def bounding_boxes(mask, padding: int) -> typing.List[typing.Tuple[int, int, int, int]]:
+    """Padded (top, bottom, left, right) boxes around the True pixels of a mask.
+
+    Changed rows closer than twice the padding are grouped into one band, and
+    each band is bounded by the columns which change within it."""
+    import numpy as np
+
+    height, width = mask.shape
+    rows = np.flatnonzero(mask.any(axis=1))
+    if len(rows) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(rows) > 2 * padding)
+    boxes = []
+    for band in np.split(rows, breaks + 1):
+        top, bottom = band[0], band[-1] + 1
+        columns = np.flatnonzero(mask[top:bottom].any(axis=0))
+        boxes.append((max(0, top - padding), min(height, bottom + padding),
+                      max(0, columns[0] - padding), min(width, columns[-1] + 1 + padding)))
+    return boxes
+
+
+def pixel_diff(src: str, out_dir: str, padding: int = 16, threshold: int = 0
+               ) -> typing.Tuple[typing.Optional[str], int, int, float]:
+    """Crop a two-column diff image to its changes.
+
+    :param src: The diff image
+    :param out_dir: The directory to write the cropped image to
+    :param padding: Pixels of context to keep around each change
+    :param threshold: Largest per-channel difference which doesn't count as a change, for antialiasing noise
+    :return: (path of the cropped image, or None if nothing changed, bytes before, bytes after, seconds taken).
+             If the image can't be split into columns, the original is returned.
+    """
+    import numpy as np
+    from PIL import Image
+
+    start = time.perf_counter()
+    before = os.path.getsize(src)
+    with Image.open(src) as image:
+        pixels = np.asarray(image.convert("RGB"))
+    halves = split_columns(pixels)
+    if halves is None:
+        return src, before, before, time.perf_counter() - start
+    old, new = halves
+
+    mask = (np.abs(old.astype(np.int16) - new.astype(np.int16)) > threshold).any(axis=2)
+    boxes = bounding_boxes(mask, padding)
+    if not boxes:
+        return None, before, 0, time.perf_counter() - start
+
+    highlighted = new.astype(np.float32)
+    highlighted[mask] = highlighted[mask] * (1 - HIGHLIGHT_ALPHA) + np.array(HIGHLIGHT) * HIGHLIGHT_ALPHA
+    highlighted = highlighted.astype(np.uint8)
+
+    background = pixels[0, 0]
+    crop_width = max(right - left for _, _, left, right in boxes)
+    rows = []
+    for top, bottom, left, right in boxes:
+        row = np.empty((bottom - top + GUTTER, 2 * crop_width + GUTTER, 3), dtype=np.uint8)
+        row[:] = background
+        row[:bottom - top, :right - left] = old[top:bottom, left:right]
+        row[:bottom - top, crop_width + GUTTER:crop_width + GUTTER + right - left] = highlighted[top:bottom, left:right]
+        rows.append(row)
+    dst = os.path.join(out_dir, os.path.basename(src))
+    Image.fromarray(np.concatenate(rows)[:-GUTTER]).save(dst, "PNG", optimize=True)
+    return dst, before, os.path.getsize(dst), time.perf_counter() - start
+
+
+def pixel_diff_images(pngfiles: typing.Dict[str, str], out_dir: str, padding: int = 16, threshold: int = 0,
+                      jobs: typing.Optional[int] = None) -> typing.Dict[str, str]:
+    """Crop images (name -> path) to their changes in parallel, writing the results to out_dir.
+
+    Logs the size before and after and the time taken for each image. Returns a
+    dict of name to path in the same order as pngfiles, without the images in
+    which nothing changed."""
+    try:
+        import numpy  # noqa: F401
+        import PIL  # noqa: F401
+    except ImportError:
+        raise ImportError("Pixel diffs require NumPy and Pillow: pip install numpy Pillow")
+
+    cropped = {}
+    dropped = []
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(pixel_diff, src, out_dir, padding, threshold) for src in pngfiles.values()]
+        for name, future in zip(pngfiles, futures):
+            dst, before, after, seconds = future.result()
+            if dst is None:
+                print(f"Dropped {name}: no pixels changed ({seconds:.2f}s)")
+                dropped.append(name)
+                continue
+            print(f"Cropped {name}: {before} -> {after} bytes in {seconds:.2f}s")
+            cropped[name] = dst
+    print(f"Pixel diff dropped {len(dropped)} of {len(pngfiles)} images")
+    return cropped
@@ -0,0 +1,86 @@
+"""Module responsecache keeps GitHub API responses on disk between runs.
+
+Retried jobs and jobs running for the same PR ask GitHub the same questions.
+Entries are stored with the time they were fetched and, for REST responses,
+their ETag, so that they can be reused outright while they are younger than
+the TTL and revalidated with a conditional request once they are older.
+
+Entries are stored as JSON, one file per key. The cache directory is often
+restored from a CI cache shared with other jobs, so loading an entry must never
+run code; JSON can only produce data. The PR features also contain datetimes,
+stored as ISO 8601 strings, and Counters, stored as objects of counts. Each is
+tagged so it is restored as the same type.
+"""
+import collections
+import datetime
+import hashlib
+import json
+import os
+import tempfile
+import time
+import typing
+from os import path
+
+
+def _encode(value):
+    """Convert a value to plain JSON, tagging datetimes and Counters so _decode can restore them."""
+    if isinstance(value, datetime.datetime):
+        return {"$datetime": value.isoformat()}
+    if isinstance(value, collections.Counter):
+        return {"$counter": dict(value)}
+    if isinstance(value, dict):
+        return {key: _encode(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_encode(item) for item in value]
+    return value
+
+
+def _decode(value: dict):
+    if value.keys() == {"$datetime"}:
+        return datetime.datetime.fromisoformat(value["$datetime"])
+    if value.keys() == {"$counter"}:
+        return collections.Counter(value["$counter"])
+    return value
+
+
+class ResponseCache:
+    """On-disk cache of values keyed by string, with a time to live."""
+
+    def __init__(self, directory: str, ttl: float, offline: bool = False):
+        """
+        :param directory: The directory to keep entries in
+        :param ttl: Seconds an entry may be used without revalidating it
+        :param offline: Use entries regardless of their age and never touch the network
+        """
+        self.directory = directory
+        self.ttl = ttl
+        self.offline = offline
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return path.join(self.directory, hashlib.sha256(key.encode()).hexdigest() + ".json")
+
+    def get(self, key: str) -> typing.Optional[dict]:
+        """Get an entry of the form {"time", "value", ...}, or None if there isn't one."""
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                entry = json.load(f, object_hook=_decode)
+        except (FileNotFoundError, ValueError):
+            return None
+        return entry if isinstance(entry, dict) and "time" in entry and "value" in entry else None
+
+    def fresh(self, entry: typing.Optional[dict]) -> bool:
+        """Whether an entry can be used without asking the network."""
+        return entry is not None and (self.offline or time.time() - entry["time"] < self.ttl)
+
+    def put(self, key: str, value, **meta):
+        """Store a value, with any extra metadata such as an ETag, replacing the old entry."""
+        entry = dict(meta, time=time.time(), value=value)
+        fd, staging = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(_encode(entry), f)
+        os.replace(staging, self._path(key))
+
+    def touch(self, key: str, entry: dict):
+        """Mark an entry as just revalidated."""
+        self.put(key, **entry)
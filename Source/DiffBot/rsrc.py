@@ -0,0 +1,113 @@
+"""Module rsrc reads the resource fork of LabVIEW files, to tell visual changes from recompiles.
+
+VIs, controls and templates are stored in the RSRC format: a header, the
+resource data, and a table of resources, each identified by a four character
+type, such as FPHb for the front panel heap, and an index. LabVIEW rewrites
+the save metadata of a VI whenever it recompiles or re-saves it, even when the
+front panel and block diagram haven't changed. That metadata includes the
+version (vers, LVSR), the modification ID (MUID), the history (HIST), the link
+information (LI*), the password hash (BDPW) and the compiled code (VICD). Diffing
+such a VI in LabVIEW only renders two identical images.
+
+`visual_digest` hashes only the resources which appear in a diff image, so two
+VIs with the same digest can be reported as "no visual change" without
+launching LabVIEW. Files are memory-mapped, so only the table and the hashed
+resources are read. Anything unexpected in a file raises FormatError, and
+callers should fall back to diffing in LabVIEW.
+"""
+import hashlib
+import mmap
+import struct
+import typing
+
+# Resources which appear in a diff image: the front panel and block diagram
+# heaps and their extra data, the connector pane, the type descriptors and
+# default data the controls are drawn from, the icon and the font table.
+VISUAL_RESOURCES = frozenset({
+    "FPHb", "FPHx", "FPHc", "FPEx",
+    "BDHb", "BDHx", "BDHc", "BDEx",
+    "CONP", "CPC2", "VCTP", "DFDS", "DSIM",
+    "ICON", "icl4", "icl8", "FTAB",
+})
+# Every VI and control has a front panel and block diagram heap. Without them
+# the digest would only cover the icon and types, and hide a real change.
+REQUIRED_RESOURCES = ("FPHb", "BDHb")
+
+_HEADER = struct.Struct(">4sH2x4s4sIIII")
+_BLOCK_INFO_LIST = struct.Struct(">IIIII")
+_BLOCK = struct.Struct(">4sII")
+_SECTION = struct.Struct(">iIIII")
+
+
+class FormatError(ValueError):
+    """The file is not a LabVIEW resource file, or one this module can't read."""
+
+
+class ResourceFile:
+    """Table of the resources in a memory-mapped LabVIEW file."""
+
+    def __init__(self, data: typing.Union[bytes, mmap.mmap]):
+        self.data = data
+        try:
+            magic, _, file_type, _, info_offset, _, self.data_offset, _ = _HEADER.unpack_from(data, 0)
+            if magic != b"RSRC":
+                raise FormatError("not a resource file")
+            self.file_type = file_type.decode("latin-1")
+            # The table is preceded by a copy of the file header.
+            _, _, _, block_info_offset, _ = _BLOCK_INFO_LIST.unpack_from(data, info_offset + _HEADER.size)
+            block_info = info_offset + block_info_offset
+            block_count = struct.unpack_from(">I", data, block_info)[0] + 1
+
+            self.sections = {}
+            for i in range(block_count):
+                ident, section_count, sections_offset = _BLOCK.unpack_from(data, block_info + 4 + i * _BLOCK.size)
+                for j in range(section_count + 1):
+                    index, _, _, offset, _ = _SECTION.unpack_from(
+                        data, block_info + sections_offset + j * _SECTION.size)
+                    self.sections[(ident.decode("latin-1"), index)] = self.data_offset + offset
+        except struct.error as e:
+            raise FormatError(f"truncated resource file: {e}")
+
+    def resource(self, ident: str, index: int = 0) -> bytes:
+        """The data of a resource, without its size prefix."""
+        offset = self.sections[(ident, index)]
+        try:
+            size = struct.unpack_from(">I", self.data, offset)[0]
+        except struct.error as e:
+            raise FormatError(f"truncated resource {ident}: {e}")
+        if offset + 4 + size > len(self.data):
+            raise FormatError(f"truncated resource {ident}")
+        return self.data[offset + 4:offset + 4 + size]
+
+    def digest(self, idents: typing.AbstractSet[str] = VISUAL_RESOURCES) -> str:
+        """Hash the given resource types, independently of their order in the file."""
+        sha = hashlib.sha256()
+        for ident, index in sorted(key for key in self.sections if key[0] in idents):
+            data = self.resource(ident, index)
+            sha.update(struct.pack(">4siI", ident.encode("latin-1"), index, len(data)))
+            sha.update(data)
+        return sha.hexdigest()
+
+
+def visual_digest(filename: str) -> str:
+    """Hash the resources of a LabVIEW file which appear in a diff image."""
+    with open(filename, "rb") as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise FormatError("empty file")
+        with data:
+            resources = ResourceFile(data)
+            present = {ident for ident, _ in resources.sections}
+            for ident in REQUIRED_RESOURCES:
+                if ident not in present:
+                    raise FormatError(f"no {ident} resource")
+            return resources.digest()
+
+
+def same_visual(old_vi: str, new_vi: str) -> bool:
+    """Whether two versions of a VI would diff as identical, or False if either can't be read."""
+    try:
+        return visual_digest(old_vi) == visual_digest(new_vi)
+    except (FormatError, OSError):
+        return False
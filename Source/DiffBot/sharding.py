@@ -0,0 +1,219 @@
+"""Module sharding splits the VIs to diff across several CI nodes, and merges their output.
+
+Each node runs diffvi.py with the same changed VIs and `--shard-index i
+--shard-count n`, and diffs only its own shard. VIs are assigned greedily,
+most expensive first, to the least loaded shard. Balancing estimated time
+rather than the number of VIs keeps the slowest shard close to the average,
+even when a few huge VIs take most of the time.
+
+A VI's cost is its recorded diff duration from earlier runs, if there is one.
+Durations are kept in a small SQLite database, `--history-db`, as a moving
+average per file. VIs without history are estimated from their size, with a
+launch cost plus seconds per byte fitted to the history, or from defaults.
+
+Every node has to compute the same partition, so every node must use the same
+history database, e.g. restored from the same CI cache before the shards start.
+Shards only read it: they write the durations they measured to their plan, and
+the merge step records them.
+Each shard writes its plan to shard_plan.json. `merge` (`python sharding.py
+--output DIR SHARD_DIR...`) checks that all plans agree and cover every VI once.
+It then combines the images, diff_failures.txt, no_visual_change.txt and
+renamed.txt of the shards into one directory for diffbot.py.
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import time
+import typing
+from os import path
+
+# Cost model for VIs with no history, until there is enough history to fit one.
+DEFAULT_LAUNCH_SECONDS = 10.0
+DEFAULT_SECONDS_PER_BYTE = 5.0 / (1024 * 1024)
+# Weight of the newest duration in a file's moving average.
+SMOOTHING = 0.5
+
+PLAN_FILE = "shard_plan.json"
+APPENDED_FILES = ("diff_failures.txt", "no_visual_change.txt", "renamed.txt")
+
+
+class DurationHistory:
+    """Moving average diff duration of each file, in a SQLite database."""
+
+    def __init__(self, filename: str):
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS durations ("
+            "filename TEXT PRIMARY KEY, seconds REAL NOT NULL, bytes INTEGER NOT NULL, "
+            "runs INTEGER NOT NULL, updated REAL NOT NULL)")
+
+    def durations(self) -> typing.Dict[str, typing.Tuple[float, int]]:
+        """Map each file to its (average seconds, bytes when last diffed)."""
+        return {filename: (seconds, size) for filename, seconds, size in
+                self.connection.execute("SELECT filename, seconds, bytes FROM durations")}
+
+    def record(self, durations: typing.Iterable[typing.Tuple[str, float, int]]):
+        """Add (filename, seconds, bytes) measurements to the moving averages."""
+        with self.connection:
+            for filename, seconds, size in durations:
+                self.connection.execute(
+                    "INSERT INTO durations VALUES (?, ?, ?, 1, ?) ON CONFLICT(filename) DO UPDATE SET "
+                    "seconds = ? * excluded.seconds + (1 - ?) * seconds, bytes = excluded.bytes, "
+                    "runs = runs + 1, updated = excluded.updated",
+                    (filename, seconds, size, time.time(), SMOOTHING, SMOOTHING))
+
+    def close(self):
+        self.connection.close()
+
+
+def fit_size_model(durations: typing.Dict[str, typing.Tuple[float, int]]) -> typing.Tuple[float, float]:
+    """Least squares fit of seconds = launch + per_byte * bytes, falling back to the defaults."""
+    points = list(durations.values())
+    n = len(points)
+    mean_size = sum(size for _, size in points) / n if n else 0
+    variance = sum((size - mean_size) ** 2 for _, size in points)
+    if n < 2 or variance == 0:
+        return DEFAULT_LAUNCH_SECONDS, DEFAULT_SECONDS_PER_BYTE
+    mean_seconds = sum(seconds for seconds, _ in points) / n
+    per_byte = sum((size - mean_size) * (seconds - mean_seconds) for seconds, size in points) / variance
+    per_byte = max(per_byte, 0.0)
+    return max(mean_seconds - per_byte * mean_size, 0.0), per_byte
+
+
+def estimate_costs(filenames: typing.Iterable[str],
+                   durations: typing.Optional[typing.Dict[str, typing.Tuple[float, int]]] = None
+                   ) -> typing.Dict[str, float]:
+    """Estimate the seconds each file takes to diff, from its history or its size."""
+    durations = durations or {}
+    launch, per_byte = fit_size_model(durations)
+    costs = {}
+    for filename in filenames:
+        if filename in durations:
+            costs[filename] = durations[filename][0]
+        else:
+            size = path.getsize(filename) if path.isfile(filename) else 0
+            costs[filename] = launch + per_byte * size
+    return costs
+
+
+def partition(filenames: typing.Iterable[str], costs: typing.Dict[str, float],
+              shard_count: int) -> typing.List[typing.List[str]]:
+    """Split files into shard_count shards of about equal total cost.
+
+    Files are assigned most expensive first to the shard with the least cost so
+    far (longest processing time first). Ties are broken by file name and shard
+    index, so the same inputs always give the same shards."""
+    shards = [[] for _ in range(shard_count)]
+    loads = [0.0] * shard_count
+    for filename in sorted(set(filenames), key=lambda filename: (-costs[filename], filename)):
+        shard = min(range(shard_count), key=lambda i: (loads[i], i))
+        shards[shard].append(filename)
+        loads[shard] += costs[filename]
+    return shards
+
+
+def plan_digest(shards: typing.List[typing.List[str]]) -> str:
+    return hashlib.sha256(json.dumps(shards).encode()).hexdigest()
+
+
+def select_shard(diffs: typing.List[typing.Tuple[str, str]], shard_index: int, shard_count: int,
+                 history: typing.Optional[DurationHistory] = None
+                 ) -> typing.Tuple[typing.List[typing.Tuple[str, str]], dict]:
+    """Pick this shard's (status, filename) diffs.
+
+    Returns the diffs, in their original order, and the plan to record in shard_plan.json."""
+    filenames = [filename for _, filename in diffs]
+    costs = estimate_costs(filenames, history.durations() if history is not None else None)
+    shards = partition(filenames, costs, shard_count)
+    mine = set(shards[shard_index])
+    loads = [sum(costs[filename] for filename in shard) for shard in shards]
+    print("Shard {0} of {1}: {2} of {3} VIs, estimated {4:.1f}s (shards: {5})".format(
+        shard_index, shard_count, len(mine), len(filenames), loads[shard_index],
+        ", ".join(f"{load:.1f}s" for load in loads)))
+    plan = {
+        "shard_index": shard_index,
+        "shard_count": shard_count,
+        "plan_digest": plan_digest(shards),
+        "files": shards[shard_index],
+        "all_files": sorted(set(filenames)),
+    }
+    return [(status, filename) for status, filename in diffs if filename in mine], plan
+
+
+def write_plan(output_dir: str, plan: dict):
+    with open(path.join(output_dir, PLAN_FILE), "w") as f:
+        json.dump(plan, f, indent=2)
+
+
+def merge(shard_dirs: typing.List[str], output_dir: str,
+          history: typing.Optional[DurationHistory] = None) -> typing.List[str]:
+    """Combine the output of shards into output_dir, returning any problems with their plans.
+
+    Images are copied; diff_failures.txt, no_visual_change.txt and renamed.txt are
+    appended in shard order. The diff durations the shards measured are recorded in history."""
+    os.makedirs(output_dir, exist_ok=True)
+    plans = []
+    for shard_dir in shard_dirs:
+        plan_file = path.join(shard_dir, PLAN_FILE)
+        if path.exists(plan_file):
+            with open(plan_file, "r") as f:
+                plans.append(json.load(f))
+        for name in sorted(os.listdir(shard_dir)):
+            src = path.join(shard_dir, name)
+            if name == PLAN_FILE or not path.isfile(src):
+                continue
+            if name in APPENDED_FILES:
+                with open(src, "r") as f_in, open(path.join(output_dir, name), "a+") as f_out:
+                    f_out.write(f_in.read())
+            else:
+                shutil.copy(src, path.join(output_dir, name))
+    if history is not None:
+        history.record(tuple(duration) for plan in plans for duration in plan.get("durations", ()))
+    return check_plans(plans)
+
+
+def check_plans(plans: typing.List[dict]) -> typing.List[str]:
+    """Check that the shards agreed on the partition, and that every file was diffed by exactly one shard."""
+    if not plans:
+        return ["no shard plans found"]
+    problems = []
+    if len({plan["plan_digest"] for plan in plans}) > 1:
+        problems.append("shards computed different partitions; were they given the same history database?")
+    shard_count = plans[0]["shard_count"]
+    missing_shards = set(range(shard_count)) - {plan["shard_index"] for plan in plans}
+    if missing_shards:
+        problems.append("missing output of shards " + ", ".join(map(str, sorted(missing_shards))))
+    diffed = {}
+    for plan in plans:
+        for filename in plan["files"]:
+            diffed[filename] = diffed.get(filename, 0) + 1
+    all_files = set().union(*(plan["all_files"] for plan in plans))
+    for filename in sorted(all_files):
+        if diffed.get(filename, 0) != 1:
+            problems.append(f"{filename} was diffed by {diffed.get(filename, 0)} shards")
+    return problems
+
+
+parser = argparse.ArgumentParser(description="Merge the output of diffvi.py shards for diffbot.py")
+parser.add_argument(
+    "--output", required=True,
+    help="Directory to merge the shards' diff output into")
+parser.add_argument(
+    "shard_dirs", nargs="+",
+    help="The --diffdir of each shard")
+parser.add_argument(
+    "--history-db",
+    help="SQLite database of past diff durations per VI to record the shards' durations in")
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    history = DurationHistory(args.history_db) if args.history_db else None
+    problems = merge(args.shard_dirs, args.output, history)
+    if history is not None:
+        history.close()
+    for problem in problems:
+        print("Warning: " + problem)
+    print(f"Merged {len(args.shard_dirs)} shards into {args.output}")
@@ -0,0 +1,28 @@
+"""Tests of the .gitignore-style glob patterns changeset.IgnoreRules matches VI paths with."""
+import unittest
+
+import changeset
+
+
+class IgnoreRulesTest(unittest.TestCase):
+
+    def test_character_class(self):
+        rules = changeset.IgnoreRules(["[AB]*.vi"])
+        self.assertTrue(rules.ignores("Ax.vi"))
+        self.assertFalse(rules.ignores("Cx.vi"))
+
+    def test_negated_character_class(self):
+        for pattern in ("[!A]*.vi", "[^A]*.vi"):
+            rules = changeset.IgnoreRules([pattern])
+            self.assertFalse(rules.ignores("Ax.vi"), pattern)
+            self.assertTrue(rules.ignores("Bx.vi"), pattern)
+            self.assertTrue(rules.ignores("dir/Bx.vi"), pattern)
+
+    def test_negated_character_class_does_not_match_slash(self):
+        rules = changeset.IgnoreRules(["dir/a[!x]b.vi"])
+        self.assertTrue(rules.ignores("dir/acb.vi"))
+        self.assertFalse(rules.ignores("dir/a/b.vi"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,200 @@
+"""Tests of diffbot's and the pipeline's GitHub uploads and PR queries, against benchmark.FakeGitHub."""
+import asyncio
+import time
+import unittest
+from os import path
+from unittest import mock
+
+import benchmark
+import diffbot
+import fixtures
+import pipeline
+
+
+class FakeGitHubTestCase(fixtures.TestCase):
+    """Points diffbot at a fresh FakeGitHub for each test."""
+
+    pr = benchmark.synthetic_pr(files=3, commits=2, comments=1)
+
+    def setUp(self):
+        super().setUp()
+        self.server = benchmark.FakeGitHub(self.pr)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        api_url = diffbot.API_URL
+        diffbot.API_URL = self.server.url
+        self.addCleanup(setattr, diffbot, "API_URL", api_url)
+
+    def calls(self, method: str, suffix: str) -> list:
+        return [call for call in self.server.calls if call[0] == method and call[1].endswith(suffix)]
+
+
+class UploadTest(FakeGitHubTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.pngfiles = {}
+        for i in range(3):
+            name = f"VI {i}.vi.png"
+            benchmark.write_png(path.join(self.directory, name), str(i))
+            self.pngfiles[name] = path.join(self.directory, name)
+
+    def test_single_commit_makes_one_commit_and_ref_update(self):
+        files = [(f"pull/1/{name}", pngpath) for name, pngpath in self.pngfiles.items()]
+        sha = diffbot.upload_files_single_commit("token", files, "owner", "repo")
+
+        self.assertEqual(len(self.calls("POST", "/git/blobs")), 3)
+        self.assertEqual(len(self.calls("POST", "/git/trees")), 1)
+        self.assertEqual(len(self.calls("POST", "/git/commits")), 1)
+        self.assertEqual(len(self.calls("PATCH", "/git/refs/heads/main")), 1)
+        self.assertEqual(self.calls("PUT", ""), [])
+        self.assertEqual(self.server.head, sha)
+        self.assertEqual(self.server.objects[sha]["parents"], ["commit0"])
+
+    def test_moved_branch_rebuilds_commit_without_uploading_blobs_again(self):
+        self.server.reject_ref_updates = 1
+        files = [(f"pull/1/{name}", pngpath) for name, pngpath in self.pngfiles.items()]
+        sha = diffbot.upload_files_single_commit("token", files, "owner", "repo")
+
+        self.assertEqual(len(self.calls("POST", "/git/blobs")), 3)
+        self.assertEqual(len(self.calls("POST", "/git/commits")), 2)
+        self.assertEqual(len(self.calls("PATCH", "/git/refs/heads/main")), 2)
+        self.assertEqual(self.server.head, sha)
+        # The second commit is on top of the commit someone else pushed.
+        pushed = self.server.objects[sha]["parents"][0]
+        self.assertNotEqual(pushed, "commit0")
+        self.assertEqual(self.server.objects[pushed]["parents"], ["commit0"])
+
+    def test_gives_up_when_the_branch_keeps_moving(self):
+        self.server.reject_ref_updates = 5
+        files = [(f"pull/1/{name}", pngpath) for name, pngpath in self.pngfiles.items()]
+        with self.assertRaises(IOError):
+            diffbot.upload_files_single_commit("token", files, "owner", "repo")
+        self.assertEqual(len(self.calls("PATCH", "/git/refs/heads/main")), 5)
+
+    def test_upload_pngs_commits_images_and_manifest_together(self):
+        urls = diffbot.upload_pngs("token", self.pngfiles, "owner", "repo", 1)
+
+        self.assertEqual(list(urls), list(self.pngfiles))
+        # Three images and the manifest, in one commit.
+        self.assertEqual(len(self.calls("POST", "/git/blobs")), 4)
+        self.assertEqual(len(self.calls("POST", "/git/commits")), 1)
+        self.assertEqual(len(self.calls("PATCH", "/git/refs/heads/main")), 1)
+        self.assertEqual(self.calls("PUT", ""), [])
+
+    def test_upload_pngs_reuses_images_from_the_committed_manifest(self):
+        first = diffbot.upload_pngs("token", self.pngfiles, "owner", "repo", 1)
+        self.server.calls.clear()
+        second = diffbot.upload_pngs("token", self.pngfiles, "owner", "repo", 1)
+
+        self.assertEqual(second, first)
+        self.assertEqual(self.calls("POST", "/git/blobs"), [])
+        self.assertEqual(self.calls("PATCH", "/git/refs/heads/main"), [])
+
+    def test_pipeline_uploader_commits_once_and_shares_the_manifest(self):
+        async def upload(pngfiles: dict) -> dict:
+            uploader = pipeline.Uploader("token", 1, jobs=2)
+            urls = {name: await uploader.upload(name, pngpath) for name, pngpath in pngfiles.items()}
+            await uploader.commit()
+            return urls
+
+        urls = asyncio.run(upload(self.pngfiles))
+        # Blobs are created as each image is uploaded, then committed with the manifest once.
+        self.assertEqual(len(self.calls("POST", "/git/blobs")), 4)
+        self.assertEqual(len(self.calls("PATCH", "/git/refs/heads/main")), 1)
+        self.assertEqual(self.calls("PUT", ""), [])
+
+        self.server.calls.clear()
+        self.assertEqual(diffbot.upload_pngs("token", self.pngfiles, diffbot.DIFF_OWNER, diffbot.DIFF_REPO, 1), urls)
+        self.assertEqual(self.calls("POST", "/git/blobs"), [])
+
+
+class RetryTest(FakeGitHubTestCase):
+    """request_with_retry against rate limits and transient errors, without actually waiting."""
+
+    def setUp(self):
+        super().setUp()
+        fake_time = mock.Mock(wraps=time)
+        self.sleep = fake_time.sleep = mock.Mock()
+        patch = mock.patch.object(diffbot, "time", fake_time)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def get(self, **kwargs):
+        return diffbot.request_with_retry(diffbot.make_session("token"), "GET",
+                                          f"{self.server.url}/repos/owner/repo/git/ref/heads/main", **kwargs)
+
+    def delays(self) -> list:
+        return [call.args[0] for call in self.sleep.call_args_list]
+
+    def test_retry_after_seconds(self):
+        self.server.failures = [(429, {"Retry-After": "7"}, "Too many requests")]
+        self.assertEqual(self.get().status_code, 200)
+        self.assertEqual(self.delays(), [7.0])
+
+    def test_retry_after_date_falls_back_to_backoff(self):
+        self.server.failures = [(429, {"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"}, "Too many requests")]
+        self.assertEqual(self.get(backoff=1.0).status_code, 200)
+        [delay] = self.delays()
+        self.assertTrue(1.0 <= delay <= 2.0, delay)
+
+    def test_forbidden_retry_after(self):
+        self.server.failures = [(403, {"Retry-After": "3"}, "You have exceeded a secondary rate limit")]
+        self.assertEqual(self.get().status_code, 200)
+        self.assertEqual(self.delays(), [3.0])
+
+    def test_secondary_rate_limit_backs_off(self):
+        self.server.failures = [(403, {}, "You have exceeded a secondary rate limit")] * 2
+        self.assertEqual(self.get(backoff=1.0).status_code, 200)
+        first, second = self.delays()
+        self.assertTrue(1.0 <= first <= 2.0, first)
+        self.assertTrue(2.0 <= second <= 3.0, second)
+
+    def test_primary_rate_limit_waits_for_reset(self):
+        reset = str(int(time.time()) + 60)
+        self.server.failures = [(403, {"x-ratelimit-remaining": "0", "x-ratelimit-reset": reset},
+                                 "API rate limit exceeded")]
+        self.assertEqual(self.get().status_code, 200)
+        [delay] = self.delays()
+        self.assertAlmostEqual(delay, 60, delta=2)
+
+    def test_other_errors_are_not_retried(self):
+        self.server.failures = [(403, {}, "Resource not accessible by integration")]
+        self.assertEqual(self.get().status_code, 403)
+        self.assertEqual(len(self.server.calls), 1)
+        self.assertEqual(self.delays(), [])
+
+    def test_gives_up_after_retries(self):
+        self.server.failures = [(502, {}, "Bad gateway")] * 3
+        self.assertEqual(self.get(retries=2).status_code, 502)
+        self.assertEqual(len(self.server.calls), 3)
+        self.assertEqual(len(self.delays()), 2)
+
+
+class FetchPrFeaturesTest(FakeGitHubTestCase):
+
+    pr = benchmark.synthetic_pr(files=2 * diffbot.PAGE_SIZE + 50, commits=diffbot.PAGE_SIZE + 30,
+                                comments=diffbot.PAGE_SIZE + 1)
+    commits = pr["data"]["repository"]["pullRequest"]["commits"]["edges"]
+    commits[-1]["node"]["commit"]["message"] = "Last commit, on the final page"
+
+    def test_connections_are_stitched_together_across_pages(self):
+        features = diffbot.fetch_pr_features("token", "owner/repo", 1)
+
+        self.assertEqual(features["file_count"], 2 * diffbot.PAGE_SIZE + 50)
+        self.assertEqual(features["commit_count"], diffbot.PAGE_SIZE + 30)
+        self.assertEqual(len(features["commit_dates"]), diffbot.PAGE_SIZE + 30)
+        self.assertEqual(features["comment_count"], diffbot.PAGE_SIZE + 1)
+        # The first page of everything, then two more pages of files, one of commits and one of comments.
+        self.assertEqual(len(self.calls("POST", "/graphql")), 5)
+
+    def test_last_commit_comes_from_the_final_page(self):
+        # Only the commits are queried for this analyzer.
+        features = diffbot.fetch_pr_features("token", "owner/repo", 1, ["last_commit_message_contains_fix"])
+
+        self.assertEqual(features["last_commit_message_lower"], "last commit, on the final page")
+        self.assertEqual(len(self.calls("POST", "/graphql")), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,238 @@
+"""Tests of how diffvi decides which VIs to diff, reuses cached diffs, and records the diffs it ran."""
+import json
+import os
+import time
+import unittest
+from os import path
+
+import diffcache
+import diffvi
+import fixtures
+import timing
+
+
+class SplitCompileOnlyTest(fixtures.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        # The same VI in the target ref and the working tree, as for a VI using a changed typedef.
+        self.export_dir = path.join(self.directory, "export")
+        self.copy_vi("export/A.vi")
+        self.copy_vi("work/A.vi")
+        self.chdir(path.join(self.directory, "work"))
+
+    def test_identical_vi_has_no_visual_change(self):
+        tasks, unchanged = diffvi.split_compile_only([("M", "A.vi")], self.export_dir)
+        self.assertEqual(tasks, [])
+        self.assertEqual(unchanged, ["A.vi"])
+
+    def test_dependents_are_diffed_even_when_identical(self):
+        controls = {"A.vi": ("Type.ctl",)}
+        tasks, unchanged = diffvi.split_compile_only([("M", "A.vi")], self.export_dir, controls)
+        self.assertEqual(tasks, [("M", "A.vi")])
+        self.assertEqual(unchanged, [])
+
+
+class SplitIdenticalRenamesTest(fixtures.TestCase):
+
+    diffs = [("R", "New.vi"), ("C", "Copy.vi"), ("M", "Other.vi")]
+    sources = {"New.vi": "Old.vi", "Copy.vi": "Old.vi"}
+
+    def test_identical_renames_and_copies_are_not_diffed(self):
+        diffs, renamed = diffvi.split_identical_renames(self.diffs, self.sources, {"New.vi", "Copy.vi"})
+        self.assertEqual(diffs, [("M", "Other.vi")])
+        self.assertEqual(renamed, [("Old.vi", "New.vi"), ("Old.vi", "Copy.vi")])
+
+    def test_dependents_are_diffed_even_when_identical(self):
+        controls = {"New.vi": ("Type.ctl",)}
+        diffs, renamed = diffvi.split_identical_renames(self.diffs, self.sources, {"New.vi", "Copy.vi"}, controls)
+        self.assertEqual(diffs, [("R", "New.vi"), ("M", "Other.vi")])
+        self.assertEqual(renamed, [("Old.vi", "Copy.vi")])
+
+
+class DiffCacheTest(fixtures.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.stub_gcli()
+        self.cache = diffcache.DiffCache(path.join(self.directory, "cache"), 1 << 20)
+        self.output_dir = path.join(self.directory, "diff")
+        os.makedirs(self.output_dir)
+        self.chdir(self.directory)
+
+    def diff(self, filename: str, controls=None):
+        diffvi.run_diff_task(("A", filename), "export", self.output_dir, "ops", "2020", self.cache,
+                             controls=controls)
+
+    def test_identical_vis_are_diffed_separately(self):
+        # Cloned or scripted VIs can be byte-identical; each needs its own image.
+        self.copy_vi("ModA/Alpha.vi")
+        self.copy_vi("ModB/Beta.vi")
+        self.diff("ModA/Alpha.vi")
+        self.diff("ModB/Beta.vi")
+
+        self.assertEqual(sorted(os.listdir(self.output_dir)), ["Alpha.vi.png", "Beta.vi.png"])
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 2))
+
+    def test_unchanged_vi_is_reused(self):
+        self.copy_vi("ModA/Alpha.vi")
+        self.diff("ModA/Alpha.vi")
+        os.remove(path.join(self.output_dir, "Alpha.vi.png"))
+        self.diff("ModA/Alpha.vi")
+
+        self.assertEqual(os.listdir(self.output_dir), ["Alpha.vi.png"])
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+
+class GcliTimeoutTest(fixtures.TestCase):
+    """diff_vi and run_diff_pool with a stub g-cli which hangs on Hang*.vi and fails on Fail*.vi."""
+
+    def setUp(self):
+        super().setUp()
+        self.stub_gcli()
+        self.log = path.join(self.directory, "gcli.log")
+        os.environ.update(GCLI_LOG=self.log, GCLI_HANG="Hang", GCLI_FAIL="Fail")
+        self.output_dir = path.join(self.directory, "diff")
+        os.makedirs(self.output_dir)
+        self.chdir(self.directory)
+
+    def calls(self, vi: str) -> list:
+        with open(self.log) as f:
+            calls = [json.loads(line) for line in f]
+        return [call for call in calls if call["vis"] == [path.abspath(vi)]]
+
+    def failures(self) -> str:
+        with open(path.join(self.output_dir, "diff_failures.txt")) as f:
+            return f.read()
+
+    def test_hung_diff_is_killed_and_retried_once(self):
+        self.write("Hang.vi")
+        start = time.perf_counter()
+        diffvi.diff_vi(None, path.abspath("Hang.vi"), self.output_dir, "ops", "2020", timeout=1)
+
+        self.assertLess(time.perf_counter() - start, 10)
+        self.assertEqual(len(self.calls("Hang.vi")), 2)
+        self.assertEqual(self.failures(), path.abspath("Hang.vi") + "\ttimed out after 1s\n")
+
+    def test_failed_diff_is_retried_once_with_a_timeout(self):
+        self.write("Fail.vi")
+        diffvi.diff_vi(None, path.abspath("Fail.vi"), self.output_dir, "ops", "2020", timeout=10)
+
+        self.assertEqual(len(self.calls("Fail.vi")), 2)
+        self.assertEqual(self.failures(), path.abspath("Fail.vi") + "\tg-cli exited with status 1\n")
+
+    def test_failed_diff_is_not_retried_without_a_timeout(self):
+        self.write("Fail.vi")
+        diffvi.diff_vi(None, path.abspath("Fail.vi"), self.output_dir, "ops", "2020")
+
+        self.assertEqual(len(self.calls("Fail.vi")), 1)
+        self.assertEqual(self.failures(), path.abspath("Fail.vi") + "\tg-cli exited with status 1\n")
+
+    def test_timeout_only_kills_the_labview_of_the_hung_diff(self):
+        # While Hang.vi waits to time out, the other job diffs A.vi and then B.vi,
+        # so B.vi is still being diffed when Hang.vi is killed.
+        os.environ["GCLI_LATENCY"] = "1.4"
+        for vi in ("Hang.vi", "A.vi", "B.vi"):
+            self.write(vi)
+        diffvi.run_diff_pool([("A", "Hang.vi"), ("A", "A.vi"), ("A", "B.vi")], "export", self.output_dir, "ops",
+                             "2020", jobs=2, timeout=2, labview_exes=["LabVIEW1.exe", "LabVIEW2.exe"], ordered=True)
+
+        self.assertEqual(sorted(os.listdir(self.output_dir)), ["A.vi.png", "B.vi.png", "diff_failures.txt"])
+        self.assertEqual(self.failures(), path.abspath("Hang.vi") + "\ttimed out after 2s\n")
+        hung = self.calls("Hang.vi")
+        self.assertEqual(len(hung), 2)
+        self.assertEqual({call["lv_exe"] for call in hung}, {"LabVIEW1.exe"})
+        self.assertEqual([call["lv_exe"] for call in self.calls("B.vi")], ["LabVIEW2.exe"])
+
+
+class DiffVisBatchTest(fixtures.TestCase):
+    """diff_vis_batch with a stub g-cli which reads the manifest, fails Fail*.vi and crashes at Crash*.vi."""
+
+    def setUp(self):
+        super().setUp()
+        self.stub_gcli()
+        self.log = path.join(self.directory, "gcli.log")
+        os.environ.update(GCLI_LOG=self.log, GCLI_FAIL="Fail", GCLI_CRASH="Crash")
+        self.opsdir = path.dirname(self.write("ops/DiffVIBatch.vi"))
+
+    def diff(self, *names: str) -> dict:
+        diffs = [(None, self.write(name), path.join(self.directory, "diff", name)) for name in names]
+        for _, _, output_dir in diffs:
+            os.makedirs(output_dir)
+        return diffvi.diff_vis_batch(diffs, self.opsdir, "2020")
+
+    def output(self, name: str) -> dict:
+        """The files in a VI's output directory, with the contents of its diff_failures.txt."""
+        output_dir = path.join(self.directory, "diff", name)
+        files = {}
+        for filename in os.listdir(output_dir):
+            with open(path.join(output_dir, filename)) as f:
+                files[filename] = f.read() if filename.endswith(".txt") else None
+        return files
+
+    def failure(self, name: str, reason: str) -> dict:
+        return {"diff_failures.txt": path.join(self.directory, name) + "\t" + reason + "\n"}
+
+    def test_every_vi_is_diffed_in_one_call(self):
+        results = self.diff("A.vi", "Fail.vi", "B.vi")
+
+        with open(self.log) as f:
+            self.assertEqual(len(f.readlines()), 1)
+        self.assertEqual([result["ok"] for result in results.values()], [True, False, True])
+        self.assertEqual(self.output("A.vi"), {"A.vi.png": None})
+        self.assertEqual(self.output("B.vi"), {"B.vi.png": None})
+        self.assertEqual(self.output("Fail.vi"), self.failure("Fail.vi", "stub failure"))
+
+    def test_missing_results_fail_every_vi(self):
+        results = self.diff("Crash.vi", "A.vi")
+
+        self.assertEqual(results, {})
+        self.assertEqual(self.output("Crash.vi"), self.failure("Crash.vi", "no result reported"))
+        self.assertEqual(self.output("A.vi"), self.failure("A.vi", "no result reported"))
+
+    def test_partial_results_fail_every_vi(self):
+        # A.vi was diffed, but LabVIEW crashed before it finished writing the results.
+        results = self.diff("A.vi", "Crash.vi", "B.vi")
+
+        self.assertEqual(results, {})
+        self.assertEqual(self.output("A.vi"), dict(self.failure("A.vi", "no result reported"), **{"A.vi.png": None}))
+        self.assertEqual(self.output("Crash.vi"), self.failure("Crash.vi", "no result reported"))
+        self.assertEqual(self.output("B.vi"), self.failure("B.vi", "no result reported"))
+
+    def test_missing_operation(self):
+        os.remove(path.join(self.opsdir, "DiffVIBatch.vi"))
+        with self.assertRaises(FileNotFoundError):
+            self.diff("A.vi")
+        self.assertFalse(path.exists(self.log))
+
+
+class GcliDurationsTest(unittest.TestCase):
+
+    def test_only_diffs_run_in_labview_are_timed(self):
+        tasks = [("M", "durations/diffed.vi"), ("M", "durations/cached.vi")]
+        first_span = len(timing.recorder().spans)
+        for attempt in range(2):
+            with timing.span("g-cli", vi=path.abspath("durations/diffed.vi"), attempt=attempt):
+                pass
+        with timing.span("diff_vi", vi="durations/cached.vi", status="M"):
+            pass
+
+        durations = diffvi.gcli_durations(tasks, first_span)
+        self.assertEqual([filename for filename, _, _ in durations], ["durations/diffed.vi"])
+        attempts = [span["seconds"] for span in timing.recorder().spans[first_span:] if span["name"] == "g-cli"]
+        self.assertEqual(len(attempts), 2)
+        self.assertAlmostEqual(durations[0][1], sum(attempts))
+
+    def test_earlier_runs_are_left_out(self):
+        tasks = [("M", "durations/rerun.vi")]
+        with timing.span("g-cli", vi=path.abspath("durations/rerun.vi"), attempt=0):
+            time.sleep(0.2)
+        first_span = len(timing.recorder().spans)
+        with timing.span("g-cli", vi=path.abspath("durations/rerun.vi"), attempt=0):
+            pass
+
+        [(_, seconds, _)] = diffvi.gcli_durations(tasks, first_span)
+        self.assertLess(seconds, 0.1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+"""Tests that responsecache stores GitHub responses and PR features as JSON, and treats bad entries as misses."""
+import collections
+import datetime
+import pickle
+import unittest
+
+import fixtures
+import responsecache
+
+
+class ResponseCacheTest(fixtures.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.cache = responsecache.ResponseCache(self.directory, ttl=60)
+
+    def test_features_round_trip(self):
+        created = datetime.datetime(2024, 10, 31, 12, 30, tzinfo=datetime.timezone.utc)
+        features = {
+            "created_at": created,
+            "commit_dates": [created, created + datetime.timedelta(hours=1)],
+            "change_type_counts": collections.Counter({"ADDED": 2, "MODIFIED": 1}),
+            "title_lower": "fix",
+            "last_commit_pst": None,
+        }
+        self.cache.put("features", features, updated_at="2024-10-31T12:30:00Z")
+
+        entry = self.cache.get("features")
+        self.assertEqual(entry["value"], features)
+        self.assertIsInstance(entry["value"]["change_type_counts"], collections.Counter)
+        self.assertEqual(entry["updated_at"], "2024-10-31T12:30:00Z")
+        self.assertTrue(self.cache.fresh(entry))
+
+    def test_entries_are_json(self):
+        self.cache.put("key", {"a": [1, 2]}, etag='"abc"')
+        with open(self.cache._path("key"), "r") as f:
+            self.assertIn('"etag": "\\"abc\\""', f.read())
+
+    def test_unreadable_entries_are_misses(self):
+        self.assertIsNone(self.cache.get("missing"))
+        with open(self.cache._path("corrupt"), "wb") as f:
+            f.write(pickle.dumps({"time": 0, "value": 1}))
+        self.assertIsNone(self.cache.get("corrupt"))
+        with open(self.cache._path("list"), "w") as f:
+            f.write("[1, 2]")
+        self.assertIsNone(self.cache.get("list"))
+
+
+if __name__ == "__main__":
+    unittest.main()
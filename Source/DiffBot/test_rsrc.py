@@ -0,0 +1,34 @@
+"""Tests that rsrc's visual digest tells re-saved VIs from changed ones, and rejects files it can't read."""
+import unittest
+
+import fixtures
+import rsrc
+
+
+class VisualDigestTest(fixtures.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        with open(fixtures.TEST_VI, "rb") as f:
+            self.data = f.read()
+
+    def rename_resource(self, ident: bytes, new_ident: bytes) -> bytes:
+        """Change the type of a resource in the table, as if the file didn't have it."""
+        info_offset = rsrc._HEADER.unpack_from(self.data, 0)[4]
+        block = self.data.index(ident, info_offset)
+        return self.data[:block] + new_ident + self.data[block + 4:]
+
+    def test_copies_have_the_same_digest(self):
+        self.assertTrue(rsrc.same_visual(self.write("old.vi", self.data), self.write("new.vi", self.data)))
+
+    def test_missing_heaps_are_a_format_error(self):
+        for ident in rsrc.REQUIRED_RESOURCES:
+            data = self.rename_resource(ident.encode(), b"XXXX")
+            filename = self.write(ident + ".vi", data)
+            with self.assertRaises(rsrc.FormatError, msg=ident):
+                rsrc.visual_digest(filename)
+            self.assertFalse(rsrc.same_visual(filename, filename), ident)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,127 @@
+"""Module timing records where a DiffBot run spends its time, for a JSON run report.
+
+Code under measurement is wrapped in a span, which records its name, start
+offset, duration and any attributes, such as the VI being diffed:
+
+    with timing.span("diff_vi", vi=new_vi):
+        ...
+
+Counters add up quantities such as bytes uploaded and HTTP retries. Spans and
+counters go to a process-wide recorder, so that deeply nested and threaded code
+can report without a recorder being passed down to it. `write_report` writes
+the phase totals, every span, the counters and the peak memory to a JSON file,
+for graphing runs over time.
+"""
+import json
+import sys
+import threading
+import time
+import typing
+from contextlib import contextmanager
+
+
+def peak_rss_bytes() -> int:
+    """Peak resident set size of this process in bytes, or 0 if it can't be measured."""
+    if sys.platform == "win32":
+        import ctypes
+        from ctypes import wintypes
+
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD),
+                        ("PageFaultCount", wintypes.DWORD),
+                        ("PeakWorkingSetSize", ctypes.c_size_t),
+                        ("WorkingSetSize", ctypes.c_size_t),
+                        ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                        ("PagefileUsage", ctypes.c_size_t),
+                        ("PeakPagefileUsage", ctypes.c_size_t)]
+
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        get_memory_info = ctypes.windll.psapi.GetProcessMemoryInfo
+        get_memory_info.argtypes = [wintypes.HANDLE, ctypes.POINTER(ProcessMemoryCounters), wintypes.DWORD]
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if get_memory_info(process, ctypes.byref(counters), counters.cb):
+            return counters.PeakWorkingSetSize
+        return 0
+    try:
+        import resource
+    except ImportError:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes everywhere else.
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class Recorder:
+    """Thread-safe collection of spans and counters."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.spans = []
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """Time the body of a with statement as a span called name."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            record = {"name": name, "start": start - self.start, "seconds": end - start, **attributes}
+            with self._lock:
+                self.spans.append(record)
+
+    def count(self, name: str, amount: int = 1):
+        """Add amount to the counter called name."""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def phases(self) -> typing.Dict[str, dict]:
+        """Total {"count", "seconds"} of the spans of each name, in order of first appearance."""
+        phases = {}
+        with self._lock:
+            for record in self.spans:
+                phase = phases.setdefault(record["name"], {"count": 0, "seconds": 0.0})
+                phase["count"] += 1
+                phase["seconds"] += record["seconds"]
+        return phases
+
+    def report(self, **meta) -> dict:
+        """Build the run report, with any extra metadata such as the command that was run."""
+        phases = self.phases()
+        with self._lock:
+            return dict(meta,
+                        wall_seconds=time.perf_counter() - self.start,
+                        peak_rss_bytes=peak_rss_bytes(),
+                        phases=phases,
+                        counters=dict(self.counters),
+                        spans=sorted(self.spans, key=lambda record: record["start"]))
+
+
+_recorder = Recorder()
+
+
+def span(name: str, **attributes):
+    """Time the body of a with statement as a span of the process-wide recorder."""
+    return _recorder.span(name, **attributes)
+
+
+def count(name: str, amount: int = 1):
+    """Add amount to a counter of the process-wide recorder."""
+    _recorder.count(name, amount)
+
+
+def recorder() -> Recorder:
+    return _recorder
+
+
+def write_report(filename: str, **meta):
+    """Write the process-wide recorder's report to a JSON file."""
+    with open(filename, "w") as f:
+        json.dump(_recorder.report(**meta), f, indent=2)
+    print(f"Wrote run report to {filename}")
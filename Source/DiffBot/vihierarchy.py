@@ -0,0 +1,122 @@
+"""Module vihierarchy indexes which LabVIEW files use which others.
+
+A VI's linker information stores the names of the subVIs, typedefs and
+controls it depends on as length-prefixed (Pascal) strings. Scanning a file for
+those strings finds its dependencies without loading it into LabVIEW. The
+index maps each file to the files that use it, is built once per git tree and
+cached on disk by the tree SHA, so it is only rebuilt when the tree changes.
+
+Names are matched by file name, so two files with the same name in different
+directories are both treated as dependencies. That can only add diffs, not
+lose them.
+"""
+import json
+import os
+import re
+import subprocess
+import typing
+from os import path
+
+INDEXED_EXTENSIONS = (".vi", ".vit", ".vim", ".ctl", ".ctt")
+CONTROL_EXTENSIONS = (".ctl", ".ctt")
+
+_EXTENSION = re.compile(rb"\.(?:vim|vit|vi|ctl|ctt)")
+
+
+def referenced_names(data: bytes) -> typing.Set[str]:
+    """Find the names of LabVIEW files referenced by length-prefixed strings in a file's bytes."""
+    names = set()
+    for match in _EXTENSION.finditer(data):
+        end = match.end()
+        for start in range(max(0, end - 256), match.start()):
+            if data[start] == end - start - 1:
+                # Library members are stored qualified, e.g. "Module.lvlib:Name.vi".
+                name = data[start + 1:end].rsplit(b":", 1)[-1].decode("latin-1")
+                names.add(name)
+    return names
+
+
+def tree_sha(ref: str = "HEAD") -> str:
+    return subprocess.check_output(["git", "rev-parse", ref + "^{tree}"]).decode("utf-8").strip()
+
+
+def labview_files(ref: str = "HEAD") -> typing.List[str]:
+    output = subprocess.check_output(["git", "ls-tree", "-r", "--name-only", ref]).decode("utf-8")
+    return [filename for filename in output.splitlines() if filename.endswith(INDEXED_EXTENSIONS)]
+
+
+def build_index(files: typing.Iterable[str]) -> typing.Dict[str, typing.List[str]]:
+    """Map each file to the files which reference it."""
+    files = list(files)
+    by_name = {}
+    for filename in files:
+        by_name.setdefault(path.basename(filename), []).append(filename)
+
+    callers = {}
+    for filename in files:
+        with open(filename, "rb") as f:
+            names = referenced_names(f.read())
+        for name in names:
+            for callee in by_name.get(name, ()):
+                if callee != filename:
+                    callers.setdefault(callee, []).append(filename)
+    return callers
+
+
+def load_index(cache_dir: str, ref: str = "HEAD") -> typing.Dict[str, typing.List[str]]:
+    """Get the dependency index of the working tree at ref, building it if it isn't cached."""
+    sha = tree_sha(ref)
+    cached = path.join(cache_dir, "deps-" + sha + ".json")
+    if path.exists(cached):
+        with open(cached, "r") as f:
+            return json.load(f)
+
+    callers = build_index(labview_files(ref))
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(cached + ".tmp", "w") as f:
+        json.dump(callers, f)
+    os.replace(cached + ".tmp", cached)
+    return callers
+
+
+def shown_controls(changed: typing.Iterable[str], callers: typing.Dict[str, typing.List[str]]
+                   ) -> typing.Dict[str, typing.Tuple[str, ...]]:
+    """Map each VI which shows a changed control to the sorted changed controls it shows.
+
+    A control change is followed through the controls and typedefs that contain
+    it to the VIs which use any of them directly. VIs further up the hierarchy
+    don't show the control, so their diffs wouldn't change."""
+    vis = {}
+    for changed_control in sorted(filename for filename in changed if filename.endswith(CONTROL_EXTENSIONS)):
+        pending = [changed_control]
+        seen = set(pending)
+        while pending:
+            control = pending.pop()
+            for caller in callers.get(control, ()):
+                if caller.endswith(CONTROL_EXTENSIONS):
+                    if caller not in seen:
+                        seen.add(caller)
+                        pending.append(caller)
+                else:
+                    vis.setdefault(caller, []).append(changed_control)
+    return {vi: tuple(sorted(set(controls))) for vi, controls in vis.items()}
+
+
+def affected_vis(changed: typing.Iterable[str], callers: typing.Dict[str, typing.List[str]]) -> typing.Set[str]:
+    """Find the VIs which show a changed control, see shown_controls."""
+    return set(shown_controls(changed, callers))
+
+
+def dependency_groups(filenames: typing.Iterable[str], callers: typing.Dict[str, typing.List[str]]
+                      ) -> typing.Dict[str, typing.Tuple[str, ...]]:
+    """Map each file to the sorted tuple of the indexed files it depends on.
+
+    Sorting diffs by this key puts VIs which share dependencies next to each
+    other, so a LabVIEW session diffing them in order loads each shared dependency once."""
+    filenames = set(filenames)
+    dependencies = {filename: [] for filename in filenames}
+    for callee, callee_callers in callers.items():
+        for caller in callee_callers:
+            if caller in filenames:
+                dependencies[caller].append(callee)
+    return {filename: tuple(sorted(deps)) for filename, deps in dependencies.items()}